@@ -0,0 +1,162 @@
+
+# find the skeleton arduinos on the serial ports
+# all candidate ports are probed concurrently, each probe resets the board and waits for its greeting
+# with blocking reads. the last good port -> board mapping is cached by usb serial number (or
+# /dev/serial/by-id path), the cached ports are probed first and a full scan follows only if a board is missing
+import os
+import time
+import concurrent.futures
+import serial   # pip install pyserial
+import simplejson as json
+
+import config
+
+BY_ID_DIR = "/dev/serial/by-id"
+
+
+def portIdentity(usbPort):
+    """
+    :return: usb serial number, by-id path or the port name itself, stable over re-enumeration if possible
+    """
+    try:
+        from serial.tools import list_ports
+        for portInfo in list_ports.comports():
+            if portInfo.device == usbPort and portInfo.serial_number:
+                return f"serial:{portInfo.serial_number}"
+    except Exception:
+        pass
+    if os.path.isdir(BY_ID_DIR):
+        for linkName in os.listdir(BY_ID_DIR):
+            linkPath = os.path.join(BY_ID_DIR, linkName)
+            if os.path.realpath(linkPath) == os.path.realpath(usbPort):
+                return linkPath
+    return usbPort
+
+
+def portFromIdentity(identity):
+    """
+    :return: current port name of a cached identity, None if the device is not present
+    """
+    if identity.startswith("serial:"):
+        try:
+            from serial.tools import list_ports
+            for portInfo in list_ports.comports():
+                if portInfo.serial_number == identity[len("serial:"):]:
+                    return portInfo.device
+        except Exception:
+            pass
+        return None
+    return identity if os.path.exists(identity) else None
+
+
+def loadPortCache():
+    """
+    :return: dict arduinoIndex -> port identity of the last successful connection
+    """
+    try:
+        with open(config.arduinoPortCacheFile, 'r') as infile:
+            return {int(arduinoIndex): identity for arduinoIndex, identity in json.load(infile).items()}
+    except Exception:
+        return {}
+
+
+def savePortCache(found):
+    cache = {arduinoIndex: portIdentity(usbPort) for arduinoIndex, (usbPort, _, _) in found.items()}
+    try:
+        with open(config.arduinoPortCacheFile, 'w') as outfile:
+            json.dump(cache, outfile, indent=2)
+    except Exception as e:
+        config.log(f"could not save arduino port cache {config.arduinoPortCacheFile}, {e}")
+
+
+def probePort(usbPort, greetingTimeout=5.0):
+    """
+    reset the device on the port and wait for a skeleton arduino greeting ("S0 ..." or "S1 ...")
+    :return: (arduinoIndex, connection, greeting), None if the port has no skeleton arduino
+    """
+    start = time.monotonic()
+    try:
+        arduino = serial.Serial(usbPort, baudrate=115200, timeout=0.5)
+    except Exception as e:
+        config.log(f"probe {usbPort}: could not open port, {time.monotonic() - start:.2f} s")
+        return None
+
+    try:
+        # Toggle DTR to reset Arduino
+        arduino.setDTR(False)
+        time.sleep(1)
+        arduino.flushInput()
+        arduino.setDTR(True)
+    except Exception as e:
+        # ports without modem control lines (e.g. emulator pseudo terminals) can not be reset
+        config.log(f"could not reset device on {usbPort}, {e}")
+
+    # blocking reads with timeout, the arduino sends its greeting after the reset
+    deadline = time.monotonic() + greetingTimeout
+    while time.monotonic() < deadline:
+        try:
+            recvB = arduino.readline()
+        except Exception as e:
+            config.log(f"probe {usbPort}: read failed, {e}")
+            break
+        if len(recvB) == 0:
+            continue
+        try:
+            recv = recvB.decode().rstrip("\r\n")
+        except Exception as e:
+            config.log(f"probe {usbPort}: problem with decoding msg '{recvB}' {e}")
+            continue
+
+        if recv[0:3] in ("S0 ", "S1 "):
+            config.log(f"probe {usbPort}: received {recv}, skeletonControlArduino {recv[0:2]} in {time.monotonic() - start:.2f} s")
+            return int(recv[1]), arduino, recv
+        config.log(f"probe {usbPort}: received {recv}, not a skeletonControlArduino, {time.monotonic() - start:.2f} s")
+        break
+    else:
+        config.log(f"probe {usbPort}: no greeting within {greetingTimeout} s")
+
+    arduino.close()
+    return None
+
+
+def probePorts(usbPorts, found):
+    """
+    probe the ports concurrently, add the skeleton arduinos to found (arduinoIndex -> (usbPort, connection, greeting))
+    """
+    if len(usbPorts) == 0:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(usbPorts)) as pool:
+        for usbPort, result in zip(usbPorts, pool.map(probePort, usbPorts)):
+            if result is None:
+                continue
+            arduinoIndex, arduino, greeting = result
+            if arduinoIndex in found:
+                config.log(f"{usbPort}: arduino S{arduinoIndex} already connected on {found[arduinoIndex][0]}, ignored")
+                arduino.close()
+                continue
+            found[arduinoIndex] = (usbPort, arduino, greeting)
+
+
+def discoverArduinos(candidates, numArduinos):
+    """
+    :return: dict arduinoIndex -> (usbPort, connection, greeting)
+    """
+    start = time.monotonic()
+    found = {}
+
+    cachedPorts = [portFromIdentity(identity) for identity in loadPortCache().values()]
+    cachedPorts = [usbPort for usbPort in cachedPorts if usbPort is not None]
+    if len(cachedPorts) > 0:
+        config.log(f"probe cached arduino ports {cachedPorts}")
+        probePorts(cachedPorts, found)
+
+    if len(found) < numArduinos:
+        probedPorts = {os.path.realpath(usbPort) for usbPort in cachedPorts}
+        remainingPorts = [usbPort for usbPort in candidates if os.path.realpath(usbPort) not in probedPorts]
+        config.log(f"probe arduino ports {remainingPorts}")
+        probePorts(remainingPorts, found)
+
+    if len(found) == numArduinos:
+        savePortCache(found)
+    config.log(f"arduino discovery finished in {time.monotonic() - start:.2f} s, found {sorted(found)}")
+    return found
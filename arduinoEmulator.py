@@ -0,0 +1,318 @@
+
+# emulation of the two skeleton arduinos (S0, S1) on linux pseudo terminals
+# allows to run and profile skeletonControl without the hardware connected
+#
+# the emulator understands the text command set sent by arduinoSend (and optionally the binary
+# frames of arduinoProtocol) and reports servo states with the compressed 0xC0 status frames
+# read by arduinoReceive
+import os
+import tty
+import time
+import select
+import threading
+
+import arduinoProtocol
+
+# status flag bits as decoded in arduinoReceive
+FLAG_ASSIGNED = 0x01
+FLAG_MOVING = 0x02
+FLAG_ATTACHED = 0x04
+FLAG_AUTO_DETACH = 0x08
+FLAG_VERBOSE = 0x10
+FLAG_TARGET_REACHED = 0x20
+FLAG_FILLER = 0x40      # unused bit, keeps the flag byte from ever being a '\n'
+
+
+class EmulatedServo:
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.servoName = ""
+        self.assigned = False
+        self.attached = False
+        self.verbose = False
+        self.autoDetach = 0.0
+        self.minPos = 0
+        self.maxPos = 180
+        self.position = 90.0
+        self.moving = False
+        self.moveFrom = 90
+        self.target = 90
+        self.moveStart = 0.0
+        self.moveDuration = 0.0
+        self.lastMoveEnd = 0.0
+        self.reportedPosition = -1
+        self.feedback = False
+        self.kp = 1.0
+        self.servoWrite = 90.0
+
+
+class ArduinoEmulator:
+
+    def __init__(self, arduinoIndex, tickInterval=0.02, greetingInterval=0.5, onCommand=None,
+                 protocolVersion=arduinoProtocol.PROTOCOL_ASCII, ackCredits=0, configCommandTime=0.01):
+        """
+        :param arduinoIndex: 0 emulates the S0 (left) board, 1 the S1 (right) board
+        :param tickInterval: simulation step and status report interval in seconds
+        :param greetingInterval: the greeting is repeated until the first command arrives
+                                 as the host flushes its input after opening the port
+        :param onCommand: optional callback(arduinoIndex, fields, receiveTime) for benchmarks
+        :param protocolVersion: announced in the greeting, PROTOCOL_BINARY accepts binary command frames
+        :param ackCredits: announced in the greeting, > 0 acknowledges configuration commands
+        :param configCommandTime: processing time of a configuration command (assign, feedback definitions)
+        """
+        self.arduinoIndex = arduinoIndex
+        self.tickInterval = tickInterval
+        self.greetingInterval = greetingInterval
+        self.onCommand = onCommand
+        self.protocolVersion = protocolVersion
+        self.ackCredits = ackCredits
+        self.configCommandTime = configCommandTime
+
+        self.masterFd, self.slaveFd = os.openpty()
+        tty.setraw(self.slaveFd)
+        self.portName = os.ttyname(self.slaveFd)
+
+        self.servos = {}
+        self.commandsReceived = 0
+        self.framesSent = 0
+        self.running = False
+        self.greeted = False
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock()
+
+
+    def start(self):
+        self.running = True
+        for target, name in ((self._readCommands, "read"), (self._simulate, "simulate")):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.name = f"emulatorS{self.arduinoIndex}_{name}"
+            thread.start()
+
+
+    def stop(self):
+        self.running = False
+
+
+    def _write(self, data):
+        with self.writeLock:
+            os.write(self.masterFd, data)
+
+
+    def _sendText(self, text):
+        self._write(bytes(f"{text}\r\n", 'ascii'))
+
+
+    def _sendAck(self):
+        if self.ackCredits > 0:
+            self._sendText(f"S{self.arduinoIndex} {arduinoProtocol.ACK_TEXT}")
+
+
+    def _servo(self, pin):
+        if pin not in self.servos:
+            self.servos[pin] = EmulatedServo(pin)
+        return self.servos[pin]
+
+
+    def _readCommands(self):
+        pending = bytearray()
+        while self.running:
+            ready, _, _ = select.select([self.masterFd], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.masterFd, 1024)
+            except OSError:
+                time.sleep(0.1)     # no process has the port open
+                continue
+            receiveTime = time.monotonic()
+            pending += data
+            while len(pending) > 0:
+                if pending[0] in arduinoProtocol.frameSizes:
+                    size = arduinoProtocol.frameSizes[pending[0]]
+                    if len(pending) < size:
+                        break
+                    fields = arduinoProtocol.decode(bytes(pending[:size]))
+                    del pending[:size]
+                    line = ",".join(fields)
+                else:
+                    end = pending.find(b'\n')
+                    if end < 0:
+                        break
+                    line = bytes(pending[:end]).decode('ascii', 'replace').strip()
+                    del pending[:end + 1]
+                    fields = [f for f in line.split(',') if f != '']
+                self.greeted = True
+                if len(fields) > 0:
+                    self._handleCommand(line, fields, receiveTime)
+
+
+    def _handleCommand(self, line, fields, receiveTime):
+        self.commandsReceived += 1
+        if self.onCommand is not None:
+            self.onCommand(self.arduinoIndex, fields, receiveTime)
+
+        try:
+            cmd = fields[0]
+            with self.lock:
+                if cmd == '0':      # assign: name, pin, minPos, maxPos, restPos, autoDetach, inverted, lastPos, powerPin
+                    servo = self._servo(int(fields[2]))
+                    servo.servoName = fields[1]
+                    servo.minPos = int(fields[3])
+                    servo.maxPos = int(fields[4])
+                    servo.autoDetach = float(fields[5])
+                    servo.position = float(fields[8])
+                    servo.target = int(fields[8])
+                    servo.assigned = True
+                    time.sleep(self.configCommandTime)
+                    self._sendStatus(servo)
+                    self._sendAck()
+
+                elif cmd == '1':    # move: pin, position, duration
+                    servo = self._servo(int(fields[1]))
+                    servo.moveFrom = servo.position
+                    servo.target = min(max(int(fields[2]), servo.minPos), servo.maxPos)
+                    servo.moveDuration = max(int(fields[3]), 1) / 1000
+                    servo.moveStart = time.monotonic()
+                    servo.moving = True
+                    servo.attached = True
+
+                elif cmd == '2':    # stop: pin
+                    servo = self._servo(int(fields[1]))
+                    self._stopServo(servo)
+
+                elif cmd == '3':    # stop all
+                    for servo in self.servos.values():
+                        self._stopServo(servo)
+
+                elif cmd == '4':    # status request: pin
+                    self._sendStatus(self._servo(int(fields[1])))
+
+                elif cmd == '5':    # auto detach: pin, milliseconds
+                    self._servo(int(fields[1])).autoDetach = float(fields[2]) / 1000
+
+                elif cmd == '6':    # set position without move: pin, position
+                    servo = self._servo(int(fields[1]))
+                    servo.position = float(fields[2])
+                    servo.target = int(fields[2])
+                    self._sendStatus(servo)
+
+                elif cmd == '7':    # verbose: pin, state
+                    servo = self._servo(int(fields[1]))
+                    servo.verbose = fields[2] == '1'
+                    self._sendStatus(servo)
+
+                elif cmd == '8':    # feedback definitions: pin, mux address, channel, offset, inverted, degPerPos, kp, ki, kd
+                    servo = self._servo(int(fields[1]))
+                    servo.feedback = True
+                    servo.kp = float(fields[7])
+                    time.sleep(self.configCommandTime)
+                    self._sendText(f"S{self.arduinoIndex} feedback servo defined, pin {servo.pin}")
+                    self._sendAck()
+
+                elif cmd in ('h', 'l'):     # power pins high/low
+                    pass
+
+                else:
+                    self._sendText(f"S{self.arduinoIndex} unknown command {line}")
+
+        except (IndexError, ValueError):
+            self._sendText(f"S{self.arduinoIndex} invalid command {line}")
+
+
+    def _stopServo(self, servo):
+        if servo.moving:
+            servo.moving = False
+            servo.target = int(round(servo.position))
+            servo.lastMoveEnd = time.monotonic()
+            self._sendStatus(servo)
+
+
+    def _flags(self, servo, targetReached=False):
+        flags = FLAG_FILLER
+        if servo.assigned: flags |= FLAG_ASSIGNED
+        if servo.moving: flags |= FLAG_MOVING
+        if servo.attached: flags |= FLAG_ATTACHED
+        if servo.autoDetach > 0: flags |= FLAG_AUTO_DETACH
+        if servo.verbose: flags |= FLAG_VERBOSE
+        if targetReached: flags |= FLAG_TARGET_REACHED
+        return flags
+
+
+    def _sendStatus(self, servo, targetReached=False, planned=None):
+        position = int(round(servo.position))
+        frame = bytearray([0xC0 | (servo.pin & 0x3f), self._flags(servo, targetReached), position + 0x10])
+        if servo.feedback:
+            ms = int((time.monotonic() - servo.moveStart) * 1000) if servo.moving or targetReached else 0
+            if (ms + 4096 + 16) & 0xff == 0x0a:
+                ms += 1     # the low byte must not look like a line end
+            encodedMs = ms + 4096 + 16
+            plannedPosition = position if planned is None else int(round(planned))
+            frame += bytes([(encodedMs >> 8) & 0xff, encodedMs & 0xff,
+                            int(round(servo.servoWrite)) + 0x10, plannedPosition + 0x10])
+        frame += b'\n'
+        self._write(bytes(frame))
+        servo.reportedPosition = position
+        self.framesSent += 1
+
+
+    def _simulate(self):
+        nextGreeting = 0.0
+        while self.running:
+            now = time.monotonic()
+
+            if not self.greeted and now > nextGreeting:
+                protocol = f" P{self.protocolVersion}" if self.protocolVersion > arduinoProtocol.PROTOCOL_ASCII else ""
+                if self.ackCredits > 0:
+                    protocol += f" A{self.ackCredits}"
+                self._sendText(f"S{self.arduinoIndex} emulated skeleton arduino{protocol}")
+                nextGreeting = now + self.greetingInterval
+
+            with self.lock:
+                for servo in self.servos.values():
+
+                    if servo.moving:
+                        progress = min((now - servo.moveStart) / servo.moveDuration, 1.0)
+                        planned = servo.moveFrom + (servo.target - servo.moveFrom) * progress
+                        if servo.feedback:
+                            # feedback servos lag behind the planned position, the controller compensates
+                            servoWrite = planned + servo.kp * (planned - servo.position)
+                            servo.servoWrite = min(max(servoWrite, servo.minPos), servo.maxPos)
+                            servo.position += (servo.servoWrite - servo.position) * 0.3
+                        else:
+                            servo.position = planned
+
+                        if progress >= 1.0:
+                            servo.position = float(servo.target)
+                            servo.moving = False
+                            servo.lastMoveEnd = now
+                            self._sendStatus(servo, targetReached=True, planned=planned)
+                        elif servo.feedback or int(round(servo.position)) != servo.reportedPosition:
+                            self._sendStatus(servo, planned=planned)
+
+                    elif servo.attached and 0 < servo.autoDetach < now - servo.lastMoveEnd:
+                        servo.attached = False
+                        self._sendStatus(servo)
+
+            time.sleep(self.tickInterval)
+
+
+def startEmulators(numArduinos=2, **kwargs):
+    """
+    create and start one emulator per skeleton arduino
+    :return: list of emulators, emulator.portName is the port to connect with
+    """
+    emulators = [ArduinoEmulator(arduinoIndex, **kwargs) for arduinoIndex in range(numArduinos)]
+    for emulator in emulators:
+        emulator.start()
+    return emulators
+
+
+if __name__ == "__main__":
+
+    emulators = startEmulators()
+    for emulator in emulators:
+        print(f"S{emulator.arduinoIndex} emulated on {emulator.portName}")
+    while True:
+        time.sleep(5)
+        print(", ".join(f"S{e.arduinoIndex}: commands {e.commandsReceived}, frames {e.framesSent}" for e in emulators))
@@ -0,0 +1,100 @@
+
+# binary command frames for the frequent commands (move, stop, status, jaw)
+#
+# an arduino announces support with a protocol token in its greeting, e.g. "S0 skeleton P1"
+# arduinos without the token get the ascii commands only.
+# an arduino that acknowledges its configuration commands (assign, feedback definitions) announces
+# the number of commands it can buffer with an ack token, e.g. "S0 skeleton P1 A4", and answers
+# every configuration command with the text line "S0 ack" when it has room for the next one.
+# binary frames have a fixed size and start with a byte >= 0xE0, so they can not be mistaken
+# for the start of an ascii command and need no line end
+import struct
+
+PROTOCOL_ASCII = 0
+PROTOCOL_BINARY = 1
+
+ACK_TEXT = "ack"
+
+CMD_MOVE = 0xE1         # pin, position, duration ms (16 bit)
+CMD_STOP = 0xE2         # pin
+CMD_STATUS = 0xE4       # pin
+CMD_JAW = 0xE9          # pin, position, duration in 10 ms units (8 bit)
+
+frameStructs = {
+    CMD_MOVE: struct.Struct('>BBBH'),
+    CMD_STOP: struct.Struct('>BB'),
+    CMD_STATUS: struct.Struct('>BB'),
+    CMD_JAW: struct.Struct('>BBBB'),
+}
+frameSizes = {cmd: frameStruct.size for cmd, frameStruct in frameStructs.items()}
+
+
+def parseGreeting(greeting):
+    """
+    :param greeting: first line received from the arduino, e.g. "S0 skeleton P1"
+    :return: protocol version announced by the arduino, PROTOCOL_ASCII if none
+    """
+    for token in greeting.split()[1:]:
+        if token[0] == 'P' and token[1:].isdigit():
+            return int(token[1:])
+    return PROTOCOL_ASCII
+
+
+def parseAckCredits(greeting):
+    """
+    :return: configuration commands the arduino can buffer, 0 for firmware without acks
+    """
+    for token in greeting.split()[1:]:
+        if token[0] == 'A' and token[1:].isdigit():
+            return int(token[1:])
+    return 0
+
+
+def isAck(text):
+    fields = text.split()
+    return len(fields) == 2 and fields[1] == ACK_TEXT
+
+
+# command tuples are created by the requesting thread and encoded by the writer thread
+# values are rounded like the ascii commands (format '.0f'), so both protocols send the same move
+def moveCommand(pin, position, duration):
+    return CMD_MOVE, int(pin), round(position), min(round(duration), 0xffff)
+
+def stopCommand(pin):
+    return CMD_STOP, int(pin)
+
+def statusCommand(pin):
+    return CMD_STATUS, int(pin)
+
+def jawCommand(pin, position, duration):
+    if duration > 0xff * 10:
+        return moveCommand(pin, position, duration)
+    return CMD_JAW, int(pin), round(position), round(duration / 10)
+
+
+def commandSize(command):
+    return frameSizes[command[0]]
+
+
+def encodeInto(buffer, offset, command):
+    """
+    pack the command into the preallocated buffer
+    :return: number of bytes written
+    """
+    frameStruct = frameStructs[command[0]]
+    frameStruct.pack_into(buffer, offset, *command)
+    return frameStruct.size
+
+
+def decode(frame):
+    """
+    decode a binary frame into the fields of the equivalent ascii command (used by the emulator)
+    """
+    values = frameStructs[frame[0]].unpack(frame)
+    if values[0] == CMD_MOVE:
+        return ['1', str(values[1]), str(values[2]), str(values[3])]
+    if values[0] == CMD_STOP:
+        return ['2', str(values[1])]
+    if values[0] == CMD_STATUS:
+        return ['4', str(values[1])]
+    return ['1', str(values[1]), str(values[2]), str(values[3] * 10)]
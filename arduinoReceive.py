@@ -2,14 +2,20 @@
 import os
 import sys
 import time
+import select
 
 import config
 from marvinglobal import marvinglobal as mg
 from marvinglobal import skeletonClasses
 
 import arduinoSend
-import feedbackServo
 import skeletonControl
+import serialFrameParser
+import arduinoProtocol
+import servoLookup
+import requestTracing
+
+parsers = {}        # FrameParser by arduinoIndex, holds the receive and parse error counters
 
 
 #####################################
@@ -23,8 +29,10 @@ def readMessages(arduinoIndex):
            'info': {'arduinoIndex': arduinoIndex, 'data': config.arduinoDictLocal[arduinoIndex]}}
     config.updateSharedDict(msg)
 
-    # init prevSent
-    prevSent = skeletonClasses.ServoCurrent()
+    parser = serialFrameParser.FrameParser()
+    parsers[arduinoIndex] = parser
+    readBuffer = bytearray(4096)
+    readView = memoryview(readBuffer)
 
     while True:
         if config.arduinoConn[arduinoIndex] is None:
@@ -32,147 +40,181 @@ def readMessages(arduinoIndex):
             continue
 
         conn = config.arduinoConn[arduinoIndex]
+        fd = conn.fileno()
 
         while conn.is_open:
-            bytesAvailable = 0
+            # wait for data, the timeout only allows to detect a closed connection
             try:
-                bytesAvailable = conn.in_waiting
+                ready, _, _ = select.select([fd], [], [], 1.0)
+                if len(ready) == 0:
+                    continue
+                # read all available bytes at once into the reusable buffer
+                numBytes = os.readv(fd, [readBuffer])
             except Exception as e:
-                config.log(f"exception in arduino: Is 6V power on?")
-                os._exit(2)
+                config.log(f"exception in arduino: Is 6V power on? {e}")
+                config.exitProcess(2)
 
-            #config.log(f"waiting for arduino message {arduino}, {bytesAvailable=}")
-            if bytesAvailable == 0:
-                time.sleep(0.1)
-                continue
-            else:
+            if numBytes == 0:   # readable but no data, device disconnected
+                config.log(f"exception in arduino: Is 6V power on?")
+                config.exitProcess(2)
 
-                recvB = conn.readline()
+            for recvB in parser.feed(readView[:numBytes]):
 
                 # check for existing shared data connection
                 if config.marvinShares is None:
                     continue
 
-                try:
-                    # special case status messages, as these can be very frequently
-                    # a compressed format is used
-                    if (recvB[0] & 0xC0) == 0xC0:     # marker for compressed servo status message
-                        # config.log(f"status msg: {len(recvB)=}, {recvB[0]:#04x},{recvB[1]:#b},{recvB[2]:#04x}")
-                        # extract data from binary message
-                        pin = recvB[0] & 0x3f               # mask out marker bits
-                        newAssigned = recvB[1] & 0x01 > 0
-                        newMoving = recvB[1] & 0x02 > 0
-                        newAttached = recvB[1] & 0x04 > 0
-                        newAutoDetach = recvB[1] & 0x08 > 0
-                        newServoVerbose = recvB[1] & 0x10 > 0
-                        newTargetReached = recvB[1] & 0x20 > 0  # sent only once when target reached
-                        currentPosition = int(recvB[2] - 0x10)  # to prevent value seen as lf 16 is added by the arduino
-                        servoWritePosition = currentPosition
-                        plannedPosition = currentPosition
-                        ms = 0      # non-feedback servos do not report millis
-                        isFeedbackStatus = False
-                        if len(recvB) > 4:      # feedback servo message
-                            isFeedbackStatus = True
-                            ms = (recvB[3] << 8) + recvB[4] - 4096 - 16
-                            servoWritePosition = (recvB[5] - 0x10)
-                            plannedPosition = (recvB[6] - 0x10)
-                            config.log(f"feedback pos: {currentPosition=}, {ms=},{servoWritePosition=},{plannedPosition=}")
-                        servoUniqueId = (arduinoIndex * 100) + pin
-                        servoName = config.servoNameByArduinoAndPin[servoUniqueId]
-
-                        if newServoVerbose:
-                            config.log(f"servo update {servoName}, {recvB[0]:#04x},{recvB[1]:#04x},{recvB[2]:#04x}, arduino: {arduinoIndex},"
-                                       f" pin: {pin:2}, pos {currentPosition:3}, assigned: {newAssigned}, moving {newMoving},"
-                                       f" attached {newAttached}, autoDetach: {newAutoDetach}, verbose: {newServoVerbose}")
-
-                        prevCurrent = config.servoCurrentDictLocal.get(servoName)
-                        servoStatic = config.servoStaticDictLocal.get(servoName)
-                        servoDerived: skeletonClasses.ServoDerived = config.servoDerivedDictLocal.get(servoName)
-
-                        servoCurrentLocal = config.servoCurrentDictLocal[servoName]
-                        servoCurrentLocal.assigned = newAssigned
-                        servoCurrentLocal.moving = newMoving
-                        servoCurrentLocal.attached = newAttached
-                        servoCurrentLocal.autoDetach = newAutoDetach
-                        servoCurrentLocal.verbose = newServoVerbose
-                        servoCurrentLocal.millisAfterMoveStart = ms
-                        servoCurrentLocal.currentPosition = currentPosition
-                        servoCurrentLocal.currentDegrees = mg.evalDegFromPos(servoStatic, servoDerived, currentPosition)
-                        servoCurrentLocal.servoWritePosition = servoWritePosition
-                        servoCurrentLocal.plannedPosition = plannedPosition
-                        servoCurrentLocal.swiping = prevCurrent.swiping
-                        servoCurrentLocal.timeOfLastMoveRequest = prevCurrent.timeOfLastMoveRequest
-
-                        # limit updates to the shared copy and the persisted position
-                        # do not update for high frequency servo (jaw)
-                        # only update when position has changed
-                        # only update max 5 times per second
-                        if servoCurrentLocal.currentPosition != prevSent.currentPosition:
-                            if time.time() - prevSent.timeOfLastShareUpdate > 0.2:
-                                servoCurrentLocal.timeOfLastShareUpdate = time.time()
-                                config.updateSharedServoCurrent(servoName, servoCurrentLocal)
-                                prevSent = servoCurrentLocal
-
-                                if servoName != "head.jaw":
-                                    skeletonControl.markServoPositionAsChanged(servoName, currentPosition)
-
-
-                        # check for feedback servo
-                        # if servo is moving add positions to the move log
-                        if isFeedbackStatus and servoCurrentLocal.moving:
-                            feedbackServo.addPosition(servoName, ms, currentPosition, servoWritePosition, plannedPosition)
-                            config.log(f"feedbackServo: {servoName=}, {ms=}, {servoWritePosition=}, {currentPosition=}")
-
-                         # update ik if running
-                        if "stickFigure" in config.marvinShares.processDict.keys():
-                            if currentPosition != prevCurrent.currentPosition:
-                                config.marvinShares.ikUpdateQueue.put({'msgType': 'update'})
-                            #config.log(f"update sent to stickFigure")
-
-                        # check for move target postition reached
-                        if newTargetReached:
-
-                            servoCurrentLocal.timeOfLastShareUpdate = time.time()
-                            config.updateSharedServoCurrent(servoName, servoCurrentLocal)
-                            prevSent = servoCurrentLocal
-
-                            # do not log high movmement frequency servos
-                            if servoName != 'head.jaw':
-                                config.log(f"target reached: {servoName=}, {currentPosition=}, currentDegrees={servoCurrentLocal.currentDegrees}")
-                                skeletonControl.markServoPositionAsChanged(servoName, currentPosition)
-
-                            config.moveRequestBuffer.setServoInactive(servoName)
-
-                            # check for feedback servo
-                            if servoName in config.servoFeedbackDictLocal:
-                                config.log(f"targetReached, feedbackPositions: {len(config.feedbackPositions[servoName]['values'])}")
-                                if len(config.feedbackPositions[servoName]['values']) > 5:
-                                    feedbackServo.dumpPositionList(servoName)
-
-                            # handle special case in swipe mode
-                            #config.log(f"{servoName}: not moving and attached, swiping: {prevCurrentDict.swiping}")
-                            if prevCurrent.swiping:
-                                nextPos = 0
-                                if abs(currentPosition - servoStatic.minPos) < 3:
-                                    nextPos = servoStatic.maxPos
-                                if abs(currentPosition - servoStatic.maxPos) < 3:
-                                    nextPos = servoStatic.minPos
-                                swipeMoveDuration = servoDerived.posRange * servoDerived.msPerPos * 4
-                                arduinoSend.requestServoPosition(servoName, nextPos, swipeMoveDuration)
-
-                        continue
-
-                except Exception as e:
-                    config.log(f"serial message, unexpected format: {recvB}, ignored, {e=}")
-                    continue
-
-                # now process all other messages starting with first byte < 0xC0
-                try:
-                    recv = recvB.decode()
-                except:
-                    config.log(f"problem with decoding arduino msg '{recvB}'")
-                    continue
-
-                # config.log(f"line read {recv}")
-                # msgID = recvB[0:3].decode()
-                config.log(f"<-I{arduinoIndex} " + recv[:-1], publish=False)
+                if (recvB[0] & 0xC0) == 0xC0:     # marker for compressed servo status message
+                    try:
+                        processStatusMessage(arduinoIndex, recvB)
+                    except Exception as e:
+                        parser.countError('statusMessage')
+                        config.log(f"serial message, unexpected format: {recvB}, ignored, {e=}")
+                else:
+                    processTextMessage(arduinoIndex, recvB)
+
+
+def getReceiveStats():
+    return {arduinoIndex: parser.stats() for arduinoIndex, parser in parsers.items()}
+
+
+def collectMetrics():
+    """
+    receive counters of the parsers for the metricsExporter, each parser is written by its read thread only
+    """
+    metrics = []
+    for arduinoIndex, parser in parsers.items():
+        board = (str(arduinoIndex),)
+        metrics.append(('skeleton_serial_bytes_received_total', board, parser.bytesReceived))
+        metrics.append(('skeleton_serial_frames_received_total', board + ('status',), parser.statusFrames))
+        metrics.append(('skeleton_serial_frames_received_total', board + ('text',), parser.textLines))
+        for reason, count in dict(parser.errorCounts).items():
+            metrics.append(('skeleton_serial_decode_errors_total', board + (reason,), count))
+    return metrics
+
+
+def processStatusMessage(arduinoIndex, recvB):
+    """
+    special case status messages, as these can be very frequently
+    a compressed format is used
+    """
+    # config.log(f"status msg: {len(recvB)=}, {recvB[0]:#04x},{recvB[1]:#b},{recvB[2]:#04x}")
+    # extract data from binary message, flags and servo through the precomputed tables
+    pin = recvB[0] & 0x3f               # mask out marker bits
+    newAssigned, newMoving, newAttached, newAutoDetach, newServoVerbose, newTargetReached = servoLookup.statusFlags[recvB[1]]
+    currentPosition = int(recvB[2] - 0x10)  # to prevent value seen as lf 16 is added by the arduino
+    servoWritePosition = currentPosition
+    plannedPosition = currentPosition
+    ms = 0      # non-feedback servos do not report millis
+    isFeedbackStatus = False
+    if len(recvB) > 4:      # feedback servo message
+        isFeedbackStatus = True
+        ms = (recvB[3] << 8) + recvB[4] - 4096 - 16
+        servoWritePosition = (recvB[5] - 0x10)
+        plannedPosition = (recvB[6] - 0x10)
+    servoEntry = config.servoByArduinoPin[arduinoIndex][pin]
+    if servoEntry is None:
+        parsers[arduinoIndex].countError('unknownServo')
+        config.log(f"status message for unknown servo, arduino: {arduinoIndex}, pin: {pin}")
+        return
+    servoName, servoCurrentLocal, servoStatic, servoDerived, posToDeg = servoEntry
+    config.metricsExporter.counters().inc('skeleton_servo_status_frames_total', (servoName,))
+
+    if newServoVerbose:
+        config.log("servo update %s, %#04x,%#04x,%#04x, arduino: %d, pin: %2d, pos %3d, assigned: %s, moving %s,"
+                   " attached %s, autoDetach: %s, verbose: %s",
+                   servoName, recvB[0], recvB[1], recvB[2], arduinoIndex, pin, currentPosition,
+                   newAssigned, newMoving, newAttached, newAutoDetach, newServoVerbose, category='serial')
+
+    previousPosition = servoCurrentLocal.currentPosition
+
+    servoCurrentLocal.assigned = newAssigned
+    servoCurrentLocal.moving = newMoving
+    servoCurrentLocal.attached = newAttached
+    servoCurrentLocal.autoDetach = newAutoDetach
+    servoCurrentLocal.verbose = newServoVerbose
+    servoCurrentLocal.millisAfterMoveStart = ms
+    servoCurrentLocal.currentPosition = currentPosition
+    if currentPosition >= 0:
+        servoCurrentLocal.currentDegrees = posToDeg[currentPosition]
+    else:
+        servoCurrentLocal.currentDegrees = mg.evalDegFromPos(servoStatic, servoDerived, currentPosition)
+    servoCurrentLocal.servoWritePosition = servoWritePosition
+    servoCurrentLocal.plannedPosition = plannedPosition
+
+    # the sharedStatePublisher sends the changed servo state at a limited rate,
+    # readers of the shared memory state see the update immediately
+    config.updateSharedServoCurrent(servoName, servoCurrentLocal)
+    config.sharedServoState.update(servoName, servoCurrentLocal, recvB[1])
+    if newMoving:
+        config.requestTracer.mark(servoName, requestTracing.MOVING)
+
+    # update the persisted position only when position has changed
+    # do not update for high frequency servo (jaw)
+    if currentPosition != previousPosition and servoName != "head.jaw":
+        skeletonControl.markServoPositionAsChanged(servoName, currentPosition)
+
+
+    # check for feedback servo
+    # if servo is moving add positions to the move log
+    if isFeedbackStatus and servoCurrentLocal.moving:
+        config.feedbackRecorder.addSample(servoName, ms, currentPosition, servoWritePosition, plannedPosition)
+        config.log("feedbackServo: %s, ms=%d, servoWritePosition=%d, currentPosition=%d, plannedPosition=%d",
+                   servoName, ms, servoWritePosition, currentPosition, plannedPosition, category='feedback')
+
+     # update ik if running
+    if "stickFigure" in config.marvinShares.processDict.keys():
+        if currentPosition != previousPosition:
+            config.marvinShares.ikUpdateQueue.put({'msgType': 'update'})
+        #config.log(f"update sent to stickFigure")
+
+    # check for move target postition reached
+    if newTargetReached:
+
+        config.updateSharedServoCurrent(servoName, servoCurrentLocal, flush=True)
+
+        # do not log high movmement frequency servos
+        if servoName != 'head.jaw':
+            config.log("target reached: servoName=%s, currentPosition=%s, currentDegrees=%s",
+                       servoName, currentPosition, servoCurrentLocal.currentDegrees, category='serial')
+            skeletonControl.markServoPositionAsChanged(servoName, currentPosition)
+
+        config.moveRequestBuffer.setServoInactive(servoName)
+        config.poseTracker.targetReached(servoName)
+        config.requestTracer.reached(servoName)
+
+        # check for feedback servo
+        if servoName in config.servoFeedbackDictLocal:
+            config.log("targetReached, feedback samples: %d", config.feedbackRecorder.sampleCount(servoName), category='feedback')
+            config.feedbackRecorder.finishMove(servoName)
+
+        # handle special case in swipe mode
+        #config.log(f"{servoName}: not moving and attached, swiping: {prevCurrentDict.swiping}")
+        if servoCurrentLocal.swiping:
+            nextPos = 0
+            if abs(currentPosition - servoStatic.minPos) < 3:
+                nextPos = servoStatic.maxPos
+            if abs(currentPosition - servoStatic.maxPos) < 3:
+                nextPos = servoStatic.minPos
+            swipeMoveDuration = servoDerived.posRange * servoDerived.msPerPos * 4
+            arduinoSend.requestServoPosition(servoName, nextPos, swipeMoveDuration)
+
+
+def processTextMessage(arduinoIndex, recvB):
+    # now process all other messages starting with first byte < 0xC0
+    try:
+        recv = recvB.decode()
+    except:
+        parsers[arduinoIndex].countError('textDecode')
+        config.log(f"problem with decoding arduino msg '{recvB}'")
+        return
+
+    # config.log(f"line read {recv}")
+    # msgID = recvB[0:3].decode()
+    config.log("<-I%d %s", arduinoIndex, recv[:-1], publish=False, category='serial')
+
+    # the arduino has room for the next configuration command
+    if arduinoProtocol.isAck(recv):
+        if config.ackCredits[arduinoIndex] is not None:
+            config.ackCredits[arduinoIndex].release()
+        return
@@ -6,28 +6,47 @@ from marvinglobal import skeletonClasses
 from marvinglobal import marvinglobal as mg
 
 import feedbackServo
+import arduinoProtocol
+import servoLookup
 
-lastSerialSend = [0.0, 0,0]
-
-
-def sendArduinoCommand(arduinoIndex, msg):
-    global lastSerialSend
+def sendArduinoCommand(arduinoIndex, msg, command=None, servoName=None, urgent=False):
+    """
+    queue the command for the writer thread of the arduino, pacing is done by the writer
+    :param command: binary form of msg, used instead of msg if the arduino supports binary commands
+    :param servoName: servo of a move command, for the request tracing
+    :param urgent: stop commands, written ahead of queued commands and scheduled batches
+    """
     if msg[-1] != "\n":
         msg += "\n"
-    conn = config.arduinoConn[arduinoIndex]
-    if conn is not None:
-        #config.log(f"send msg to arduino {arduinoIndex}: {msg}")
-        # do not overload the arduino with too many requests
-        while time.time() - lastSerialSend[arduinoIndex] < 0.05:
-            time.sleep(0.01)
-        conn.write(bytes(msg, 'ascii'))
-        conn.flush()
-        if msg != '1,24': config.log(f"msg to arduino {arduinoIndex}: {bytes(msg, 'ascii')}")   # do not log jaw
-        lastSerialSend[arduinoIndex] = time.time()
+    writer = config.arduinoWriters[arduinoIndex]
+    if writer is not None:
+        writer.put(msg, command, servoName, urgent)
     else:
         config.log(f"no connection with arduino {arduinoIndex}")
 
 
+def getWriterStats():
+    return [writer.stats() for writer in config.arduinoWriters if writer is not None]
+
+
+def collectWriterMetrics():
+    return [metric for writer in config.arduinoWriters if writer is not None for metric in writer.metrics()]
+
+
+def sendConfigCommand(arduinoIndex, msg):
+    """
+    configuration commands are sent as soon as the arduino acknowledges it has room for them,
+    arduinos without acks get a fixed pause after each command
+    """
+    ackCredits = config.ackCredits[arduinoIndex]
+    if ackCredits is None:
+        sendArduinoCommand(arduinoIndex, msg)
+        time.sleep(config.configCommandDelay)     # add delay as arduino gets overwhelmed otherwise
+        return
+    ackCredits.acquire()
+    config.arduinoWriters[arduinoIndex].putConfig(msg)
+
+
 def servoAssign(servoName, lastPos):
 
     servoStatic = config.servoStaticDictLocal.get(servoName)
@@ -45,7 +64,7 @@ def servoAssign(servoName, lastPos):
     restPos = mg.evalPosFromDeg(servoStatic, servoDerived, servoStatic.restDeg)
     msg = f"0,{servoName},{servoStatic.pin},{servoStatic.minPos},{servoStatic.maxPos},{restPos},{servoStatic.autoDetach:.1f},{inverted},{lastPos},{servoStatic.powerPin},\n"
 
-    sendArduinoCommand(servoStatic.arduinoIndex, msg)
+    sendConfigCommand(servoStatic.arduinoIndex, msg)
 
     config.log(f"assign servo: {servoName:<20}, \
 pin: {servoStatic.pin:2}, minPos: {servoStatic.minPos:3}, maxPos:{servoStatic.maxPos:3}, \
@@ -58,21 +77,22 @@ def servoFeedbackDefinitions(arduinoIndex, pin, servoFeedback):
     msg += f"{servoFeedback.degPerPos},"
     msg += f"{servoFeedback.kp},{servoFeedback.ki},{servoFeedback.kd},\n"
 
-    sendArduinoCommand(arduinoIndex, msg)
+    sendConfigCommand(arduinoIndex, msg)
 
     config.log(f"feedback definitions sent: {servoFeedback}")
 
-def requestServoPosition(servoName, newPosition, duration, sequential=True):
+def prepareMoveRequest(servoName, newPosition, duration):
     """
-    move servo in <duration> seconds from current position to <position>
+    verify the move of the servo to <newPosition> in <duration> ms and create the arduino command
     filter fast passed in requests
+    :return: move request as used by the moveRequestBuffer, None if the move is not to be executed
     """
     # command 1,<arduino>,<servo>,<position>,<duration>
     # e.g. servo=eyeX, position=50, duration=2500: 2,3,50,2500
     servoStatic = config.servoStaticDictLocal.get(servoName)
     if not servoStatic.enabled:
         config.log(f"servoPos {newPosition} requested but {servoName} is disabled")
-        return
+        return None
 
     servoDerived = config.servoDerivedDictLocal.get(servoName)
     servoCurrent = config.servoCurrentDictLocal.get(servoName)
@@ -88,47 +108,148 @@ def requestServoPosition(servoName, newPosition, duration, sequential=True):
     else:
         deltaPos = abs(servoCurrent.currentPosition - newPosition)
         minDuration = servoDerived.msPerPos * deltaPos
-        config.log(f"request servo position for {servoName}, arduino {servoStatic.arduinoIndex}, degrees: {degrees}, position: {newPosition:.0f}, duration: {duration:.0f}", publish=False)
+        config.log(f"request servo position for {servoName}, arduino {servoStatic.arduinoIndex}, degrees: {degrees}, position: {newPosition:.0f}, duration: {duration:.0f}", publish=False, category='requests')
 
     if abs(deltaPos) < 2:
         config.log(f"{servoName} moveRequest for minimal move, from {servoCurrent.currentPosition} to {newPosition}, ignore")
-        return
+        return None
 
     # verify duration
     if duration < minDuration:
-        config.log(f"move duration increased {servoName}, deltaPos: {deltaPos:.0f}, msPerPos: {servoDerived.msPerPos:.1f}, from: {duration:.0f} to: {minDuration:.0f}")
+        config.log(f"move duration increased {servoName}, deltaPos: {deltaPos:.0f}, msPerPos: {servoDerived.msPerPos:.1f}, from: {duration:.0f} to: {minDuration:.0f}", category='requests')
         duration = minDuration
     if duration > 99999:
         config.log(f"excessive duration {duration} ms, limit to 9999 ms")
         duration = 9999
     speedRate = int(100*minDuration/duration)/100    # >0..1
-    config.log(f"speedRate {duration=:.0f} ms / {minDuration=:.0f} ms = {speedRate:.02f}")
+    config.log("speedRate duration=%.0f ms / minDuration=%.0f ms = %.02f", duration, minDuration, speedRate, category='requests')
+
+    return buildMoveRequest(servoName, servoStatic, servoCurrent.currentPosition, newPosition, duration, speedRate)
 
+
+def buildMoveRequest(servoName, servoStatic, fromPos, newPosition, duration, speedRate):
     msg = f"1,{servoStatic.pin:02.0f},{newPosition:03.0f},{duration:04.0f},\n"
+    if servoName == "head.jaw":
+        command = arduinoProtocol.jawCommand(servoStatic.pin, newPosition, duration)
+    else:
+        command = arduinoProtocol.moveCommand(servoStatic.pin, newPosition, duration)
+
+    return {'servoName': servoName,
+            'arduino': servoStatic.arduinoIndex,
+            'msg': msg,
+            'command': command,
+            'fromPos': fromPos,
+            'toPos': newPosition,
+            'speedRate': speedRate,
+            'duration': duration
+            }
+
+
+def targetPositions(targets, unit='degrees'):
+    """
+    validate the targets of a pose or gesture keyframe, targets of disabled servos are left out
+    :param targets: servoName -> degrees or position
+    :param unit: 'degrees' or 'position'
+    :return: (list of (servoName, servoStatic, position), problems)
+    """
+    problems = []
+    positions = []
+    disabled = []
+    for servoName, value in targets.items():
+        servoStatic = config.servoStaticDictLocal.get(servoName)
+        if servoStatic is None:
+            problems.append(f"{servoName}: unknown servo")
+            continue
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            problems.append(f"{servoName}: invalid target {value!r}")
+            continue
+        if not servoStatic.enabled:
+            disabled.append(servoName)
+            continue
+        if unit == 'degrees':
+            if not min(servoStatic.minDeg, servoStatic.maxDeg) <= value <= max(servoStatic.minDeg, servoStatic.maxDeg):
+                problems.append(f"{servoName}: {value} degrees out of range {servoStatic.minDeg}..{servoStatic.maxDeg}")
+                continue
+            position = servoLookup.posFromDeg(servoName, value)
+        else:
+            position = value
+        if not min(servoStatic.minPos, servoStatic.maxPos) <= position <= max(servoStatic.minPos, servoStatic.maxPos):
+            problems.append(f"{servoName}: position {position:.0f} out of range {servoStatic.minPos}..{servoStatic.maxPos}")
+            continue
+        positions.append((servoName, servoStatic, round(position)))
+
+    if len(disabled) > 0:
+        config.log(f"targets of disabled servos ignored: {disabled}")
+    return positions, problems
+
+
+def preparePoseMoves(targets, unit='degrees', duration=None, speedRate=None):
+    """
+    validate all targets of a pose and create their move requests
+    :param targets: servoName -> degrees or position
+    :param unit: 'degrees' or 'position'
+    :param duration: common move duration in ms, extended to the min duration of the slowest servo
+                     so that all servos arrive together
+    :param speedRate: >0..1 of the max speed of each servo, used without duration
+    :return: (move requests, problems), no move requests if a target is invalid
+    """
+    positions, problems = targetPositions(targets, unit)
+    if len(problems) > 0:
+        return [], problems
+
+    # min duration of every move, the small moves are filtered as with single requests
+    moves = []
+    for servoName, servoStatic, position in positions:
+        servoCurrent = config.servoCurrentDictLocal[servoName]
+        fromPos = config.lastRequestedJawPosition if servoName == "head.jaw" else servoCurrent.currentPosition
+        deltaPos = abs(fromPos - position)
+        if deltaPos < 2:
+            continue
+        moves.append((servoName, servoStatic, fromPos, position, config.servoDerivedDictLocal[servoName].msPerPos * deltaPos))
+    if len(moves) == 0:
+        return [], problems
+
+    if duration is not None:
+        duration = max(duration, max(minDuration for *_, minDuration in moves))
+
+    moveRequests = []
+    for servoName, servoStatic, fromPos, position, minDuration in moves:
+        moveDuration = min(duration if duration is not None else minDuration / speedRate, 9999)
+        if servoName == "head.jaw":
+            config.lastRequestedJawPosition = position
+        moveRequests.append(buildMoveRequest(servoName, servoStatic, fromPos, position, moveDuration,
+                                             int(100 * minDuration / moveDuration) / 100))
+    return moveRequests, problems
+
+
+def requestServoPosition(servoName, newPosition, duration, sequential=True, trace=None):
+    """
+    move servo in <duration> seconds from current position to <position>
+    :param trace: request trace of a coalesced request, see requestTracing
+    """
+    request = prepareMoveRequest(servoName, newPosition, duration)
+    if request is None:
+        config.requestTracer.drop(trace)
+        return
 
     # for sequential requests add the request to the moveRequestBuffer
     # moves for a single servo will be requested in sequence of the added requests
     if sequential:
-        config.moveRequestBuffer.addMoveRequest(
-            {'servoName': servoName,
-             'arduino': servoStatic.arduinoIndex,
-             'msg': msg,
-             'fromPos': servoCurrent.currentPosition,
-             'toPos': newPosition,
-             'speedRate': speedRate
-             })
+        config.moveRequestBuffer.addMoveRequest(request)
     else:
         # if servo is still moving arduino will terminate the current move and set the new target
+        servoCurrent = config.servoCurrentDictLocal.get(servoName)
         servoCurrent.timeOfLastMoveRequest = time.time()
         servoCurrent.targetPosition = newPosition
-        sendArduinoCommand(servoStatic.arduinoIndex, msg)
+        config.requestTracer.dispatch(servoName, trace)
+        sendArduinoCommand(request['arduino'], request['msg'], request['command'], servoName)
+        if servoName in config.servoFeedbackDictLocal:
+            config.feedbackRecorder.startMove(servoName, request['fromPos'], request['toPos'], request['speedRate'])
 
 
 def requestServoDegrees(servoName, degrees, duration, sequential=True):
-    servoStatic: skeletonClasses.ServoStatic = config.servoStaticDictLocal.get(servoName)
-    servoDerived: skeletonClasses.ServoDerived = config.servoDerivedDictLocal.get(servoName)
-    position = mg.evalPosFromDeg(servoStatic, servoDerived, degrees)
-    config.log(f"request servo degrees for {servoName}, {degrees=}, {position=}, {duration=:.0f}", publish=False)
+    position = servoLookup.posFromDeg(servoName, degrees)
+    config.log(f"request servo degrees for {servoName}, {degrees=}, {position=}, {duration=:.0f}", publish=False, category='requests')
     requestServoPosition(servoName, position, duration, sequential)
 
 
@@ -136,33 +257,44 @@ def requestServoStop(servoName):
     servoStatic: skeletonClasses.ServoStatic = config.servoStaticDictLocal.get(servoName)
     servoCurrentLocal: skeletonClasses.ServoCurrent = config.servoCurrentDictLocal.get(servoName)
 
-    # clear all buffered requests for the servo
+    # clear all buffered requests for the servo, also the moves queued in the writer or scheduled,
+    # the stop skips ahead of them and they would restart the servo
     config.moveRequestBuffer.removeServoFromRequestList(servoName)
+    config.requestCoalescer.drop(servoName)
+    config.moveScheduler.dropServo(servoName)
+    if config.arduinoWriters[servoStatic.arduinoIndex] is not None:
+        config.arduinoWriters[servoStatic.arduinoIndex].dropServo(servoName)
+    config.poseTracker.cancelServo(servoName)
 
     # send stop request to arduino
     msg = f"2,{servoStatic.pin},\n"
-    sendArduinoCommand(servoStatic.arduinoIndex, msg)
+    sendArduinoCommand(servoStatic.arduinoIndex, msg, arduinoProtocol.stopCommand(servoStatic.pin), urgent=True)
 
     if servoCurrentLocal.swiping:
         servoCurrentLocal.swiping = False
-        config.updateSharedServoCurrent(servoName, servoCurrentLocal)
+    config.updateSharedServoCurrent(servoName, servoCurrentLocal, flush=True)
 
 
 def requestAllServosStop():
     config.log(f"all servos stop requested")
+    config.gesturePlayer.halt()     # no further keyframe batches, the handed over ones are cancelled
     config.moveRequestBuffer.clearBuffer()
     config.moveRequestBuffer.clearServoActiveList()
+    config.moveScheduler.clear()
+    config.requestCoalescer.clear()
+    config.poseTracker.cancelAll()
     msg = f"3,\n"
     for i in range(config.numArduinos):
-        if config.arduinoConn[i] is not None:
-            sendArduinoCommand(i, msg)
+        if config.arduinoWriters[i] is not None:
+            config.arduinoWriters[i].clear()    # drop commands and scheduled batches not yet sent
+            sendArduinoCommand(i, msg, urgent=True)
     time.sleep(1)   # allow some time to stop
 
 
 def requestServoStatus(servoName: str):
     servoStatic = config.servoStaticDictLocal.get(servoName)
     msg = f"4,{servoStatic.pin},\n"
-    sendArduinoCommand(servoStatic.arduinoIndex, msg)
+    sendArduinoCommand(servoStatic.arduinoIndex, msg, arduinoProtocol.statusCommand(servoStatic.pin))
 
 
 def setAutoDetach(servoName: str, milliseconds: int):
@@ -0,0 +1,455 @@
+
+# serial writer, one thread per arduino
+# callers only queue their commands, the writer thread paces the serial writes
+# so the arduino does not get overloaded
+import time
+import logging
+import threading
+import collections
+
+import config
+import arduinoProtocol
+import requestTracing
+
+
+class TokenBucket:
+    """
+    allows <burst> sends at once, refills one token every <interval> seconds
+    """
+    def __init__(self, interval, burst=1):
+        self.interval = interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.lastRefill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) / self.interval)
+        self.lastRefill = now
+
+    def acquire(self):
+        """
+        wait for a token
+        :return: seconds waited
+        """
+        waited = 0.0
+        self._refill()
+        while self.tokens < 1:
+            delay = (1 - self.tokens) * self.interval
+            time.sleep(delay)
+            waited += delay
+            self._refill()
+        self.tokens -= 1
+        return waited
+
+
+class AckCredits:
+    """
+    configuration commands in flight for an arduino that acknowledges them
+    a lost ack is replaced after timeout seconds, so a missing ack only delays the next command
+    """
+    def __init__(self, arduinoIndex, credits, timeout=1.0):
+        self.arduinoIndex = arduinoIndex
+        self.credits = credits
+        self.available = credits
+        self.timeout = timeout
+        self.condition = threading.Condition()
+
+        # stats
+        self.acksReceived = 0
+        self.timeouts = 0
+        self.waitTotal = 0.0
+
+    def acquire(self):
+        """
+        wait until the arduino has room for a configuration command
+        :return: seconds waited
+        """
+        start = time.monotonic()
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.available > 0, self.timeout):
+                # no ack within the timeout, the arduino has processed the commands in flight and the acks were lost
+                self.timeouts += 1
+                config.log(f"no ack from arduino {self.arduinoIndex} within {self.timeout} s, send next command")
+                self.available = self.credits
+            self.available -= 1
+        waited = time.monotonic() - start
+        self.waitTotal += waited
+        return waited
+
+    def release(self):
+        with self.condition:
+            self.acksReceived += 1
+            self.available = min(self.available + 1, self.credits)
+            self.condition.notify()
+
+    def stats(self):
+        return {'arduinoIndex': self.arduinoIndex,
+                'credits': self.credits,
+                'acksReceived': self.acksReceived,
+                'timeouts': self.timeouts,
+                'waitTotal': self.waitTotal}
+
+
+class ScheduledBatch:
+    """
+    commands to be written together not before <notBefore> (time.monotonic)
+    onSent(arduinoIndex, firstWriteTime, lastWriteTime) is called after the batch was written
+    a cancelled batch is dropped if it was not yet written
+    """
+    def __init__(self, commands, notBefore, onSent=None):
+        self.commands = commands        # list of (msg, command, servoName)
+        self.notBefore = notBefore
+        self.onSent = onSent
+        self.cancelled = False
+        self.revision = 0               # incremented when the commands of a stopped servo are removed
+
+
+class ArduinoWriter:
+
+    def __init__(self, arduinoIndex, conn, interval=0.05, burst=1, combineWrites=False, maxFrameBytes=60,
+                 protocolVersion=arduinoProtocol.PROTOCOL_ASCII):
+        """
+        :param protocolVersion: PROTOCOL_BINARY sends the commands that have a binary form as binary frames
+        :param combineWrites: pack all commands queued within one pacing window into a single serial write
+        :param maxFrameBytes: max size of a combined write, keep below the 64 byte arduino receive buffer
+        """
+        self.arduinoIndex = arduinoIndex
+        self.conn = conn
+        self.bucket = TokenBucket(interval, burst)
+        self.combineWrites = combineWrites
+        self.maxFrameBytes = maxFrameBytes
+        self.protocolVersion = protocolVersion
+        self.frame = bytearray(max(maxFrameBytes, 128))
+        self.outQueue = collections.deque()
+        self.urgentQueue = collections.deque()  # stop commands, written ahead of queued commands and batches
+        self.batchQueue = collections.deque()
+        self.configQueue = collections.deque()  # acknowledged configuration commands (msg, putTime), not paced
+        self.lastPutTime = 0.0                  # orders the configuration commands and the queued commands
+        self.currentBatch = None                # batch the writer thread waits for or writes
+        self.condition = threading.Condition()
+
+        # stats
+        self.commandsSent = 0
+        self.framesSent = 0
+        self.bytesSent = 0
+        self.commandsCleared = 0
+        self.commandsSkipped = 0
+        self.batchesCancelled = 0
+        self.maxQueueDepth = 0
+        self.queueWaitTotal = 0.0
+        self.queueWaitMax = 0.0
+        self.pacingWaitTotal = 0.0
+
+    def start(self):
+        writerThread = threading.Thread(target=self.run, daemon=True)
+        writerThread.name = f"arduinoWrite_{self.arduinoIndex}"
+        writerThread.start()
+
+    def put(self, msg, command=None, servoName=None, urgent=False):
+        """
+        :param msg: ascii command
+        :param command: optional binary form of the command, see arduinoProtocol
+        :param servoName: servo of a move command, the write time is passed to the request tracing
+        :param urgent: stop commands, written without pacing ahead of the queued commands and scheduled batches
+        """
+        if self.protocolVersion < arduinoProtocol.PROTOCOL_BINARY:
+            command = None
+        with self.condition:
+            if urgent:
+                self.urgentQueue.append((msg, command, time.monotonic(), servoName))
+            else:
+                self.outQueue.append((msg, command, self._putTime(), servoName))
+                self.maxQueueDepth = max(self.maxQueueDepth, len(self.outQueue))
+            self.condition.notify()
+
+    def putConfig(self, msg):
+        """
+        configuration command of an arduino with acks, the ack credits replace the pacing
+        """
+        with self.condition:
+            self.configQueue.append((msg, self._putTime()))
+            self.condition.notify()
+
+    def _putTime(self):
+        # strictly increasing, the configuration commands are written in order with the queued commands
+        self.lastPutTime = max(time.monotonic(), self.lastPutTime + 1e-9)
+        return self.lastPutTime
+
+    def _configDue(self):
+        return len(self.configQueue) > 0 and (len(self.outQueue) == 0 or self.configQueue[0][1] < self.outQueue[0][2])
+
+    def putBatch(self, batch):
+        """
+        scheduled batches are written ahead of the queued single commands
+        """
+        if self.protocolVersion < arduinoProtocol.PROTOCOL_BINARY:
+            batch.commands = [(msg, None, servoName) for msg, _, servoName in batch.commands]
+        with self.condition:
+            self.batchQueue.append(batch)
+            self.condition.notify()
+
+    def clear(self):
+        """
+        drop all not yet sent commands and cancel the scheduled batches, used with stop requests
+        """
+        with self.condition:
+            self.commandsCleared += len(self.outQueue)
+            self.outQueue.clear()
+            for batch in self.batchQueue:
+                batch.cancelled = True
+            self.batchesCancelled += len(self.batchQueue)
+            self.batchQueue.clear()
+            if self.currentBatch is not None and not self.currentBatch.cancelled:
+                self.currentBatch.cancelled = True
+                self.batchesCancelled += 1
+            self.condition.notify()
+
+    def dropServo(self, servoName):
+        """
+        remove the not yet sent commands of a servo from the queue and the scheduled batches, used with a servo stop
+        so a move queued before the stop can not restart the servo after it
+        """
+        with self.condition:
+            queued = len(self.outQueue)
+            self.outQueue = collections.deque(item for item in self.outQueue if item[3] != servoName)
+            self.commandsCleared += queued - len(self.outQueue)
+            batches = list(self.batchQueue)
+            if self.currentBatch is not None:
+                batches.append(self.currentBatch)
+            for batch in batches:
+                commands = [item for item in batch.commands if item[2] != servoName]
+                if len(commands) < len(batch.commands):
+                    self.commandsCleared += len(batch.commands) - len(commands)
+                    batch.commands = commands
+                    batch.revision += 1
+
+    def queueDepth(self):
+        return len(self.outQueue)
+
+    def stats(self):
+        return {'arduinoIndex': self.arduinoIndex,
+                'queueDepth': len(self.outQueue),
+                'maxQueueDepth': self.maxQueueDepth,
+                'commandsSent': self.commandsSent,
+                'framesSent': self.framesSent,
+                'bytesSent': self.bytesSent,
+                'commandsCleared': self.commandsCleared,
+                'commandsSkipped': self.commandsSkipped,
+                'batchesCancelled': self.batchesCancelled,
+                'queueWaitAvg': self.queueWaitTotal / self.commandsSent if self.commandsSent > 0 else 0.0,
+                'queueWaitMax': self.queueWaitMax,
+                'pacingWaitTotal': self.pacingWaitTotal}
+
+    def metrics(self):
+        """
+        :return: [(name, label values, value)] for the metricsExporter
+        """
+        board = (str(self.arduinoIndex),)
+        return [('skeleton_serial_bytes_sent_total', board, self.bytesSent),
+                ('skeleton_serial_frames_sent_total', board, self.framesSent),
+                ('skeleton_serial_commands_sent_total', board, self.commandsSent),
+                ('skeleton_serial_queue_depth', board, len(self.outQueue)),
+                ('skeleton_serial_queue_wait_seconds_total', board, self.queueWaitTotal),
+                ('skeleton_serial_pacing_wait_seconds_total', board, self.pacingWaitTotal)]
+
+    def _takeCommands(self):
+        """
+        dequeue the commands for the next serial write, in queue order
+        with combined writes take as many commands as fit into the frame
+        (a single command larger than the frame is sent on its own)
+        """
+        commands = [self.outQueue.popleft()]
+        if self.combineWrites:
+            frameLength = self._size(commands[0])
+            while len(self.outQueue) > 0 and frameLength + self._size(self.outQueue[0]) <= self.maxFrameBytes \
+                    and not self._configDue():
+                commands.append(self.outQueue.popleft())
+                frameLength += self._size(commands[-1])
+        return commands
+
+    @staticmethod
+    def _size(item):
+        msg, command = item[0], item[1]
+        return len(msg) if command is None else arduinoProtocol.commandSize(command)
+
+    def _buildFrames(self, commands):
+        """
+        pack the commands into frames of at most maxFrameBytes, a larger command gets a frame of its own
+        a command that can not be encoded (e.g. a field out of range) is logged and left out
+        yields (frame, commands in the frame), the frame is only valid until the next one is taken
+        """
+        frameLength = 0
+        frameCommands = []
+        for item in commands:
+            msg, command = item[0], item[1]
+            try:
+                data = msg.encode('ascii') if command is None else None
+                size = len(data) if command is None else arduinoProtocol.commandSize(command)
+            except Exception as e:
+                self._skip(msg, command, e)
+                continue
+            if frameLength > 0 and frameLength + size > self.maxFrameBytes:
+                yield memoryview(self.frame)[:frameLength], frameCommands
+                frameLength, frameCommands = 0, []
+            if command is None and size > len(self.frame):     # oversized ascii command, written as it is
+                yield data, [item]
+                continue
+            try:
+                if command is None:
+                    self.frame[frameLength:frameLength + size] = data
+                else:
+                    arduinoProtocol.encodeInto(self.frame, frameLength, command)
+            except Exception as e:
+                self._skip(msg, command, e)
+                continue
+            frameLength += size
+            frameCommands.append(item)
+        if frameLength > 0:
+            yield memoryview(self.frame)[:frameLength], frameCommands
+
+    def _skip(self, msg, command, e):
+        self.commandsSkipped += 1
+        config.log("arduinoWriter %d, command %r %r not encodable, skipped, %s", self.arduinoIndex, msg, command, e,
+                   level=logging.WARNING)
+
+    def _batchFrames(self, commands):
+        """
+        :return: list of (frame, batch commands in the frame), batches larger than maxFrameBytes are split into several frames
+        """
+        return [(bytes(frame), frameCommands) for frame, frameCommands in self._buildFrames(commands)]
+
+    def _writeBatch(self, batch):
+        """
+        build the frames ahead of time and write them as close as possible to batch.notBefore
+        """
+        with self.condition:
+            revision = batch.revision
+            frames = self._batchFrames(batch.commands)
+
+        writeTimes = []
+        written = 0
+        while len(frames) > 0:
+            self.pacingWaitTotal += self.bucket.acquire()
+            self._waitFor(batch)
+            with self.condition:
+                if batch.cancelled:
+                    break
+                if batch.revision != revision:
+                    # a servo was stopped meanwhile, rebuild the frames of the commands not yet written
+                    revision = batch.revision
+                    kept = {id(item) for item in batch.commands}
+                    frames = self._batchFrames([item for _, items in frames for item in items if id(item) in kept])
+                    if len(frames) == 0:
+                        break
+            frame, items = frames.pop(0)
+            try:
+                self.conn.write(frame)
+                self.conn.flush()
+            except Exception as e:
+                config.log("exception in arduinoWriter %d, %s", self.arduinoIndex, e, category='serial', level=logging.ERROR)
+            writeTimes.append(time.monotonic())
+            written += len(items)
+            self.framesSent += 1
+            self.bytesSent += len(frame)
+        if len(writeTimes) == 0:
+            return
+
+        self.commandsSent += written
+        config.log("scheduled batch of %d commands to arduino %d written in %d frames", written, self.arduinoIndex, len(writeTimes), category='serial')
+        if batch.onSent is not None:
+            batch.onSent(self.arduinoIndex, writeTimes[0], writeTimes[-1])
+
+    def _waitFor(self, batch):
+        """
+        wait until the batch is due or cancelled, stop commands queued meanwhile are written right away
+        """
+        while True:
+            with self.condition:
+                while not batch.cancelled and len(self.urgentQueue) == 0 and batch.notBefore > time.monotonic():
+                    self.condition.wait(max(batch.notBefore - time.monotonic(), 0.0))
+                if len(self.urgentQueue) == 0:
+                    return
+            self._writeUrgent()
+
+    def _writeUrgent(self):
+        with self.condition:
+            commands = list(self.urgentQueue)
+            self.urgentQueue.clear()
+        for item in commands:
+            self._writeCommands([item])
+
+    def _writeConfig(self, msg):
+        try:
+            self.conn.write(msg.encode('ascii'))
+            self.conn.flush()
+        except Exception as e:
+            config.log("exception in arduinoWriter %d, %s", self.arduinoIndex, e, category='serial', level=logging.ERROR)
+            return
+        self.framesSent += 1
+        self.bytesSent += len(msg)
+        self.commandsSent += 1
+        config.log("config msg to arduino %d: %r", self.arduinoIndex, msg, category='serial')
+
+    def _writeCommands(self, commands):
+        """
+        write queued (msg, command, putTime, servoName) items as one frame
+        a command larger than the frame is written separately after the commands before it
+        """
+        for frame, frameCommands in self._buildFrames(commands):
+            try:
+                self.conn.write(frame)
+                self.conn.flush()
+            except Exception as e:
+                config.log("exception in arduinoWriter %d, %s", self.arduinoIndex, e, category='serial', level=logging.ERROR)
+                return
+
+            now = time.monotonic()
+            self.framesSent += 1
+            self.bytesSent += len(frame)
+            for msg, command, putTime, servoName in frameCommands:
+                if servoName is not None:
+                    config.requestTracer.mark(servoName, requestTracing.WRITTEN, now)
+                queueWait = now - putTime
+                self.queueWaitTotal += queueWait
+                self.queueWaitMax = max(self.queueWaitMax, queueWait)
+                self.commandsSent += 1
+                if not msg.startswith('1,24'):     # do not log jaw
+                    config.log("msg to arduino %d: %r%s", self.arduinoIndex, msg,
+                               ' (binary)' if command is not None else '', category='serial')
+
+    def run(self):
+        config.log(f"arduinoWriter, start writing commands for arduino: {self.arduinoIndex}")
+        while True:
+            with self.condition:
+                while len(self.outQueue) == 0 and len(self.batchQueue) == 0 and len(self.configQueue) == 0 \
+                        and len(self.urgentQueue) == 0:
+                    self.condition.wait()
+                urgent = len(self.urgentQueue) > 0
+                batch = self.batchQueue.popleft() if not urgent and len(self.batchQueue) > 0 else None
+                configMsg = self.configQueue.popleft()[0] if not urgent and batch is None and self._configDue() else None
+                self.currentBatch = batch
+
+            if urgent:
+                self._writeUrgent()
+                continue
+
+            if batch is not None:
+                self._writeBatch(batch)
+                with self.condition:
+                    self.currentBatch = None
+                continue
+
+            if configMsg is not None:
+                self._writeConfig(configMsg)
+                continue
+
+            # do not overload the arduino with too many requests, pacing applies per write
+            self.pacingWaitTotal += self.bucket.acquire()
+
+            with self.condition:
+                if len(self.outQueue) == 0 or self._configDue():    # cleared or a configuration command came first
+                    self.bucket.tokens += 1
+                    continue
+                commands = self._takeCommands()
+            self._writeCommands(commands)
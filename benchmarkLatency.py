@@ -0,0 +1,219 @@
+
+# end to end latency benchmark of skeletonControl against the emulated arduinos
+#
+# measures for each move request
+#   request -> serial write:     time until the command arrives at the (emulated) arduino
+#   request -> targetReached:    time until skeletonControl processed the targetReached status
+#
+# usage: python benchmarkLatency.py --servos 8 --rate 20 --duration 20 [--sequential]
+import os
+import argparse
+import threading
+import time
+import collections
+
+import config
+import arduinoEmulator
+import arduinoSend
+import arduinoReceive
+import marvinSharesLocal
+import skeletonControl
+import skeletonRequests
+
+
+class LatencyRecorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pendingWrite = collections.defaultdict(list)                  # (arduino, pin) -> [(requestTime, toPos)]
+        self.pendingTarget = collections.defaultdict(list)                 # servoName -> [(requestTime, toPos)]
+        self.writeLatencies = []
+        self.targetLatencies = []
+        self.superseded = 0
+
+    def requestSent(self, servoName, arduinoIndex, pin, toPos):
+        t = time.monotonic()
+        with self.lock:
+            self.pendingWrite[(arduinoIndex, pin)].append((t, toPos))
+            self.pendingTarget[servoName].append((t, toPos))
+
+    def commandReceived(self, arduinoIndex, fields, receiveTime):
+        if fields[0] != '1':
+            return
+        with self.lock:
+            self._match(self.pendingWrite[(arduinoIndex, int(fields[1]))], int(fields[2]), receiveTime, self.writeLatencies)
+
+    def targetReached(self, servoName):
+        t = time.monotonic()
+        position = config.servoCurrentDictLocal[servoName].currentPosition
+        with self.lock:
+            self.superseded += self._match(self.pendingTarget[servoName], position, t, self.targetLatencies)
+
+    @staticmethod
+    def _match(pending, position, t, latencies):
+        """
+        the latest request for <position> is completed, older requests have been superseded
+        :return: number of superseded requests
+        """
+        for index in range(len(pending) - 1, -1, -1):
+            requestTime, toPos = pending[index]
+            if abs(toPos - position) <= 2:
+                latencies.append(t - requestTime)
+                del pending[:index + 1]
+                return index
+        return 0
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return "no samples"
+    ordered = sorted(values)
+    def p(q):
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+    return f"n={len(ordered):5}, p50={p(0.5):8.1f} ms, p90={p(0.9):8.1f} ms, p99={p(0.99):8.1f} ms, max={ordered[-1]*1000:8.1f} ms"
+
+
+def startSkeletonControl(recorder, tickInterval, protocolVersion, ackCredits):
+    """
+    start emulators, connect skeletonControl with them and run the request loop in a thread
+    """
+    emulators = arduinoEmulator.startEmulators(tickInterval=tickInterval, onCommand=recorder.commandReceived,
+                                               protocolVersion=protocolVersion, ackCredits=ackCredits)
+    config.arduinoPortCandidates = [emulator.portName for emulator in emulators]
+    config.marvinShares = marvinSharesLocal.MarvinSharesLocal()
+    config.startLogWriter()
+
+    start = time.monotonic()
+    skeletonControl.connectWithArduinos()
+    skeletonControl.startupPhase("connect", start)
+    start = time.monotonic()
+    skeletonControl.initServoControl()
+    skeletonControl.startupPhase("servo definitions", start)
+
+    # hook into the targetReached handling of arduinoReceive
+    setServoInactive = config.moveRequestBuffer.setServoInactive
+    def setServoInactiveTimed(servoName):
+        recorder.targetReached(servoName)
+        setServoInactive(servoName)
+    config.moveRequestBuffer.setServoInactive = setServoInactiveTimed
+
+    skeletonControl.startServoControl()
+    requestThread = threading.Thread(target=skeletonControl.processSkeletonRequests, daemon=True)
+    requestThread.name = "skeletonRequests"
+    requestThread.start()
+    return emulators
+
+
+def runScheduledLoad(recorder, servoNames, rate, duration, moveDuration, pose=False):
+    """
+    move all servos together in scheduled groups or poses, alternating between 20% and 80% of the range
+    """
+    highSide = False
+    endTime = time.monotonic() + duration
+    groupCount = 0
+    while time.monotonic() < endTime:
+        highSide = not highSide
+        share = 0.8 if highSide else 0.2
+        moves = []
+        for servoName in servoNames:
+            servoStatic = config.servoStaticDictLocal[servoName]
+            toPos = int(servoStatic.minPos + share * (servoStatic.maxPos - servoStatic.minPos))
+            recorder.requestSent(servoName, servoStatic.arduinoIndex, servoStatic.pin, toPos)
+            moves.append({'servoName': servoName, 'position': toPos, 'duration': moveDuration})
+        if pose:
+            config.marvinShares.skeletonRequestQueue.put({'msgType': 'pose', 'unit': 'position', 'duration': moveDuration,
+                                                          'targets': {move['servoName']: move['position'] for move in moves},
+                                                          'enqueueTime': time.monotonic()})
+        else:
+            config.marvinShares.skeletonRequestQueue.put({'msgType': 'scheduledMove', 'moves': moves,
+                                                          'startTime': time.time() + 0.2, 'enqueueTime': time.monotonic()})
+        groupCount += 1
+        time.sleep(max(1 / rate, moveDuration / 1000 + 0.3))
+    return groupCount
+
+
+def runLoad(recorder, servoNames, rate, duration, moveDuration, sequential):
+    """
+    put position requests for the servos round robin into the skeletonRequestQueue
+    each servo alternates between 20% and 80% of its position range
+    """
+    highSide = {servoName: False for servoName in servoNames}
+    endTime = time.monotonic() + duration
+    nextRequest = time.monotonic()
+    requestCount = 0
+    while time.monotonic() < endTime:
+        servoName = servoNames[requestCount % len(servoNames)]
+        servoStatic = config.servoStaticDictLocal[servoName]
+        highSide[servoName] = not highSide[servoName]
+        share = 0.8 if highSide[servoName] else 0.2
+        toPos = int(servoStatic.minPos + share * (servoStatic.maxPos - servoStatic.minPos))
+
+        recorder.requestSent(servoName, servoStatic.arduinoIndex, servoStatic.pin, toPos)
+        config.marvinShares.skeletonRequestQueue.put({'msgType': 'position', 'servoName': servoName,
+                                                      'position': toPos, 'duration': moveDuration,
+                                                      'sequential': sequential, 'enqueueTime': time.monotonic()})
+        requestCount += 1
+        nextRequest += 1 / rate
+        time.sleep(max(nextRequest - time.monotonic(), 0))
+    return requestCount
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="skeletonControl latency benchmark with emulated arduinos")
+    parser.add_argument("--servos", type=int, default=8, help="number of servos to move")
+    parser.add_argument("--rate", type=float, default=10, help="move requests per second")
+    parser.add_argument("--duration", type=float, default=20, help="load duration in seconds")
+    parser.add_argument("--moveDuration", type=int, default=500, help="requested move duration in ms")
+    parser.add_argument("--sequential", action="store_true", help="use sequential (buffered) move requests")
+    parser.add_argument("--scheduled", action="store_true", help="move all servos together with scheduled move groups")
+    parser.add_argument("--blend", action="store_true", help="blend the queued sequential moves of a servo")
+    parser.add_argument("--pose", action="store_true", help="move all servos together with pose requests")
+    parser.add_argument("--binary", action="store_true", help="emulated arduinos accept binary commands")
+    parser.add_argument("--ackCredits", type=int, default=2, help="emulated arduinos acknowledge configuration commands, 0 for none")
+    parser.add_argument("--tick", type=float, default=0.02, help="emulator status interval in seconds")
+    args = parser.parse_args()
+
+    recorder = LatencyRecorder()
+    config.moveRequestBuffer.blend = args.blend
+    emulators = startSkeletonControl(recorder, args.tick, 1 if args.binary else 0, args.ackCredits)
+
+    servoNames = [servoName for servoName, servoStatic in config.servoStaticDictLocal.items()
+                  if servoStatic.enabled and servoName != 'head.jaw'][:args.servos]
+    if args.scheduled or args.pose:
+        requestCount = runScheduledLoad(recorder, servoNames, args.rate, args.duration, args.moveDuration, args.pose)
+    else:
+        requestCount = runLoad(recorder, servoNames, args.rate, args.duration, args.moveDuration, args.sequential)
+    time.sleep(2 + args.moveDuration / 1000)     # let the last moves finish
+
+    config.log(f"{requestCount} requests for {len(servoNames)} servos, rate {args.rate}/s, sequential: {args.sequential}")
+    config.log(f"request -> serial write:   {percentiles(recorder.writeLatencies)}")
+    config.log(f"request -> targetReached:  {percentiles(recorder.targetLatencies)}")
+    config.log(f"superseded before target reached: {recorder.superseded}")
+    for writerStats in arduinoSend.getWriterStats():
+        config.log(f"writer {writerStats}")
+    config.log(f"coalescer {config.requestCoalescer.stats()}")
+    config.log(f"move request buffer {config.moveRequestBuffer.stats()}")
+    config.log(f"startup phases {', '.join(f'{phase}: {seconds:.2f} s' for phase, seconds in config.startupPhases.items())}")
+    config.log(f"ack credits {[ackCredits.stats() for ackCredits in config.ackCredits if ackCredits is not None]}")
+    config.log(f"log records dropped: {config.logRecordsDropped}")
+    config.log(f"shared state publisher {config.sharedStatePublisher.stats()}")
+    config.log(f"position store {config.positionStore.stats()}")
+    config.log(f"feedback recorder {config.feedbackRecorder.stats()}")
+    config.log(f"request dispatcher {config.requestDispatcher.stats()}")
+    if args.scheduled or args.pose:
+        config.log(f"scheduler {config.moveScheduler.stats()}")
+    if args.pose:
+        config.log(f"poses {config.poseTracker.stats()}")
+    config.log(f"metrics exporter {config.metricsExporter.stats()}")
+    config.log(f"request tracer {config.requestTracer.stats()}")
+    for key, summary in config.requestTracer.snapshot()['stages'].items():
+        config.log(f"  {key:32} n={summary['count']:5}, p50={summary['p50']:8.2f} ms, p90={summary['p90']:8.2f} ms, "
+              f"p99={summary['p99']:8.2f} ms, max={summary['max']:8.2f} ms")
+    for arduinoIndex, receiveStats in arduinoReceive.getReceiveStats().items():
+        config.log(f"receive {arduinoIndex} {receiveStats}")
+    for emulator in emulators:
+        config.log(f"S{emulator.arduinoIndex}: commands received {emulator.commandsReceived}, status frames sent {emulator.framesSent}")
+
+    config.flushLog()
+    config.exitProcess(0)     # serial receive threads do not terminate on their own
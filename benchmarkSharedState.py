@@ -0,0 +1,100 @@
+
+# read latency of the servo state in another process
+#   shared memory   sharedServoState.ServoStateReader, see sharedServoState
+#   proxied         dict of ServoCurrent dicts behind a multiprocessing manager, as with marvinShares
+# a writer thread in the owner process updates all servos at the status frame rate while the reader
+# process reads one servo after the other
+#   python benchmarkSharedState.py --servos 50 --reads 20000
+import time
+import argparse
+import threading
+import multiprocessing
+
+import sharedServoState
+
+STATE_NAME = "benchmarkServoState"
+
+
+class ServoCurrent:
+    # the ServoCurrent fields used by sharedServoState
+    def __init__(self):
+        self.currentPosition = 90
+        self.currentDegrees = 0.0
+        self.targetPosition = 90
+        self.servoWritePosition = 90
+        self.plannedPosition = 90
+        self.timeOfLastMoveRequest = 0.0
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    def p(q):
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)] / 1000
+    return f"p50={p(0.5):7.2f} us, p90={p(0.9):7.2f} us, p99={p(0.99):7.2f} us, max={ordered[-1] / 1000:9.2f} us"
+
+
+def readShared(servoNames, reads, results):
+    reader = sharedServoState.ServoStateReader(STATE_NAME)
+    latencies = []
+    for i in range(reads):
+        servoName = servoNames[i % len(servoNames)]
+        start = time.perf_counter_ns()
+        reader.read(servoName)
+        latencies.append(time.perf_counter_ns() - start)
+    results.put(('shared memory', latencies, reader.retries))
+    reader.close()
+
+
+def readProxied(servoNames, reads, proxiedDict, results):
+    latencies = []
+    for i in range(reads):
+        servoName = servoNames[i % len(servoNames)]
+        start = time.perf_counter_ns()
+        proxiedDict[servoName]
+        latencies.append(time.perf_counter_ns() - start)
+    results.put(('manager proxy', latencies, 0))
+
+
+def writeLoop(servoNames, state, proxiedDict, running, interval):
+    servoCurrents = {servoName: ServoCurrent() for servoName in servoNames}
+    position = 0
+    while running.is_set():
+        position = (position + 1) % 180
+        for servoName, servoCurrent in servoCurrents.items():
+            servoCurrent.currentPosition = position
+            state.update(servoName, servoCurrent, 0x06)
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="read latency of shared memory vs manager proxied servo state")
+    parser.add_argument("--servos", type=int, default=50)
+    parser.add_argument("--reads", type=int, default=20000)
+    parser.add_argument("--interval", type=float, default=0.02, help="seconds between updates of all servos")
+    args = parser.parse_args()
+
+    servoNames = [f"servo{i:02d}" for i in range(args.servos)]
+    state = sharedServoState.SharedServoState(STATE_NAME, servoNames)
+    # readers are started like the separate consumer programs, without inheriting the owner's state
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    proxiedDict = manager.dict({servoName: dict(ServoCurrent().__dict__) for servoName in servoNames})
+    results = context.Queue()
+
+    running = threading.Event()
+    running.set()
+    writer = threading.Thread(target=writeLoop, args=(servoNames, state, proxiedDict, running, args.interval), daemon=True)
+    writer.start()
+
+    for target, targetArgs in ((readShared, (servoNames, args.reads, results)),
+                               (readProxied, (servoNames, args.reads, proxiedDict, results))):
+        process = context.Process(target=target, args=targetArgs)
+        process.start()
+        name, latencies, retries = results.get()
+        process.join()
+        print(f"{name:14}: {percentiles(latencies)}{f', seqlock retries {retries}' if retries else ''}")
+
+    running.clear()
+    writer.join()
+    state.close()
+    manager.shutdown()
@@ -2,14 +2,42 @@
 import os
 import time, datetime
 import logging
+import queue
+import threading
 
 from marvinglobal import marvinglobal as mg
 from marvinglobal import marvinShares
 import moveRequestBuffer
+import moveScheduler
+import requestCoalescer
+import sharedStatePublisher
+import feedbackRecorder
+import poseTracker
+import gesturePlayer
+import requestTracing
+import metricsExporter
 
 numArduinos = 2
 arduinoConn = [None] * numArduinos
 
+# serial ports to search for the skeleton arduinos, replaced by the emulator ports when benchmarking
+startupCacheFile = "startupCache.pickle"     # prepared servo definitions, see startupCache
+arduinoPortCacheFile = "arduinoPorts.json"    # last port -> board mapping, see arduinoDiscovery
+arduinoPortCandidates = [f"/dev/ttyACM{portNumber}" for portNumber in range(5)]
+
+# one writer thread per arduino, see arduinoWriter
+arduinoWriters = [None] * numArduinos
+serialSendInterval = 0.05   # min seconds between serial sends, the arduino gets overloaded otherwise
+serialSendBurst = 1         # number of sends allowed back to back after an idle period
+serialWriteCombining = True # send the commands queued within one pacing interval with a single write
+serialMaxFrameBytes = 60    # max bytes of a combined write, the arduino serial receive buffer holds 64 bytes
+serialProtocolVersion = 1   # highest outbound protocol used by the host, 0 forces ascii commands (see arduinoProtocol)
+useAcks = True              # flow control of configuration commands by acks if the arduino supports it
+ackCredits = [None] * numArduinos   # arduinoWriter.AckCredits per arduino, None without acks
+ackTimeout = 1.0            # seconds to wait for an ack before sending anyway
+configCommandDelay = 0.2    # pause after a configuration command for arduinos without acks
+startupPhases = {}          # phase name -> seconds, see skeletonControl.startupPhase
+
 processName = 'skeletonControl'
 marvinShares = None   # shared data
 
@@ -21,16 +49,37 @@ servoStaticDictLocal = {}
 servoDerivedDictLocal = {}
 servoCurrentDictLocal = {}
 servoFeedbackDictLocal = {}
+# servo names are stored with this fixed width in the shared servo state, the position store slots
+# and the feedback archive index (sharedServoState, positionStore, feedbackRecorder, feedbackAnalytics),
+# longer names are rejected when the definitions are loaded
+servoNameBytes = 32
+
+sharedServoStateName = "marvinServoState"    # shared memory block with the servo state, see sharedServoState
+sharedServoState = None
 
 persistedServoPositionsLocal = {}
-servoPositionsChanged = False
-servoPositionsSavedTime = 0
+positionStore = None            # positionStore.PositionStore, created when the servo positions are loaded
 
 servoNameByArduinoAndPin = {}   # a dictionary to access servos by Arduino and Id
 
-moveRequestBuffer = moveRequestBuffer.MoveRequestBuffer(verbose=True)
-
-feedbackPositions = {}
+# lookup tables for the status message decoding, see servoLookup
+servoByArduinoPin = []
+posToDeg = {}
+degToPos = {}
+
+blendSequentialMoves = False   # join the queued sequential moves of a servo into one continuous motion
+moveRequestBuffer = moveRequestBuffer.MoveRequestBuffer(verbose=True, blend=blendSequentialMoves)
+moveScheduler = moveScheduler.MoveScheduler(leadTime=0.1)   # time scheduled, board synchronized move groups
+requestCoalescer = requestCoalescer.RequestCoalescer(interval=serialSendInterval)  # latest non-sequential target wins
+sharedStatePublisher = sharedStatePublisher.SharedStatePublisher(interval=0.2)      # rate limited servoCurrent updates
+
+feedbackRecorder = feedbackRecorder.FeedbackRecorder(dataDir="feedbackData")    # feedback servo move archive
+poseTracker = poseTracker.PoseTracker()     # completion of whole body poses
+gesturePlayer = gesturePlayer.GesturePlayer(lookahead=0.1, tick=0.02)    # in-process gesture playback
+gestureDir = "gestures"
+requestDispatcher = None       # requestDispatcher.RequestDispatcher, created by processSkeletonRequests
+metricsExporter = metricsExporter.MetricsExporter(port=9110, snapshotInterval=5)  # link health metrics, prometheus on localhost
+requestTracer = requestTracing.RequestTracer(snapshotFile="requestTraces.json", snapshotInterval=60)  # per stage move latencies
 
 # special case jaw servo, keep track of last requested position
 lastRequestedJawPosition = 80
@@ -43,22 +92,132 @@ def startLogging():
         filemode="w")
 
 
-def log(msg, publish=True):
-
-    logtime = str(datetime.datetime.now())[11:23]
+# log pipeline
+# log records are queued and written by the logWriter thread, a full queue drops the record
+# each record has a category with its own level, levels can be changed at runtime (skeletonRequests.setLogLevel)
+LOG_OFF = logging.CRITICAL + 10
+logLevels = {'general': logging.INFO,
+             'serial': logging.INFO,        # serial messages sent and received
+             'feedback': logging.INFO,      # feedback servo samples
+             'moveBuffer': logging.INFO,    # moveRequestBuffer
+             'requests': logging.INFO,      # skeleton requests received and processed
+             'gesture': logging.INFO}       # gesture keyframe timing
+logQueue = queue.Queue(maxsize=10000)
+logWriterRunning = False
+logRecordsDropped = 0
+
+
+def logEnabled(category, level=logging.INFO):
+    """
+    use to guard expensive log message creation in hot paths
+    """
+    return level >= logLevels.get(category, logging.INFO)
+
+
+def log(msg, *args, publish=True, category='general', level=logging.INFO):
+    """
+    :param msg: message, formatted with msg % args in the log writer thread if args are given
+    :param publish: False writes the record to the log file only, not to the console
+    """
+    global logRecordsDropped
+
+    if level < logLevels.get(category, logging.INFO):
+        return
+    record = (time.time(), msg, args, publish)
+    if not logWriterRunning:
+        writeLogRecord(record)
+        return
+    try:
+        logQueue.put_nowait(record)
+    except queue.Full:
+        logRecordsDropped += 1
+
+
+def writeLogRecord(record):
+    timestamp, msg, args, publish = record
+    if len(args) > 0:
+        msg = msg % args
+    logtime = datetime.datetime.fromtimestamp(timestamp).strftime("%H:%M:%S.%f")[:12]
     logging.info(f"{logtime} - {msg}")
-    print(f"{logtime} - {msg}")
+    if publish:
+        print(f"{logtime} - {msg}")
+
+
+def runLogWriter():
+    while True:
+        record = logQueue.get()
+        try:
+            writeLogRecord(record)
+        except Exception as e:
+            print(f"log record could not be written, {record}, {e}")
+        logQueue.task_done()
+
+
+def startLogWriter():
+    global logWriterRunning
+
+    logWriterThread = threading.Thread(target=runLogWriter, daemon=True)
+    logWriterThread.name = "logWriter"
+    logWriterThread.start()
+    logWriterRunning = True
+
+
+def flushLog():
+    # wait for the queued records to be written, exitProcess does not run the writer to the end
+    if logWriterRunning:
+        logQueue.join()
+
+
+def setLogLevel(category, level):
+    """
+    :param level: logging level name or number, 'OFF' disables the category
+    """
+    if isinstance(level, str):
+        level = LOG_OFF if level.upper() == 'OFF' else logging.getLevelName(level.upper())
+    if not isinstance(level, int):
+        log(f"invalid log level {level} for category {category}")
+        return
+    logLevels[category] = level
+    log(f"log level for {category} set to {logging.getLevelName(level) if level < LOG_OFF else 'OFF'}")
 
 
 def updateSharedDict(msg):
     #log(f"updateSharedDict, {msg=}")
-    if not marvinShares.updateSharedData(msg):
+    start = time.monotonic()
+    updated = marvinShares.updateSharedData(msg)
+    item = (getattr(msg['msgType'], 'name', str(msg['msgType'])),)
+    counters = metricsExporter.counters()
+    counters.inc('skeleton_shared_updates_total', item)
+    counters.inc('skeleton_shared_update_seconds_total', item, time.monotonic() - start)
+    if not updated:
 
         log(f"connection with shared data lost, going down") # connection to marvinData lost, try to reconnect
-        os._exit(1)
-
-def updateSharedServoCurrent(servoName, servoCurrentLocal):
-    log(f"update share: {servoName}, {servoCurrentLocal}")
-    msg = {'msgType': mg.SharedDataItems.SERVO_CURRENT, 'sender':processName,
-           'info': {'servoName': servoName, 'data': dict(servoCurrentLocal.__dict__)}}
-    updateSharedDict(msg)
+        exitProcess(1)
+
+def closeSharedServoState():
+    # the owner unlinks the shared memory block, otherwise it stays in /dev/shm after the process ended
+    global sharedServoState
+    if sharedServoState is not None:
+        sharedServoState.close()
+        sharedServoState = None
+
+
+def exitProcess(exitCode):
+    """
+    os._exit skips the atexit handlers, release the shared servo state before going down
+    """
+    closeSharedServoState()
+    os._exit(exitCode)
+
+
+def updateSharedServoCurrent(servoName, servoCurrentLocal, flush=False):
+    """
+    mark the servo state as changed, the sharedStatePublisher sends it to marvinData
+    :param flush: publish without waiting for the next publish interval (targetReached, stop)
+    """
+    if sharedStatePublisher.running:
+        sharedStatePublisher.markChanged(servoName, flush)
+    else:
+        # publisher not yet started, update directly
+        log("update share: %s, %s", servoName, servoCurrentLocal, category='serial', level=logging.DEBUG)
+        sharedStatePublisher.publish(servoName, dict(servoCurrentLocal.__dict__))
@@ -0,0 +1,171 @@
+
+# trajectory quality of the archived feedback servo moves, see feedbackRecorder
+# all metrics are computed with numpy over all moves of an archive chunk at once (segment reductions),
+# the moves are grouped by servo, pid values and speedRate and written as a csv summary table
+#   python feedbackAnalytics.py --days 2026-10-17 2026-10-18 --out tuning.csv
+# an offline tool, it reads the archive files directly and logs through the logging module,
+# config and feedbackRecorder would load marvinglobal and create the controller objects
+import os
+import csv
+import logging
+import argparse
+import numpy as np
+
+# servoName has the width of config.servoNameBytes
+INDEX_DTYPE = np.dtype([('servoName', 'S32'), ('startTime', '<f8'), ('fromPos', '<i2'), ('toPos', '<i2'),
+                        ('speedRate', '<f4'), ('kp', '<f4'), ('ki', '<f4'), ('kd', '<f4'),
+                        ('sampleOffset', '<u8'), ('sampleCount', '<u4')])
+COLUMN_DTYPES = {'ms': np.int32, 'current': np.int16, 'servoWrite': np.int16, 'planned': np.int16}
+METRICS = ('rmsError', 'maxError', 'overshoot', 'settlingMs', 'lagMs', 'achievedSpeedRate')
+SUMMARY_FIELDS = ('servoName', 'kp', 'ki', 'kd', 'speedRate', 'moves') + \
+                 tuple(f"{metric}{stat}" for metric in METRICS for stat in ('Mean', 'P90'))
+
+
+def chunkNames(dayDir):
+    # same naming as feedbackRecorder, chunkNnn.index and one file per column
+    if not os.path.isdir(dayDir):
+        return []
+    return sorted(fileName[:-len(".index")] for fileName in os.listdir(dayDir) if fileName.endswith(".index"))
+
+
+def loadChunk(chunkBase):
+    """
+    :return: (index as structured array, dict columnName -> memory mapped column)
+    """
+    index = np.fromfile(f"{chunkBase}.index", dtype=INDEX_DTYPE)
+    columns = {}
+    for columnName, dtype in COLUMN_DTYPES.items():
+        fileName = f"{chunkBase}.{columnName}"
+        columns[columnName] = np.memmap(fileName, dtype=dtype, mode='r') \
+            if os.path.getsize(fileName) > 0 else np.zeros(0, dtype=dtype)
+    return index, columns
+
+
+def moveMetrics(index, columns, tolerance=2):
+    """
+    per move metrics of one chunk
+    :param tolerance: positions around toPos counted as settled
+    :return: dict metricName -> array with one value per move
+    """
+    starts = index['sampleOffset'].astype(np.int64)
+    counts = index['sampleCount'].astype(np.int64)
+    numSamples = int(starts[-1] + counts[-1]) if len(index) > 0 else 0
+    ms = np.asarray(columns['ms'][:numSamples], dtype=np.float64)
+    current = np.asarray(columns['current'][:numSamples], dtype=np.float64)
+    planned = np.asarray(columns['planned'][:numSamples], dtype=np.float64)
+
+    # broadcast the per move values to the samples
+    moveOfSample = np.repeat(np.arange(len(index)), counts)
+    toPos = index['toPos'].astype(np.float64)
+    direction = np.sign(toPos - index['fromPos'])
+    lasts = starts + counts - 1
+
+    error = current - planned
+    rmsError = np.sqrt(np.add.reduceat(error * error, starts) / counts)
+    maxError = np.maximum.reduceat(np.abs(error), starts)
+
+    # overshoot: furthest position beyond the target in move direction
+    beyond = (current - toPos[moveOfSample]) * direction[moveOfSample]
+    overshoot = np.maximum(np.maximum.reduceat(beyond, starts), 0)
+
+    # settling: first sample after the last one outside the tolerance band, NaN if not settled
+    sampleNumber = np.arange(numSamples)
+    outside = np.abs(current - toPos[moveOfSample]) > tolerance
+    lastOutside = np.maximum.reduceat(np.where(outside, sampleNumber, -1), starts)
+    settledSample = np.maximum(lastOutside + 1, starts)
+    settled = settledSample <= lasts
+    settlingMs = np.where(settled, ms[np.minimum(settledSample, lasts)] - ms[starts], np.nan)
+
+    # planned move time: first sample where the planned position reaches its final value
+    plannedFinal = planned[lasts]
+    plannedDone = np.where(planned == plannedFinal[moveOfSample], sampleNumber, numSamples)
+    plannedEnd = np.minimum.reduceat(plannedDone, starts)
+    plannedMs = ms[plannedEnd] - ms[starts]
+
+    # lag: mean distance behind the planned position while the plan moves, divided by the planned speed
+    plannedSpeed = np.abs(plannedFinal - planned[starts]) / np.where(plannedMs > 0, plannedMs, np.nan)
+    moving = sampleNumber <= plannedEnd[moveOfSample]
+    behind = np.where(moving, np.maximum(error * -direction[moveOfSample], 0), 0)
+    movingCount = np.add.reduceat(moving.astype(np.int64), starts)
+    lagMs = np.add.reduceat(behind, starts) / movingCount / np.where(plannedSpeed > 0, plannedSpeed, np.nan)
+
+    # speedRate is min duration / requested duration (see arduinoSend), a slower move lowers the achieved one
+    achievedSpeedRate = index['speedRate'] * plannedMs / np.where(settlingMs > 0, settlingMs, np.nan)
+
+    return {'rmsError': rmsError, 'maxError': maxError, 'overshoot': overshoot, 'settlingMs': settlingMs,
+            'lagMs': lagMs, 'achievedSpeedRate': achievedSpeedRate, 'plannedMs': plannedMs}
+
+
+def analyse(days, dataDir="feedbackData", servoName=None, tolerance=2):
+    """
+    :return: (index of all moves, dict metricName -> array over all moves)
+    """
+    indexes = []
+    metrics = {metric: [] for metric in METRICS}
+    for day in days:
+        dayDir = os.path.join(dataDir, day)
+        for chunkName in chunkNames(dayDir):
+            index, columns = loadChunk(os.path.join(dayDir, chunkName))
+            if len(index) == 0:
+                continue
+            chunkMetrics = moveMetrics(index, columns, tolerance)
+            selected = np.ones(len(index), dtype=bool) if servoName is None else index['servoName'] == servoName.encode()
+            indexes.append(index[selected])
+            for metric in METRICS:
+                metrics[metric].append(chunkMetrics[metric][selected])
+    if len(indexes) == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE), {metric: np.zeros(0) for metric in METRICS}
+    return np.concatenate(indexes), {metric: np.concatenate(values) for metric, values in metrics.items()}
+
+
+def summarize(index, metrics, speedRateStep=0.05):
+    """
+    group the moves by servo, pid values and speedRate (rounded to speedRateStep)
+    :return: list of summary rows (dicts with SUMMARY_FIELDS)
+    """
+    if len(index) == 0:
+        return []
+    keys = np.zeros(len(index), dtype=[('servoName', 'S32'), ('kp', '<f4'), ('ki', '<f4'), ('kd', '<f4'), ('speedRate', '<f4')])
+    for field in ('servoName', 'kp', 'ki', 'kd'):
+        keys[field] = index[field]
+    keys['speedRate'] = np.round(index['speedRate'] / speedRateStep) * speedRateStep
+    groups, groupOfMove = np.unique(keys, return_inverse=True)
+    order = np.argsort(groupOfMove, kind='stable')
+    bounds = np.searchsorted(groupOfMove[order], np.arange(len(groups) + 1))
+
+    rows = []
+    for groupNumber, group in enumerate(groups):
+        moves = order[bounds[groupNumber]:bounds[groupNumber + 1]]
+        row = {'servoName': group['servoName'].decode(), 'kp': round(float(group['kp']), 4),
+               'ki': round(float(group['ki']), 4), 'kd': round(float(group['kd']), 4),
+               'speedRate': round(float(group['speedRate']), 2), 'moves': len(moves)}
+        for metric in METRICS:
+            values = metrics[metric][moves]
+            values = values[~np.isnan(values)]
+            row[f"{metric}Mean"] = round(float(values.mean()), 2) if len(values) > 0 else ''
+            row[f"{metric}P90"] = round(float(np.percentile(values, 90)), 2) if len(values) > 0 else ''
+        rows.append(row)
+    return rows
+
+
+def writeSummary(rows, fileName):
+    with open(fileName, 'w', newline='') as outFile:
+        writer = csv.DictWriter(outFile, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    parser = argparse.ArgumentParser(description="trajectory quality of the recorded feedback servo moves")
+    parser.add_argument('--days', nargs='+', required=True, help="archive days, yyyy-mm-dd")
+    parser.add_argument('--dataDir', default="feedbackData")
+    parser.add_argument('--servo', default=None, help="only moves of this servo")
+    parser.add_argument('--tolerance', type=float, default=2, help="positions around the target counted as settled")
+    parser.add_argument('--out', default="feedbackSummary.csv")
+    args = parser.parse_args()
+
+    index, metrics = analyse(args.days, args.dataDir, args.servo, args.tolerance)
+    rows = summarize(index, metrics)
+    writeSummary(rows, args.out)
+    logging.info("%d moves analysed, %d groups written to %s", len(index), len(rows), args.out)
@@ -0,0 +1,261 @@
+
+# recorder for the feedback servo trajectories
+# the receive thread appends the samples of a move into preallocated typed arrays, finished moves are
+# handed to the feedbackWriter thread which appends them to a columnar archive, one directory per day:
+#   feedbackData/<yyyy-mm-dd>/chunkNNN.index        one MOVE_INDEX record per move
+#   feedbackData/<yyyy-mm-dd>/chunkNNN.<column>     ms (int32), current, servoWrite, planned (int16)
+# a chunk takes up to CHUNK_SAMPLES samples, a move's samples are at [sampleOffset:sampleOffset + sampleCount]
+import os
+import time
+import mmap
+import queue
+import array
+import struct
+import datetime
+
+import config
+
+COLUMNS = (('ms', 'i'), ('current', 'h'), ('servoWrite', 'h'), ('planned', 'h'))
+MOVE_INDEX = struct.Struct('<32sdhhffffQI')    # servoName, startTime, fromPos, toPos, speedRate, kp, ki, kd, sampleOffset, sampleCount
+MOVE_INDEX_FIELDS = ('servoName', 'startTime', 'fromPos', 'toPos', 'speedRate', 'kp', 'ki', 'kd', 'sampleOffset', 'sampleCount')
+CHUNK_SAMPLES = 1 << 20
+MIN_SAMPLES = 6         # shorter moves are not archived
+
+
+class MoveRecording:
+
+    def __init__(self, capacity):
+        self.columns = [array.array(typeCode, bytes(array.array(typeCode).itemsize * capacity))
+                        for _, typeCode in COLUMNS]
+        self.capacity = capacity
+        self.reset(None, 0, 0, 0.0)
+
+    def reset(self, servoName, fromPos, toPos, speedRate):
+        self.servoName = servoName
+        self.startTime = time.time()
+        self.fromPos = fromPos
+        self.toPos = toPos
+        self.speedRate = speedRate
+        self.pid = (0.0, 0.0, 0.0)
+        self.count = 0
+
+
+class FeedbackRecorder:
+
+    def __init__(self, dataDir="feedbackData", capacity=2048, queueSize=100):
+        """
+        :param capacity: max samples per move, further samples of the move are dropped
+        :param queueSize: max finished moves waiting for the writer
+        """
+        self.dataDir = dataDir
+        self.capacity = capacity
+        self.recordings = {}                    # servoName -> MoveRecording of the running move
+        self.freeRecordings = queue.SimpleQueue()
+        self.writeQueue = queue.Queue(maxsize=queueSize)
+
+        # archive chunk the writer appends to
+        self.chunkDay = None
+        self.chunkBase = None
+        self.chunkSamples = 0
+        self.chunkFiles = []                    # open files of the chunk, columns and index
+
+        # stats
+        self.movesRecorded = 0
+        self.movesWritten = 0
+        self.movesDropped = 0
+        self.samplesDropped = 0
+
+    def _recording(self):
+        try:
+            return self.freeRecordings.get_nowait()
+        except queue.Empty:
+            return MoveRecording(self.capacity)
+
+    def startMove(self, servoName, fromPos, toPos, speedRate):
+        """
+        a new move of a feedback servo was sent, an unfinished recording of the servo is discarded
+        """
+        recording = self.recordings.pop(servoName, None)
+        if recording is None:
+            recording = self._recording()
+        recording.reset(servoName, fromPos, toPos, speedRate)
+        self.recordings[servoName] = recording
+
+    def addSample(self, servoName, ms, currentPosition, servoWritePosition, plannedPosition):
+        recording = self.recordings.get(servoName)
+        if recording is None:
+            return
+        i = recording.count
+        if i >= recording.capacity:
+            self.samplesDropped += 1
+            return
+        msColumn, currentColumn, servoWriteColumn, plannedColumn = recording.columns
+        msColumn[i] = ms
+        currentColumn[i] = currentPosition
+        servoWriteColumn[i] = servoWritePosition
+        plannedColumn[i] = plannedPosition
+        recording.count = i + 1
+
+    def sampleCount(self, servoName):
+        recording = self.recordings.get(servoName)
+        return 0 if recording is None else recording.count
+
+    def finishMove(self, servoName):
+        """
+        target reached, hand the recording to the writer thread
+        """
+        recording = self.recordings.pop(servoName, None)
+        if recording is None:
+            return
+        if recording.count < MIN_SAMPLES:
+            self.freeRecordings.put(recording)
+            return
+        servoFeedback = config.servoFeedbackDictLocal.get(servoName)
+        if servoFeedback is not None:
+            recording.pid = (servoFeedback.kp, servoFeedback.ki, servoFeedback.kd)
+        self.movesRecorded += 1
+        try:
+            self.writeQueue.put_nowait(recording)
+        except queue.Full:
+            self.movesDropped += 1
+            self.freeRecordings.put(recording)
+
+    def stats(self):
+        return {'movesRecorded': self.movesRecorded,
+                'movesWritten': self.movesWritten,
+                'movesDropped': self.movesDropped,
+                'samplesDropped': self.samplesDropped,
+                'writeQueueDepth': self.writeQueue.qsize()}
+
+    def _openChunk(self, day):
+        """
+        continue the last chunk of the day, a partly written move of a crash is cut off
+        """
+        dayDir = os.path.join(self.dataDir, day)
+        os.makedirs(dayDir, exist_ok=True)
+        chunks = chunkNames(dayDir)
+        chunkNumber = len(chunks) - 1 if len(chunks) > 0 else 0
+        self.chunkDay = day
+        self.chunkBase = os.path.join(dayDir, f"chunk{chunkNumber:03d}")
+        self.chunkSamples = _repairChunk(self.chunkBase)
+        if self.chunkSamples >= CHUNK_SAMPLES:
+            self._nextChunk()
+        else:
+            self._openChunkFiles()
+
+    def _nextChunk(self):
+        dayDir = os.path.dirname(self.chunkBase)
+        self.chunkBase = os.path.join(dayDir, f"chunk{len(chunkNames(dayDir)):03d}")
+        self.chunkSamples = 0
+        self._openChunkFiles()
+
+    def _openChunkFiles(self):
+        for chunkFile in self.chunkFiles:
+            chunkFile.close()
+        self.chunkFiles = [open(f"{self.chunkBase}.{columnName}", 'ab') for columnName, _ in COLUMNS] + \
+                          [open(f"{self.chunkBase}.index", 'ab')]
+
+    def write(self, recording):
+        day = datetime.date.fromtimestamp(recording.startTime).isoformat()
+        if day != self.chunkDay:
+            self._openChunk(day)
+        elif self.chunkSamples + recording.count > CHUNK_SAMPLES:
+            self._nextChunk()
+
+        # columns first, the index record makes the move visible
+        *columnFiles, indexFile = self.chunkFiles
+        for columnFile, column in zip(columnFiles, recording.columns):
+            columnFile.write(memoryview(column)[:recording.count])
+            columnFile.flush()
+        kp, ki, kd = recording.pid
+        indexFile.write(MOVE_INDEX.pack(recording.servoName.encode(), recording.startTime,
+                                        int(recording.fromPos), int(recording.toPos), recording.speedRate,
+                                        kp, ki, kd, self.chunkSamples, recording.count))
+        indexFile.flush()
+        self.chunkSamples += recording.count
+        self.movesWritten += 1
+
+    def run(self):
+        config.log(f"feedbackWriter started, archive in {self.dataDir}")
+        while True:
+            recording = self.writeQueue.get()
+            try:
+                self.write(recording)
+            except Exception as e:
+                config.log(f"could not archive feedback move of {recording.servoName}, {e}")
+            self.freeRecordings.put(recording)
+
+
+def chunkNames(dayDir):
+    if not os.path.isdir(dayDir):
+        return []
+    return sorted(fileName[:-len(".index")] for fileName in os.listdir(dayDir) if fileName.endswith(".index"))
+
+
+def _repairChunk(chunkBase):
+    """
+    truncate index and columns to the last complete move
+    :return: number of samples in the chunk
+    """
+    indexFile = f"{chunkBase}.index"
+    if not os.path.isfile(indexFile):
+        for columnName, _ in COLUMNS:
+            if os.path.isfile(f"{chunkBase}.{columnName}"):
+                os.truncate(f"{chunkBase}.{columnName}", 0)
+        return 0
+    indexSize = os.path.getsize(indexFile)
+    indexSize -= indexSize % MOVE_INDEX.size
+    os.truncate(indexFile, indexSize)
+    numSamples = 0
+    if indexSize > 0:
+        with open(indexFile, 'rb') as inFile:
+            inFile.seek(indexSize - MOVE_INDEX.size)
+            lastMove = MOVE_INDEX.unpack(inFile.read(MOVE_INDEX.size))
+        numSamples = lastMove[8] + lastMove[9]
+    for columnName, typeCode in COLUMNS:
+        columnFile = f"{chunkBase}.{columnName}"
+        if os.path.isfile(columnFile):
+            os.truncate(columnFile, numSamples * array.array(typeCode).itemsize)
+    return numSamples
+
+
+def _mapFile(fileName, typeCode):
+    if os.path.getsize(fileName) == 0:
+        return memoryview(array.array(typeCode))
+    with open(fileName, 'rb') as inFile:
+        return memoryview(mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)).cast(typeCode)
+
+
+def readChunk(chunkBase):
+    """
+    map the index and the columns of a chunk
+    :return: (list of move dicts, dict columnName -> memoryview of the column)
+    """
+    with open(f"{chunkBase}.index", 'rb') as inFile:
+        indexData = inFile.read()
+    moves = []
+    for fields in MOVE_INDEX.iter_unpack(indexData[:len(indexData) - len(indexData) % MOVE_INDEX.size]):
+        move = dict(zip(MOVE_INDEX_FIELDS, fields))
+        move['servoName'] = move['servoName'].rstrip(b'\0').decode()
+        moves.append(move)
+    columns = {columnName: _mapFile(f"{chunkBase}.{columnName}", typeCode) for columnName, typeCode in COLUMNS}
+    return moves, columns
+
+
+def readDay(day, dataDir="feedbackData", servoName=None):
+    """
+    all archived moves of a day
+    :param day: 'yyyy-mm-dd'
+    :return: list of (move dict, columns), the samples of a move are
+             columns[columnName][move['sampleOffset']:move['sampleOffset'] + move['sampleCount']]
+    """
+    result = []
+    dayDir = os.path.join(dataDir, day)
+    for chunkName in chunkNames(dayDir):
+        moves, columns = readChunk(os.path.join(dayDir, chunkName))
+        result.extend((move, columns) for move in moves if servoName is None or move['servoName'] == servoName)
+    return result
+
+
+def runFeedbackWriter():
+    config.feedbackRecorder.run()
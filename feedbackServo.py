@@ -1,17 +1,13 @@
 
 # feedback servo handling
-# create a log of the movements
+# the movements are recorded by feedbackRecorder
 import os
-import time
 import config
-import datetime
 import simplejson as json
-import csv
 from marvinglobal import marvinglobal as mg
 from marvinglobal import skeletonClasses
 import arduinoSend
-
-createCsv = True
+import startupCache
 
 
 def loadServoFeedbackDefinitions():
@@ -20,8 +16,7 @@ def loadServoFeedbackDefinitions():
     try:
         with open(mg.SERVO_FEEDBACK_DEFINITIONS_FILE, 'r') as infile:
             servoFeedbackDefinitions = json.load(infile)
-        with open(mg.SERVO_FEEDBACK_DEFINITIONS_FILE + ".bak", 'w') as outfile:
-            json.dump(servoFeedbackDefinitions, outfile, indent=2)
+        startupCache.backupIfChanged(mg.SERVO_FEEDBACK_DEFINITIONS_FILE)
 
     except Exception as e:
         config.log(f"problem loading {mg.SERVO_FEEDBACK_DEFINITIONS_FILE} file, try using the backup file, {e}")
@@ -32,12 +27,6 @@ def loadServoFeedbackDefinitions():
         servoFeedback.updateValues(servoFeedbackData)
         config.servoFeedbackDictLocal.update({servoName: servoFeedback})
 
-        # add servoFeedback to shared data
-        # updStmt = (mg.SharedDataItems.SERVO_TYPE, servoTypeName, dict(servoType.__dict__))
-        msg = {'msgType': mg.SharedDataItems.SERVO_FEEDBACK, 'sender': config.processName,
-               'info': {'servoName': servoName, 'data': dict(servoFeedback.__dict__)}}
-        config.updateSharedDict(msg)
-
     config.log(f"servoFeedbackDict loaded")
 
 
@@ -92,37 +81,3 @@ def setupFeedbackServos(arduinoIndex):
 
             config.log(f"servo feedback definitions {servoName}")
             arduinoSend.servoFeedbackDefinitions(arduinoIndex, servoStatic.pin, servoFeedback)
-            time.sleep(0.2)     # add delay as arduino gets overwhelmed otherwise
-
-
-def clearPositionList(servoName, fromPos, toPos, speedRate):
-    config.feedbackPositions.update({servoName: {'fromPos': fromPos, 'toPos': toPos, 'speedRate': speedRate, 'values': []}})
-
-def addPosition(servoName, ms, currentPosition, servoWritePosition, plannedPosition):
-    config.feedbackPositions[servoName]['values'].append([ms, currentPosition, servoWritePosition, plannedPosition])
-
-def dumpPositionList(servoName):
-    fromPos = config.feedbackPositions[servoName]['fromPos']
-    toPos = config.feedbackPositions[servoName]['toPos']
-    speedRate = config.feedbackPositions[servoName]['speedRate']
-    basename = f"feedbackData/{servoName}/{str(datetime.datetime.now())[:10]}"
-    os.makedirs(basename, exist_ok=True)
-    filename = f"{basename}/{str(datetime.datetime.now())[11:19]}_{fromPos}_{toPos}_{speedRate:.2f}"
-    with open(filename + ".json", 'w') as outFile:
-        json.dump(config.feedbackPositions[servoName], outFile, indent=0)
-
-    if createCsv:
-        with open(filename + '.csv', 'w') as outFile:
-            writer = csv.writer(outFile)
-            header = ["ms","current","servoWrite","planned"]
-            writer.writerow(header)
-            for row in config.feedbackPositions[servoName]['values']:
-                writer.writerow(row)
-
-
-if __name__ == "__main__":
-    clearPositionList('servo', 90, 100, 0.5)
-    addPosition('servo', 10, 8, 20, 7, 6)
-    addPosition('servo', 15,11, 21, 6, 7)
-    dumpPositionList('servo')
-
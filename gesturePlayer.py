@@ -0,0 +1,339 @@
+
+# gestures played inside skeletonControl
+# a gesture file is compiled into per arduino, time sorted keyframe batches before it is played.
+# the player thread hands the batches due within the lookahead window to the writers, the writers
+# send them at their keyframe time (time.monotonic based). pause, resume, seek and stop take effect
+# at the next tick in the order they were requested, batches handed over but not yet written are cancelled.
+# an all servos stop halts the player at once (see halt).
+# gesture file gestures/<name>.json:
+#   {"unit": "degrees"|"position",
+#    "keyframes": [{"time": <ms from gesture start>, "duration": <move ms>, "targets": {servoName: value, ..}}, ..]}
+import os
+import time
+import bisect
+import threading
+import collections
+import simplejson as json
+
+import config
+import arduinoSend
+import arduinoWriter
+
+IDLE = 'idle'
+PLAYING = 'playing'
+PAUSED = 'paused'
+
+
+class KeyframeBatch:
+
+    def __init__(self, keyframeIndex, timeMs, moveRequests):
+        self.keyframeIndex = keyframeIndex
+        self.timeMs = timeMs
+        self.moveRequests = moveRequests
+        self.commands = [(request['msg'], request['command'], request['servoName']) for request in moveRequests]
+
+
+class CompiledGesture:
+
+    def __init__(self, name):
+        self.name = name
+        self.keyframeTimes = []     # ms from gesture start
+        self.keyframeTargets = []   # per keyframe list of (servoName, position)
+        self.boards = {}            # arduinoIndex -> list of KeyframeBatch sorted by time
+        self.boardTimes = {}        # arduinoIndex -> list of batch times, for seeking
+        self.endMs = 0.0
+        self.servoNames = set()
+        self.warnings = []
+
+
+gestureCache = {}   # fileName -> (mtime, parsed gesture)
+
+
+def loadGesture(gestureName):
+    """
+    :return: parsed gesture file, reused while the file is unchanged
+    """
+    fileName = os.path.join(config.gestureDir, f"{gestureName}.json")
+    mtime = os.stat(fileName).st_mtime
+    cached = gestureCache.get(fileName)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(fileName, 'r') as infile:
+        gesture = json.load(infile)
+    gestureCache[fileName] = (mtime, gesture)
+    return gesture
+
+
+def compileGesture(gestureName, gesture, startPositions):
+    """
+    :param startPositions: servoName -> position at the start of the gesture
+    :return: (CompiledGesture, problems), a gesture with problems must not be played
+    """
+    compiled = CompiledGesture(gestureName)
+    unit = gesture.get('unit', 'degrees')
+    lastPositions = dict(startPositions)
+    problems = []
+    keyframes = sorted(gesture['keyframes'], key=lambda keyframe: keyframe['time'])
+    for keyframeIndex, keyframe in enumerate(keyframes):
+        timeMs = float(keyframe['time'])
+        duration = float(keyframe.get('duration', 500))
+        positions, keyframeProblems = arduinoSend.targetPositions(keyframe['targets'], unit)
+        problems.extend(f"keyframe {keyframeIndex}: {problem}" for problem in keyframeProblems)
+
+        compiled.keyframeTimes.append(timeMs)
+        compiled.keyframeTargets.append([(servoName, position) for servoName, _, position in positions])
+        moveRequests = {}
+        for servoName, servoStatic, position in positions:
+            fromPos = lastPositions[servoName]
+            lastPositions[servoName] = position
+            deltaPos = abs(fromPos - position)
+            if deltaPos < 2:
+                continue
+            minDuration = config.servoDerivedDictLocal[servoName].msPerPos * deltaPos
+            if duration < minDuration:
+                compiled.warnings.append(f"keyframe {keyframeIndex}: {servoName} needs {minDuration:.0f} ms")
+            moveDuration = min(max(duration, minDuration), 9999)
+            moveRequests.setdefault(servoStatic.arduinoIndex, []).append(
+                arduinoSend.buildMoveRequest(servoName, servoStatic, fromPos, position, moveDuration,
+                                             int(100 * minDuration / moveDuration) / 100))
+            compiled.servoNames.add(servoName)
+            compiled.endMs = max(compiled.endMs, timeMs + moveDuration)
+
+        for arduinoIndex, requests in moveRequests.items():
+            compiled.boards.setdefault(arduinoIndex, []).append(KeyframeBatch(keyframeIndex, timeMs, requests))
+    compiled.boardTimes = {arduinoIndex: [batch.timeMs for batch in batches] for arduinoIndex, batches in compiled.boards.items()}
+    return compiled, problems
+
+
+class GesturePlayer:
+
+    def __init__(self, lookahead=0.1, tick=0.02, seekDuration=800):
+        """
+        :param lookahead: seconds before its keyframe time a batch is handed to the writer
+        :param tick: max seconds between checks of the player state
+        :param seekDuration: ms to move the servos to the pose at the seek time
+        """
+        self.lookahead = lookahead
+        self.tick = tick
+        self.seekDuration = seekDuration
+        self.condition = threading.Condition()
+        self.state = IDLE
+        self.gesture = None
+        self.startTime = 0.0        # time.monotonic of gesture time 0
+        self.pausedMs = 0.0
+        self.nextBatch = {}         # arduinoIndex -> index of the next batch to hand over
+        self.inFlight = []          # handed over batches, cancelled on pause, seek and stop
+        self.controls = collections.deque()     # (action, value), applied by the player thread at the next tick
+        self.halted = False         # no batches are handed over until the halt control is applied
+        self.nextDue = None         # seconds until the next batch is to be handed over
+        self.timingErrors = {}      # keyframeIndex -> {arduinoIndex: ms late}
+        self.lastReport = None
+
+    def play(self, gestureName):
+        """
+        :return: list of problems, empty if the gesture was started
+        """
+        try:
+            gesture = loadGesture(gestureName)
+        except (OSError, ValueError) as e:
+            return [f"could not load gesture {gestureName}, {e}"]
+        startPositions = {servoName: servoCurrent.currentPosition for servoName, servoCurrent in config.servoCurrentDictLocal.items()}
+        compiled, problems = compileGesture(gestureName, gesture, startPositions)
+        if len(problems) > 0:
+            return problems
+        for warning in compiled.warnings:
+            config.log(f"gesture {gestureName}, {warning}", category='gesture')
+        self._setControl('play', compiled)
+        return []
+
+    def pause(self):
+        self._setControl('pause')
+
+    def resume(self):
+        self._setControl('resume')
+
+    def seek(self, timeMs):
+        self._setControl('seek', timeMs)
+
+    def stop(self):
+        self._setControl('stop')
+
+    def halt(self):
+        """
+        all servos stop: cancel the handed over batches right away, called by the request thread
+        pending controls are dropped, the gesture ends at the next tick
+        """
+        with self.condition:
+            self.halted = True
+            self.controls.clear()
+            self.controls.append(('halt', None))
+            self._cancelInFlight()
+            self.condition.notify()
+
+    def _setControl(self, action, value=None):
+        with self.condition:
+            self.controls.append((action, value))
+            self.condition.notify()
+
+    def _cancelInFlight(self):
+        with self.condition:
+            for batch in self.inFlight:
+                batch.cancelled = True
+            self.inFlight = []
+
+    def _position(self, timeMs):
+        # first batch of every board at or after timeMs
+        self.nextBatch = {arduinoIndex: bisect.bisect_left(times, timeMs) for arduinoIndex, times in self.gesture.boardTimes.items()}
+
+    def _applyControl(self, action, value, now):
+        if action == 'play':
+            if self.gesture is not None:
+                self._cancelInFlight()
+                self._finish('replaced')
+            self.gesture = value
+            with self.condition:
+                self.timingErrors = {}
+            self._position(0.0)
+            self.startTime = now + self.lookahead
+            self.state = PLAYING
+            config.log(f"gesture {self.gesture.name} started, {len(self.gesture.keyframeTimes)} keyframes, {self.gesture.endMs / 1000:.1f} s")
+        elif self.gesture is None:
+            return
+        elif action == 'pause' and self.state == PLAYING:
+            self._cancelInFlight()
+            self._stopMoving()
+            self.pausedMs = (now - self.startTime) * 1000
+            self._position(self.pausedMs)
+            self.state = PAUSED
+            config.log(f"gesture {self.gesture.name} paused at {self.pausedMs:.0f} ms")
+        elif action == 'resume' and self.state == PAUSED:
+            self.startTime = now - self.pausedMs / 1000
+            self.state = PLAYING
+            config.log(f"gesture {self.gesture.name} resumed at {self.pausedMs:.0f} ms")
+        elif action == 'seek':
+            self._cancelInFlight()
+            self._moveToPose(value)
+            self._position(value)
+            self.startTime = now + self.seekDuration / 1000 - value / 1000
+            self.pausedMs = value
+            config.log(f"gesture {self.gesture.name} seek to {value:.0f} ms")
+        elif action == 'halt':
+            # the servos were stopped by the all servos stop
+            self._cancelInFlight()
+            self._finish('stopped')
+        elif action == 'stop':
+            self._cancelInFlight()
+            self._stopMoving()
+            self._finish('stopped')
+
+    def _stopMoving(self):
+        # the written keyframes keep the servos moving until their targets are reached
+        for servoName in self.gesture.servoNames:
+            if config.servoCurrentDictLocal[servoName].moving:
+                arduinoSend.requestServoStop(servoName)
+
+    def _moveToPose(self, timeMs):
+        """
+        move the gesture servos to their last keyframe target before timeMs
+        """
+        targets = {}
+        for keyframeTime, keyframeTargets in zip(self.gesture.keyframeTimes, self.gesture.keyframeTargets):
+            if keyframeTime >= timeMs:
+                break
+            targets.update(keyframeTargets)
+        moveRequests, _ = arduinoSend.preparePoseMoves(targets, 'position', self.seekDuration)
+        if len(moveRequests) > 0:
+            config.moveScheduler.startGroup(moveRequests)
+
+    def _handOver(self, now):
+        """
+        hand the batches due within the lookahead window to the writers
+        :return: seconds until the next batch is due, None if all batches were handed over
+        """
+        horizonMs = (now + self.lookahead - self.startTime) * 1000
+        nextDue = None
+        for arduinoIndex, batches in self.gesture.boards.items():
+            index = self.nextBatch[arduinoIndex]
+            while index < len(batches) and batches[index].timeMs <= horizonMs:
+                self._stage(arduinoIndex, batches[index])
+                index += 1
+            self.nextBatch[arduinoIndex] = index
+            if index < len(batches):
+                due = self.startTime + batches[index].timeMs / 1000 - self.lookahead - now
+                nextDue = due if nextDue is None else min(nextDue, due)
+        return nextDue
+
+    def _stage(self, arduinoIndex, keyframeBatch):
+        writer = config.arduinoWriters[arduinoIndex]
+        if writer is None:
+            config.log(f"no connection with arduino {arduinoIndex}, gesture keyframe {keyframeBatch.keyframeIndex} dropped")
+            return
+        notBefore = self.startTime + keyframeBatch.timeMs / 1000
+        onSent = lambda arduinoIndex, firstWrite, lastWrite: self._batchSent(keyframeBatch, notBefore, arduinoIndex, firstWrite)
+        batch = arduinoWriter.ScheduledBatch(list(keyframeBatch.commands), notBefore, onSent)
+        with self.condition:
+            if self.halted:
+                return
+            self.inFlight = [inFlight for inFlight in self.inFlight if inFlight.notBefore > time.monotonic() - 1] + [batch]
+            writer.putBatch(batch)
+
+        for request in keyframeBatch.moveRequests:
+            servoName = request['servoName']
+            servoCurrent = config.servoCurrentDictLocal[servoName]
+            servoCurrent.timeOfLastMoveRequest = time.time()
+            servoCurrent.targetPosition = request['toPos']
+            if servoName in config.servoFeedbackDictLocal:
+                config.feedbackRecorder.startMove(servoName, servoCurrent.currentPosition, request['toPos'], request['speedRate'])
+
+    def _batchSent(self, keyframeBatch, notBefore, arduinoIndex, firstWrite):
+        # called by the writer threads
+        lateMs = (firstWrite - notBefore) * 1000
+        with self.condition:
+            self.timingErrors.setdefault(keyframeBatch.keyframeIndex, {})[arduinoIndex] = lateMs
+        config.log("gesture keyframe %d, arduino %d, %.1f ms late", keyframeBatch.keyframeIndex, arduinoIndex, lateMs, category='gesture')
+
+    def _finish(self, state):
+        with self.condition:
+            timingErrors = sorted((keyframeIndex, dict(keyframeErrors)) for keyframeIndex, keyframeErrors in self.timingErrors.items())
+        errors = [lateMs for _, keyframeErrors in timingErrors for lateMs in keyframeErrors.values()]
+        self.lastReport = {'gesture': self.gesture.name, 'state': state,
+                           'keyframes': dict(timingErrors),
+                           'meanLateMs': sum(errors) / len(errors) if len(errors) > 0 else 0.0,
+                           'maxLateMs': max(errors) if len(errors) > 0 else 0.0}
+        config.log(f"gesture {self.gesture.name} {state}, {len(timingErrors)} keyframes sent, "
+                   f"late mean {self.lastReport['meanLateMs']:.1f} ms, max {self.lastReport['maxLateMs']:.1f} ms")
+        self.gesture = None
+        self.state = IDLE
+        self.nextDue = None
+
+    def stats(self):
+        return {'state': self.state, 'gesture': self.gesture.name if self.gesture is not None else None,
+                'lastReport': self.lastReport}
+
+    def run(self):
+        config.log(f"gesturePlayer started")
+        while True:
+            with self.condition:
+                if len(self.controls) == 0:
+                    timeout = None
+                    if self.state == PLAYING:
+                        timeout = self.tick if self.nextDue is None else min(self.tick, max(self.nextDue, 0.0))
+                    self.condition.wait(timeout)
+                controls = list(self.controls)
+                self.controls.clear()
+            now = time.monotonic()
+            for action, value in controls:
+                self._applyControl(action, value, now)
+                if action == 'halt':
+                    with self.condition:
+                        self.halted = False
+            if self.state != PLAYING:
+                continue
+
+            self.nextDue = self._handOver(now)
+            if self.nextDue is None and now > self.startTime + self.gesture.endMs / 1000:
+                self._finish('completed')
+
+
+def runGesturePlayer():
+    config.gesturePlayer.run()
@@ -0,0 +1,43 @@
+
+# local stand-in for marvinglobal.marvinShares
+# used with the arduino emulator to run skeletonControl without a running marvinData process
+import time
+import queue
+
+from marvinglobal import marvinglobal as mg
+
+
+class MarvinSharesLocal:
+
+    def __init__(self):
+        self.processDict = {}
+        self.servoDict = {item: {} for item in mg.SharedDataItems}
+        self.arduinoDict = {}
+        self.skeletonRequestQueue = queue.Queue()
+        self.ikUpdateQueue = queue.Queue()
+        self.updateCount = 0
+
+    def sharedDataConnect(self, processName):
+        return True
+
+    def updateProcessDict(self, processName):
+        self.processDict.update({processName: {'lastUpdate': time.time()}})
+
+    def removeProcess(self, processName):
+        self.processDict.pop(processName, None)
+
+    def updateSharedData(self, msg):
+        """
+        keep the data of the update messages in the same structure marvinData would
+        :return: always True, the local connection can not get lost
+        """
+        self.updateCount += 1
+        msgType = msg['msgType']
+        info = msg['info']
+        if msgType == mg.SharedDataItems.ARDUINO:
+            self.arduinoDict.update({info['arduinoIndex']: info['data']})
+        elif 'servoName' in info:
+            self.servoDict[msgType].update({info['servoName']: info['data']})
+        elif 'type' in info:
+            self.servoDict[msgType].update({info['type']: info['data']})
+        return True
@@ -0,0 +1,220 @@
+
+# link health and controller metrics
+# counters updated on the hot paths (status frames per servo, shared data updates) live in per thread
+# ThreadCounters, only the owning thread writes them, no locks. other metrics are read at scrape time
+# from the single writer stats of the owning objects through collectors (frame parsers, writers, buffers).
+# the merged metrics are served in prometheus text format on a local http socket and published
+# periodically to marvinData as part of the arduino entries (key 'metrics')
+import time
+import threading
+import http.server
+
+import config
+from marvinglobal import marvinglobal as mg
+
+# name -> (type, help, label names)
+METRICS = {
+    'skeleton_serial_bytes_received_total': ('counter', "bytes received from the arduino", ('board',)),
+    'skeleton_serial_frames_received_total': ('counter', "frames received from the arduino", ('board', 'kind')),
+    'skeleton_serial_decode_errors_total': ('counter', "received frames that could not be decoded", ('board', 'reason')),
+    'skeleton_serial_bytes_sent_total': ('counter', "bytes written to the arduino", ('board',)),
+    'skeleton_serial_frames_sent_total': ('counter', "serial writes to the arduino", ('board',)),
+    'skeleton_serial_commands_sent_total': ('counter', "commands written to the arduino", ('board',)),
+    'skeleton_serial_queue_depth': ('gauge', "commands waiting in the outbound queue", ('board',)),
+    'skeleton_serial_queue_wait_seconds_total': ('counter', "time commands waited in the outbound queue", ('board',)),
+    'skeleton_serial_pacing_wait_seconds_total': ('counter', "time the writer waited for the pacing", ('board',)),
+    'skeleton_servo_status_frames_total': ('counter', "status frames received per servo", ('servo',)),
+    'skeleton_move_buffer_depth': ('gauge', "sequential move requests waiting in the move request buffer", ()),
+    'skeleton_move_buffer_active_servos': ('gauge', "servos executing a buffered move", ()),
+    'skeleton_shared_updates_total': ('counter', "updates sent to marvinData", ('item',)),
+    'skeleton_shared_update_seconds_total': ('counter', "round trip time of the updates sent to marvinData", ('item',)),
+}
+
+
+class ThreadCounters:
+    """
+    counters of one thread, (name, label values) -> value
+    only the owning thread writes, the scrape merges a copy
+    """
+
+    def __init__(self, threadName):
+        self.threadName = threadName
+        self.values = {}
+
+    def inc(self, name, labelValues=(), amount=1):
+        key = (name, labelValues)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = config.metricsExporter.prometheusText().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter:
+
+    def __init__(self, host="127.0.0.1", port=9110, snapshotInterval=5.0):
+        """
+        :param port: local http port of the prometheus endpoint, 0 to not serve http
+        :param snapshotInterval: seconds between the snapshots published to marvinData, 0 for none
+        """
+        self.host = host
+        self.port = port
+        self.snapshotInterval = snapshotInterval
+        self.local = threading.local()
+        self.threadCounters = []
+        self.collectors = []        # functions returning [(name, label values, value)]
+        self.lock = threading.Lock()    # registration of threads and collectors only
+        self.lastSnapshot = None    # (monotonic time, merged values) for the rates
+        self.server = None
+
+        # stats
+        self.scrapes = 0
+        self.snapshotsPublished = 0
+
+    def counters(self):
+        """
+        :return: the ThreadCounters of the calling thread
+        """
+        counters = getattr(self.local, 'counters', None)
+        if counters is None:
+            counters = self.local.counters = ThreadCounters(threading.current_thread().name)
+            with self.lock:
+                self.threadCounters.append(counters)
+        return counters
+
+    def addCollector(self, collector):
+        with self.lock:
+            if collector not in self.collectors:
+                self.collectors.append(collector)
+
+    def collect(self):
+        """
+        :return: (name, label values) -> value, thread counters summed over the threads
+        """
+        with self.lock:
+            threadCounters = list(self.threadCounters)
+            collectors = list(self.collectors)
+        merged = {}
+        for counters in threadCounters:
+            for key, value in dict(counters.values).items():
+                merged[key] = merged.get(key, 0) + value
+        for collector in collectors:
+            try:
+                for name, labelValues, value in collector():
+                    key = (name, labelValues)
+                    merged[key] = merged.get(key, 0) + value
+            except Exception as e:
+                config.log(f"metrics collector {collector} failed, {e}")
+        return merged
+
+    def prometheusText(self):
+        self.scrapes += 1
+        byName = {}
+        for (name, labelValues), value in self.collect().items():
+            byName.setdefault(name, []).append((labelValues, value))
+        lines = []
+        for name in sorted(byName):
+            metricType, helpText, labelNames = METRICS.get(name, ('untyped', name, ()))
+            lines.append(f"# HELP {name} {helpText}")
+            lines.append(f"# TYPE {name} {metricType}")
+            for labelValues, value in sorted(byName[name]):
+                lines.append(f"{name}{self._labels(labelNames, labelValues)} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(labelNames, labelValues):
+        if len(labelValues) == 0:
+            return ""
+        labels = ','.join(f'{labelName}="{str(labelValue)}"' for labelName, labelValue in zip(labelNames, labelValues))
+        return "{" + labels + "}"
+
+    def snapshot(self):
+        """
+        :return: 'name{labels}' -> value and the per second rates of the counters since the previous snapshot
+        """
+        now = time.monotonic()
+        merged = self.collect()
+        rates = {}
+        if self.lastSnapshot is not None:
+            previousTime, previous = self.lastSnapshot
+            elapsed = max(now - previousTime, 1e-3)
+            for key, value in merged.items():
+                if METRICS.get(key[0], ('untyped',))[0] == 'counter':
+                    rates[key] = (value - previous.get(key, 0)) / elapsed
+        self.lastSnapshot = (now, merged)
+        return merged, rates
+
+    def boardOf(self, name, labelValues):
+        """
+        :return: arduino index a series belongs to, None for controller wide series
+        """
+        labelNames = METRICS.get(name, ('untyped', name, ()))[2]
+        labels = dict(zip(labelNames, labelValues))
+        if 'board' in labels:
+            return int(labels['board'])
+        if 'servo' in labels and labels['servo'] in config.servoStaticDictLocal:
+            return config.servoStaticDictLocal[labels['servo']].arduinoIndex
+        return None
+
+    def publishSnapshot(self):
+        """
+        add the metrics of each board and the controller wide metrics to the arduino entries of marvinData
+        """
+        merged, rates = self.snapshot()
+        boardMetrics = {arduinoIndex: {'time': time.time(), 'values': {}, 'rates': {}}
+                        for arduinoIndex in config.arduinoDictLocal}
+        for series, target in ((merged, 'values'), (rates, 'rates')):
+            for (name, labelValues), value in series.items():
+                board = self.boardOf(name, labelValues)
+                seriesName = name + self._labels(METRICS.get(name, ('untyped', name, ()))[2], labelValues)
+                for arduinoIndex, metrics in boardMetrics.items():
+                    if board is None or board == arduinoIndex:
+                        metrics[target][seriesName] = value
+        for arduinoIndex, metrics in boardMetrics.items():
+            config.arduinoDictLocal[arduinoIndex]['metrics'] = metrics
+            config.updateSharedDict({'msgType': mg.SharedDataItems.ARDUINO, 'sender': config.processName,
+                                     'info': {'arduinoIndex': arduinoIndex, 'data': config.arduinoDictLocal[arduinoIndex]}})
+        self.snapshotsPublished += 1
+
+    def startServer(self):
+        try:
+            self.server = http.server.ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        except OSError as e:
+            config.log(f"metrics endpoint http://{self.host}:{self.port}/metrics not available, {e}")
+            return
+        self.server.daemon_threads = True
+        serverThread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        serverThread.name = "metricsServer"
+        serverThread.start()
+        config.log(f"metrics endpoint http://{self.host}:{self.server.server_address[1]}/metrics")
+
+    def stats(self):
+        return {'scrapes': self.scrapes, 'snapshotsPublished': self.snapshotsPublished,
+                'threads': [counters.threadName for counters in self.threadCounters], 'collectors': len(self.collectors)}
+
+    def run(self):
+        if self.port > 0:
+            self.startServer()
+        if self.snapshotInterval <= 0:
+            return
+        while True:
+            time.sleep(self.snapshotInterval)
+            if config.marvinShares is not None:
+                self.publishSnapshot()
+
+
+def runMetricsExporter():
+    config.metricsExporter.run()
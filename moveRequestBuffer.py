@@ -1,85 +1,194 @@
 
 import time
+import threading
+import collections
 import config
 import arduinoSend
-import feedbackServo
+import trajectoryBlending
 #from marvinglobal import marvinglobal as mg
 
-class MoveRequestBuffer:
+class Blend:
+
+    def __init__(self, finalPos, finalTime, deadline, groups, segments):
+        self.finalPos = finalPos
+        self.finalTime = finalTime      # time.monotonic the last waypoint is sent
+        self.deadline = deadline        # time.monotonic the blend ends even if the servo stopped short of finalPos
+        self.groups = groups            # moveScheduler groups of the waypoints
+        self.segments = segments
 
-    def __init__(self, verbose:bool=False):
-        self.servoRequestList = []
-        self.servoActiveList = []
+
+class MoveRequestBuffer:
+    """
+    sequential move requests, one fifo per servo
+    a servo is active from sending its move until the arduino reports target reached,
+    the next request of the servo is sent when it gets inactive
+    with blend set, two or more queued moves of a servo are joined into one continuous motion
+    (see trajectoryBlending), the servo stays active until the last target is reached
+    """
+    def __init__(self, verbose:bool=False, blend:bool=False, maxBlendSegments=8, waypointInterval=0.2, waypointLead=0.03,
+                 blendGrace=0.5):
+        """
+        :param waypointInterval: seconds between the waypoints of a blended motion
+        :param waypointLead: seconds a waypoint is sent before the previous one ends
+        :param blendGrace: seconds after its planned end a blend ends without the final target reached
+        """
+        self.servoRequests = {}         # servoName -> deque of requests
+        self.servoActive = set()
+        self.readyServos = set()        # servos with buffered requests that are not active
+        self.lock = threading.Lock()
+        self.requestsReady = threading.Condition(self.lock)
         self.verbose = verbose
         self.superVerbose = False
         self.unbufferedServos = ['head.jaw']
+        self.blend = blend
+        self.maxBlendSegments = maxBlendSegments
+        self.waypointInterval = waypointInterval
+        self.waypointLead = waypointLead
+        self.blendGrace = blendGrace
+        self.blends = {}                # servoName -> Blend in progress, access with lock held
+
+        # stats
+        self.blendsStarted = 0
+        self.segmentsBlended = 0
+        self.waypointsSent = 0
+        self.blendsExpired = 0
 
     def clearServoActiveList(self):
-        if self.verbose: config.log(f"cleared servoActiveList {self.servoActiveList=}")
-        self.servoActiveList.clear()
+        self.cancelBlends()
+        with self.lock:
+            if self.verbose: config.log(f"cleared servoActive {self.servoActive=}", category='moveBuffer')
+            self.servoActive.clear()
+            self._updateReady()
 
     def setServoActive(self, servoName):
         if servoName in self.unbufferedServos:
-            if self.verbose: config.log(f"set request for servo that is in the exclude list")
+            if self.verbose: config.log(f"set request for servo that is in the exclude list", category='moveBuffer')
             return
 
-        self.servoActiveList.append(servoName)
+        with self.lock:
+            self.servoActive.add(servoName)
+            self.readyServos.discard(servoName)
 
-        if self.verbose: config.log(f"added {servoName} to servoActive list")
-        if self.superVerbose: config.log(f"{self.servoActiveList=}")
+        if self.verbose: config.log(f"added {servoName} to servoActive list", category='moveBuffer')
+        if self.superVerbose: config.log(f"{self.servoActive=}", category='moveBuffer')
 
     def isServoActive(self, servoName):
-        return servoName in self.servoActiveList
+        return servoName in self.servoActive
 
     def setServoInactive(self, servoName):
         if servoName in self.unbufferedServos:
-            if self.superVerbose: config.log(f"set inactive request for servo that is in the exclude list")
+            if self.superVerbose: config.log(f"set inactive request for servo that is in the exclude list", category='moveBuffer')
             return
 
-        if servoName not in self.servoActiveList:
-            if self.verbose: config.log(f"servoActiveList: remove servo {servoName} failed, not in list")
-        else:
-            self.servoActiveList.remove(servoName)
-            if self.verbose: config.log(f"removed {servoName} from servoActive list")
-            if self.superVerbose: config.log(f"{self.servoActiveList=}")
+        with self.lock:
+            # a blended motion ends with the last target, waypoints reached on the way do not count
+            blend = self.blends.get(servoName)
+            if blend is not None:
+                now = time.monotonic()
+                currentPosition = config.servoCurrentDictLocal[servoName].currentPosition
+                if now < blend.finalTime or (abs(currentPosition - blend.finalPos) > 2 and now < blend.deadline):
+                    return
+                del self.blends[servoName]
+
+            if servoName not in self.servoActive:
+                if self.verbose: config.log(f"servoActive: remove servo {servoName} failed, not in list", category='moveBuffer')
+                return
+            self.servoActive.remove(servoName)
 
             # check for more requests in request list for this servo
-            if self.verbose: config.log(f"{self.servoRequestList=}")
-            moreRequests = any(request['servoName'] for request in self.servoRequestList if request['servoName'] == servoName)
-            if not moreRequests:
-                servoCurrentLocal = config.servoCurrentDictLocal[servoName]
-                servoCurrentLocal.inRequestList = False
-                config.updateSharedServoCurrent(servoName, servoCurrentLocal)
-
+            moreRequests = len(self.servoRequests.get(servoName, ())) > 0
+            if moreRequests:
+                self.readyServos.add(servoName)
+                self.requestsReady.notify()
+
+        if self.verbose: config.log(f"removed {servoName} from servoActive list, more requests: {moreRequests}", category='moveBuffer')
+        if self.superVerbose: config.log(f"{self.servoActive=}", category='moveBuffer')
+
+        if not moreRequests:
+            servoCurrentLocal = config.servoCurrentDictLocal[servoName]
+            servoCurrentLocal.inRequestList = False
+            config.updateSharedServoCurrent(servoName, servoCurrentLocal)
+
+
+    def _updateReady(self):
+        # call with lock held
+        self.readyServos = {servoName for servoName, requests in self.servoRequests.items()
+                            if len(requests) > 0 and servoName not in self.servoActive}
+        if len(self.readyServos) > 0:
+            self.requestsReady.notify()
+
+
+    def cancelBlend(self, servoName):
+        with self.lock:
+            blend = self.blends.pop(servoName, None)
+        if blend is not None:
+            for group in blend.groups:
+                config.moveScheduler.cancel(group)
+
+    def cancelBlends(self):
+        with self.lock:
+            servoNames = list(self.blends)
+        for servoName in servoNames:
+            self.cancelBlend(servoName)
+
+    def expireBlends(self):
+        """
+        end the blends of servos that stopped short of their final target, called by the monitor thread
+        :return: seconds until the next blend deadline, None without blends
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [servoName for servoName, blend in self.blends.items() if now >= blend.deadline]
+            remaining = [blend.deadline - now for blend in self.blends.values() if now < blend.deadline]
+        for servoName in expired:
+            self.blendsExpired += 1
+            config.log("blend %s did not reach its final target in time, ended", servoName, category='moveBuffer')
+            self.setServoInactive(servoName)
+        return min(remaining) if len(remaining) > 0 else None
 
     def clearBuffer(self):
-        self.servoRequestList.clear()
+        self.cancelBlends()
+        with self.lock:
+            self.servoRequests.clear()
+            self.readyServos.clear()
 
 
     def isRequestListEmpty(self):
-        return len(self.servoRequestList) == 0
+        return not any(len(requests) > 0 for requests in list(self.servoRequests.values()))
+
+
+    def requestCount(self):
+        return sum(len(requests) for requests in list(self.servoRequests.values()))
 
 
     def printRequestList(self):
-        config.log(f"{self.servoRequestList=}")
+        with self.lock:
+            config.log(f"{self.servoRequests=}", category='moveBuffer')
 
 
     def addMoveRequest(self, request):
 
         servoName = request['servoName']
         if servoName in self.unbufferedServos:
-            if self.verbose: config.log(f"add request for servo that is in the moveRequestBuffer exclude list")
+            if self.verbose: config.log(f"add request for servo that is in the moveRequestBuffer exclude list", category='moveBuffer')
 
-            config.log(f"send request directly to arduino {request=}")
-            arduinoSend.sendArduinoCommand(request['arduino'], request['msg'])
+            config.log("send request directly to arduino %s", request, category='moveBuffer')
+            config.requestTracer.dispatch(servoName, config.requestTracer.admit(servoName))
+            arduinoSend.sendArduinoCommand(request['arduino'], request['msg'], request.get('command'), servoName)
 
             return
 
-        self.servoRequestList.append(request)
+        request['trace'] = config.requestTracer.admit(servoName)
+        with self.lock:
+            self.servoRequests.setdefault(servoName, collections.deque()).append(request)
+            if servoName not in self.servoActive:
+                self.readyServos.add(servoName)
+                self.requestsReady.notify()
+
         servoCurrentLocal = config.servoCurrentDictLocal[servoName]
         servoCurrentLocal.inRequestList = True
         config.updateSharedServoCurrent(servoName, servoCurrentLocal)
-        if self.verbose: config.log(f"addMoveToRequestList {request} ")
+        if self.verbose: config.log(f"addMoveToRequestList {request} ", category='moveBuffer')
 
 
     def removeServoFromRequestList(self, servoName):
@@ -89,60 +198,146 @@ class MoveRequestBuffer:
         :return:
         """
         if servoName in self.unbufferedServos:
-            if self.verbose: config.log(f"remove request for servo that is in the moveRequestBuffer exclude list")
+            if self.verbose: config.log(f"remove request for servo that is in the moveRequestBuffer exclude list", category='moveBuffer')
             return
 
-        if self.verbose: config.log(f"remove servo from moveRequestBuffer {servoName:20s}, {self.servoRequestList=}")
-
-        for index, item in enumerate(self.servoRequestList):
-            if item['servoName'] == servoName:
-                self.servoRequestList.pop(index)
-                if self.verbose: config.log(f"request removed {index=}: {self.servoRequestList=}")
+        self.cancelBlend(servoName)
+        with self.lock:
+            removed = self.servoRequests.pop(servoName, ())
+            self.readyServos.discard(servoName)
+        for request in removed:
+            config.requestTracer.drop(request.get('trace'))
+        if self.verbose: config.log(f"removed {len(removed)} requests of {servoName:20s} from moveRequestBuffer", category='moveBuffer')
 
         self.setServoInactive(servoName)
-        if self.verbose: config.log(f"{self.servoActiveList=}")
+        if self.verbose: config.log(f"{self.servoActive=}", category='moveBuffer')
 
 
-    def checkForExecutableRequests(self):
+    def waitForExecutableRequests(self, timeout=None):
         """
-        sequential move requests are dequeued from the buffered list when servo is not moving
-        :return:
+        block until a buffered request can be sent (or timeout)
         """
-        if self.superVerbose: config.log(f"check for executable request")
-
-        listChanged = True
-        while listChanged:
-            listChanged = False
-            for index, item in enumerate(self.servoRequestList):
-
-                # if more than 1 request for servo in list use only the first one
-                if not self.isServoActive(item['servoName']):
-                    servoName = item['servoName']
-
-                    # for move requests update servoCurrentLocal
-                    servoCurrent = config.servoCurrentDictLocal[servoName]
-                    servoCurrent.timeOfLastMoveRequest = time.time()
-                    servoCurrent.targetPosition = item['toPos']
-
-                    self.setServoActive(servoName)
-                    config.log(f"send request to arduino {item=}")
-                    arduinoSend.sendArduinoCommand(item['arduino'], item['msg'])
-                    config.log(f"{len(self.servoRequestList)=}, {index=}")
+        with self.lock:
+            if len(self.readyServos) == 0:
+                self.requestsReady.wait(timeout)
+            return len(self.readyServos) > 0
 
-                    # check for feedback servo
-                    if servoName in config.servoFeedbackDictLocal:
-                        feedbackServo.clearPositionList(item['servoName'], item['fromPos'], item['toPos'], item['speedRate'])
 
-                    try:
-                        self.servoRequestList.pop(index)
-                    except Exception as e:
-                        config.log(f"exception in servoRequestList")
-                    listChanged = True
-                    if self.superVerbose: config.log(f"remaining requests: {self.servoRequestList=}")
-                    break
+    def checkForExecutableRequests(self):
+        """
+        sequential move requests are dequeued from the buffer when servo is not moving
+        :return: number of requests sent
+        """
+        if self.superVerbose: config.log(f"check for executable request", category='moveBuffer')
+
+        # take the next request of every ready servo and mark the servo active
+        with self.lock:
+            executable = []
+            blendable = []
+            for servoName in self.readyServos:
+                requests = self.servoRequests.get(servoName)
+                if not requests:
+                    continue
+                self.servoActive.add(servoName)
+                # feedback servos follow their own planned positions on the arduino, they are not blended
+                if self.blend and len(requests) > 1 and servoName not in config.servoFeedbackDictLocal:
+                    blendable.append([requests.popleft() for _ in range(min(len(requests), self.maxBlendSegments))])
+                else:
+                    executable.append(requests.popleft())
+            self.readyServos.clear()
+
+        for segments in blendable:
+            self._startBlend(segments)
+
+        for item in executable:
+            servoName = item['servoName']
+
+            # for move requests update servoCurrentLocal
+            servoCurrent = config.servoCurrentDictLocal[servoName]
+            servoCurrent.timeOfLastMoveRequest = time.time()
+            servoCurrent.targetPosition = item['toPos']
+
+            if self.verbose: config.log(f"added {servoName} to servoActive list", category='moveBuffer')
+            config.log("send request to arduino %s", item, category='moveBuffer')
+            config.requestTracer.dispatch(servoName, item.get('trace'))
+            arduinoSend.sendArduinoCommand(item['arduino'], item['msg'], item.get('command'), servoName)
+
+            # check for feedback servo
+            if servoName in config.servoFeedbackDictLocal:
+                config.feedbackRecorder.startMove(servoName, item['fromPos'], item['toPos'], item['speedRate'])
+
+        if self.superVerbose: config.log(f"remaining requests: {self.requestCount()}", category='moveBuffer')
+        return len(executable) + len(blendable)
+
+
+    def _startBlend(self, segments):
+        """
+        send the segments as one continuous motion, each waypoint is scheduled to reach the arduino
+        waypointLead before the previous waypoint ends
+        """
+        servoName = segments[0]['servoName']
+        servoStatic = config.servoStaticDictLocal[servoName]
+        servoDerived = config.servoDerivedDictLocal[servoName]
+        fromPos = config.servoCurrentDictLocal[servoName].currentPosition
+
+        # the segments were prepared from the position at request time, drop the ones without a move now
+        moves = []
+        previousPos = fromPos
+        for segment in segments:
+            if abs(segment['toPos'] - previousPos) >= 2:
+                moves.append(segment)
+                previousPos = segment['toPos']
+            else:
+                config.requestTracer.drop(segment.get('trace'))
+        if len(moves) == 0:
+            # marks the remaining queued requests of the servo ready
+            self.setServoInactive(servoName)
+            return
+        segments = moves
+        for segment in segments:
+            config.requestTracer.dispatch(servoName, segment.get('trace'))
+
+        times, positions = trajectoryBlending.planBlend(fromPos, [segment['toPos'] for segment in segments],
+                                                        [segment['duration'] for segment in segments],
+                                                        servoDerived.msPerPos, intervalMs=self.waypointInterval * 1000)
+
+        start = time.monotonic()
+        groups = []
+        previousMs = 0.0
+        moveDuration = 0.0
+        for timeMs, position in zip(times.tolist(), positions.tolist()):
+            position = int(round(position))
+            sendTime = start + max(previousMs / 1000 - self.waypointLead, 0.0)
+            moveDuration = timeMs - (sendTime - start) * 1000
+            speedRate = min(1.0, int(100 * servoDerived.msPerPos * abs(position - fromPos) / moveDuration) / 100)
+            request = arduinoSend.buildMoveRequest(servoName, servoStatic, fromPos, position, moveDuration, speedRate)
+            groups.append(config.moveScheduler.addGroupAt([request], sendTime, quiet=True))
+            fromPos = position
+            previousMs = timeMs
+
+        # a servo stopping short (limit, load) reports no final target, the blend ends at the deadline
+        deadline = groups[-1].startTime + max(moveDuration, segments[-1]['duration']) / 1000 + self.blendGrace
+        with self.lock:
+            self.blends[servoName] = Blend(fromPos, groups[-1].startTime, deadline, groups, len(segments))
+        self.blendsStarted += 1
+        self.segmentsBlended += len(segments)
+        self.waypointsSent += len(groups)
+        config.log("blend %s, %d segments in %d waypoints, %.0f ms", servoName, len(segments), len(groups), times[-1], category='moveBuffer')
+
+    def stats(self):
+        return {'queued': self.requestCount(), 'active': len(self.servoActive), 'blending': len(self.blends),
+                'blendsStarted': self.blendsStarted, 'segmentsBlended': self.segmentsBlended, 'waypointsSent': self.waypointsSent,
+                'blendsExpired': self.blendsExpired}
+
+    def metrics(self):
+        return [('skeleton_move_buffer_depth', (), self.requestCount()),
+                ('skeleton_move_buffer_active_servos', (), len(self.servoActive))]
 
 
 def monitorMoveRequestBuffer():
+    # woken up by addMoveRequest and setServoInactive, the timeout is a safety net and the blend deadline check
     while True:
-        config.moveRequestBuffer.checkForExecutableRequests()
-        time.sleep(0.1)
\ No newline at end of file
+        nextDeadline = config.moveRequestBuffer.expireBlends()
+        timeout = 1.0 if nextDeadline is None else min(1.0, nextDeadline)
+        if config.moveRequestBuffer.waitForExecutableRequests(timeout=timeout):
+            config.moveRequestBuffer.checkForExecutableRequests()
@@ -0,0 +1,192 @@
+
+# time scheduled move groups
+# all moves of a group are prepared in advance and handed to the writer threads of both arduinos
+# as one batch each, the writers send them at the scheduled start time
+import time
+import heapq
+import itertools
+import threading
+import collections
+
+import config
+import arduinoSend
+import arduinoWriter
+import requestTracing
+
+
+class MoveGroup:
+
+    def __init__(self, groupId, startTime, moveRequests):
+        self.groupId = groupId
+        self.startTime = startTime          # time.monotonic
+        self.moveRequests = moveRequests    # prepared requests, see arduinoSend.prepareMoveRequest
+        self.writeTimes = {}                # arduinoIndex -> (firstWrite, lastWrite)
+        self.numBoards = len({request['arduino'] for request in moveRequests})
+        self.batches = []                   # batches handed to the writers
+        self.cancelled = False
+        self.quiet = False                  # no log entry when started (blend waypoints)
+
+
+class MoveScheduler:
+
+    def __init__(self, leadTime=0.1, verbose=False):
+        """
+        :param leadTime: seconds before the start time the batches are handed to the writers
+        """
+        self.leadTime = leadTime
+        self.verbose = verbose
+        self.groups = []        # heap of (startTime, groupId, MoveGroup)
+        self.groupIds = itertools.count()
+        self.condition = threading.Condition()
+        self.results = collections.deque(maxlen=100)
+        self.maxSkew = 0.0
+
+    def addGroup(self, moveRequests, startTime=None, deadline=None):
+        """
+        :param moveRequests: prepared move requests of the group
+        :param startTime: wall clock time (time.time) for the moves to start, as soon as possible if None
+        :param deadline: latest acceptable wall clock start time
+        :return: groupId, None if the group can not start in time
+        """
+        now = time.time()
+        if startTime is None or startTime < now + self.leadTime:
+            startTime = now + self.leadTime
+        if deadline is not None and startTime > deadline:
+            config.log(f"scheduled move can not start before its deadline, {startTime - deadline:.3f} s late, ignored")
+            return None
+
+        for request in moveRequests:
+            request['trace'] = config.requestTracer.admit(request['servoName'])
+        groupId = next(self.groupIds)
+        group = MoveGroup(groupId, time.monotonic() + (startTime - now), moveRequests)
+        with self.condition:
+            heapq.heappush(self.groups, (group.startTime, groupId, group))
+            self.condition.notify()
+        if self.verbose: config.log(f"move group {groupId} with {len(moveRequests)} moves scheduled in {startTime - now:.3f} s")
+        return groupId
+
+    def addGroupAt(self, moveRequests, startTime, quiet=False):
+        """
+        :param startTime: time.monotonic for the moves to start
+        :return: MoveGroup, can be cancelled until it is written
+        """
+        group = MoveGroup(next(self.groupIds), startTime, moveRequests)
+        group.quiet = quiet
+        with self.condition:
+            heapq.heappush(self.groups, (group.startTime, group.groupId, group))
+            self.condition.notify()
+        return group
+
+    def cancel(self, group):
+        group.cancelled = True
+        for batch in group.batches:
+            batch.cancelled = True
+
+    def dropServo(self, servoName):
+        """
+        remove the moves of a stopped servo from the groups not yet handed to the writers,
+        the writers remove them from the handed over batches (see ArduinoWriter.dropServo)
+        """
+        with self.condition:
+            for _, _, group in self.groups:
+                moveRequests = [request for request in group.moveRequests if request['servoName'] != servoName]
+                if len(moveRequests) == len(group.moveRequests):
+                    continue
+                for request in group.moveRequests:
+                    if request['servoName'] == servoName:
+                        config.requestTracer.drop(request.get('trace'))
+                group.moveRequests = moveRequests
+                group.numBoards = len({request['arduino'] for request in moveRequests})
+                if len(moveRequests) == 0:
+                    group.cancelled = True
+
+    def startGroup(self, moveRequests):
+        """
+        hand the moves to the writers immediately, one batch per arduino
+        :return: groupId
+        """
+        for request in moveRequests:
+            request['trace'] = config.requestTracer.admit(request['servoName'])
+        groupId = next(self.groupIds)
+        with self.condition:
+            self._stage(MoveGroup(groupId, time.monotonic(), moveRequests))
+        return groupId
+
+    def clear(self):
+        with self.condition:
+            self.groups.clear()
+
+    def _stage(self, group):
+        """
+        hand one batch per arduino to the writers, called with self.condition held so a servo stop
+        either removes the move from the group or finds it in the writer's batch
+        """
+        if group.cancelled:
+            return
+        batches = {}
+        for request in group.moveRequests:
+            batches.setdefault(request['arduino'], []).append((request['msg'], request.get('command'), request['servoName']))
+
+            servoName = request['servoName']
+            servoCurrent = config.servoCurrentDictLocal[servoName]
+            servoCurrent.timeOfLastMoveRequest = time.time()
+            servoCurrent.targetPosition = request['toPos']
+            if servoName in config.servoFeedbackDictLocal:
+                config.feedbackRecorder.startMove(servoName, request['fromPos'], request['toPos'], request['speedRate'])
+            config.requestTracer.dispatch(servoName, request.get('trace'))
+
+        onSent = lambda arduinoIndex, firstWrite, lastWrite: self._batchSent(group, arduinoIndex, firstWrite, lastWrite)
+        for arduinoIndex, commands in batches.items():
+            writer = config.arduinoWriters[arduinoIndex]
+            if writer is None:
+                config.log(f"no connection with arduino {arduinoIndex}, scheduled moves dropped")
+                group.numBoards -= 1
+                continue
+            batch = arduinoWriter.ScheduledBatch(commands, group.startTime, onSent)
+            group.batches.append(batch)
+            writer.putBatch(batch)
+
+    def _batchSent(self, group, arduinoIndex, firstWrite, lastWrite):
+        for request in group.moveRequests:
+            if request['arduino'] == arduinoIndex:
+                config.requestTracer.mark(request['servoName'], requestTracing.WRITTEN, firstWrite)
+        with self.condition:
+            group.writeTimes[arduinoIndex] = (firstWrite, lastWrite)
+            if len(group.writeTimes) < group.numBoards:
+                return
+
+        # all boards written, skew is the spread between the first and the last write over all boards
+        firstWrites = [times[0] for times in group.writeTimes.values()]
+        lastWrites = [times[1] for times in group.writeTimes.values()]
+        skew = max(lastWrites) - min(firstWrites)
+        late = min(firstWrites) - group.startTime
+        if group.quiet:
+            return
+        self.maxSkew = max(self.maxSkew, skew)
+        self.results.append({'groupId': group.groupId, 'moves': len(group.moveRequests),
+                             'skew': skew, 'late': late})
+        config.log(f"move group {group.groupId} started, {len(group.moveRequests)} moves, "
+                   f"skew: {skew * 1000:.1f} ms, late: {late * 1000:.1f} ms")
+
+    def stats(self):
+        return {'scheduledGroups': len(self.groups),
+                'maxSkew': self.maxSkew,
+                'recent': list(self.results)[-10:]}
+
+    def run(self):
+        config.log(f"moveScheduler started")
+        while True:
+            with self.condition:
+                while len(self.groups) == 0:
+                    self.condition.wait()
+                startTime, _, group = self.groups[0]
+                delay = startTime - self.leadTime - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)     # a new earlier group may arrive meanwhile
+                    continue
+                heapq.heappop(self.groups)
+                self._stage(group)
+
+
+def runMoveScheduler():
+    config.moveScheduler.run()
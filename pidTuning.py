@@ -0,0 +1,241 @@
+
+# offline pid tuning of a feedback servo from its recorded moves
+# a first order plant with dead time is fitted to the archived samples (servoWrite -> current),
+# the kp/ki/kd grid is simulated in a process pool against a step and ramps at several speedRates.
+# the ranked candidates are written to a csv file, --apply sends the chosen one to the running skeletonControl
+#   python pidTuning.py --servo leftArm.shoulder --days 2026-10-18 --apply 1
+import os
+import csv
+import logging
+import itertools
+import argparse
+import concurrent.futures
+import numpy as np
+
+import feedbackAnalytics
+
+MAX_DEAD_TIME = 8       # samples
+
+
+class PlantModel:
+    """
+    current[k+1] = current[k] + alpha * (servoWrite[k - deadTime] - current[k])
+    """
+    def __init__(self, alpha, deadTime, sampleMs, msPerPos, residual=0.0, samples=0):
+        self.alpha = alpha
+        self.deadTime = deadTime
+        self.sampleMs = sampleMs
+        self.msPerPos = msPerPos        # planned move speed for speedRate 1
+        self.residual = residual
+        self.samples = samples
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+def fitPlant(servoName, days, dataDir="feedbackData"):
+    """
+    least squares fit of alpha for every dead time, the dead time with the smallest residual wins
+    :return: PlantModel, None without recorded moves
+    """
+    xs = {deadTime: [] for deadTime in range(MAX_DEAD_TIME + 1)}
+    ys = {deadTime: [] for deadTime in range(MAX_DEAD_TIME + 1)}
+    sampleMs = []
+    msPerPos = []
+    for day in days:
+        dayDir = os.path.join(dataDir, day)
+        for chunkName in feedbackAnalytics.chunkNames(dayDir):
+            index, columns = feedbackAnalytics.loadChunk(os.path.join(dayDir, chunkName))
+            if len(index) == 0:
+                continue
+            counts = index['sampleCount'].astype(np.int64)
+            numSamples = int(index['sampleOffset'][-1]) + int(counts[-1])
+            moveOfSample = np.repeat(np.arange(len(index)), counts)
+            ms = np.asarray(columns['ms'][:numSamples], dtype=np.float64)
+            current = np.asarray(columns['current'][:numSamples], dtype=np.float64)
+            servoWrite = np.asarray(columns['servoWrite'][:numSamples], dtype=np.float64)
+            ofServo = index['servoName'][moveOfSample] == servoName.encode()
+
+            for deadTime in range(MAX_DEAD_TIME + 1):
+                k = np.arange(deadTime, numSamples - 1)
+                valid = ofServo[k] & (moveOfSample[k + 1] == moveOfSample[k - deadTime])
+                k = k[valid]
+                xs[deadTime].append(servoWrite[k - deadTime] - current[k])
+                ys[deadTime].append(current[k + 1] - current[k])
+
+            # samples can share a timestamp (ms resolution), a zero step would give a zero sample time
+            steps = np.diff(ms)
+            sampleMs.append(steps[ofServo[1:] & (moveOfSample[1:] == moveOfSample[:-1]) & (steps > 0)])
+
+            selected = index['servoName'] == servoName.encode()
+            plannedMs = feedbackAnalytics.moveMetrics(index, columns)['plannedMs'][selected]
+            distance = np.abs(index['toPos'][selected].astype(np.float64) - index['fromPos'][selected])
+            speedRate = index['speedRate'][selected].astype(np.float64)
+            valid = (distance > 0) & (speedRate > 0)
+            # speedRate = distance * msPerPos / plannedMs
+            msPerPos.append(plannedMs[valid] * speedRate[valid] / distance[valid])
+
+    sampleMs = np.concatenate(sampleMs) if len(sampleMs) > 0 else np.zeros(0)
+    if len(sampleMs) == 0:
+        return None
+
+    best = None
+    for deadTime in range(MAX_DEAD_TIME + 1):
+        x = np.concatenate(xs[deadTime])
+        y = np.concatenate(ys[deadTime])
+        if len(x) == 0 or np.dot(x, x) == 0:
+            continue
+        alpha = float(np.dot(x, y) / np.dot(x, x))
+        residual = float(np.sqrt(np.mean((y - alpha * x) ** 2)))
+        if best is None or residual < best.residual:
+            best = PlantModel(alpha, deadTime, 0.0, 0.0, residual, len(x))
+    if best is None:
+        return None
+    best.sampleMs = float(np.median(sampleMs))
+    msPerPos = np.concatenate(msPerPos)
+    best.msPerPos = float(np.median(msPerPos)) if len(msPerPos) > 0 else 5.0
+    return best
+
+
+def profiles(plant, distance=60, speedRates=(1.0, 0.5, 0.25)):
+    """
+    planned position per sample, a step and a ramp for every speedRate (>0..1), each followed by a hold phase
+    """
+    result = {'step': [0.0] + [float(distance)] * 100}
+    for speedRate in speedRates:
+        rampMs = distance * plant.msPerPos / speedRate
+        rampSamples = max(1, int(round(rampMs / plant.sampleMs)))
+        result[f"ramp {speedRate}"] = [distance * min(k, rampSamples) / rampSamples for k in range(rampSamples + 100)]
+    return result
+
+
+def simulate(plant, kp, ki, kd, planned, tolerance=2):
+    """
+    the controller corrects the written position by the pid output of the tracking error,
+    gains are per sample as on the arduino
+    :return: (settlingMs after the end of the plan, overshoot, integrated absolute error), settlingMs None if not settled
+    """
+    target = planned[-1]
+    current = 0.0
+    integral = 0.0
+    previousError = 0.0
+    writes = [0.0] * (plant.deadTime + 1)
+    overshoot = 0.0
+    absError = 0.0
+    lastOutside = 0
+    plannedEnd = next(k for k, position in enumerate(planned) if position == target)
+    for k, plannedPosition in enumerate(planned):
+        error = plannedPosition - current
+        integral += error
+        servoWrite = plannedPosition + kp * error + ki * integral + kd * (error - previousError)
+        previousError = error
+        writes.append(min(max(servoWrite, -255.0), 255.0))
+        current += plant.alpha * (writes[-1 - plant.deadTime] - current)
+
+        absError += abs(error)
+        overshoot = max(overshoot, current - target)
+        if abs(current - target) > tolerance:
+            lastOutside = k + 1
+    if lastOutside >= len(planned):
+        return None, overshoot, absError
+    return max(0, lastOutside - plannedEnd) * plant.sampleMs, overshoot, absError
+
+
+def evaluateCandidates(plant, profileList, candidates):
+    """
+    process pool worker, simulate the candidates against all profiles
+    :return: list of (kp, ki, kd, settled profiles, mean settlingMs, max overshoot, mean abs error)
+    """
+    results = []
+    for kp, ki, kd in candidates:
+        settlingTimes = []
+        overshoots = []
+        absErrors = []
+        for planned in profileList:
+            settlingMs, overshoot, absError = simulate(plant, kp, ki, kd, planned)
+            if settlingMs is not None:
+                settlingTimes.append(settlingMs)
+            overshoots.append(overshoot)
+            absErrors.append(absError / len(planned))
+        results.append((kp, ki, kd, len(settlingTimes),
+                        sum(settlingTimes) / len(settlingTimes) if len(settlingTimes) > 0 else float('inf'),
+                        max(overshoots), sum(absErrors) / len(absErrors)))
+    return results
+
+
+def tune(plant, kpValues, kiValues, kdValues, workers=None, batchSize=64):
+    """
+    simulate the gain grid in a process pool
+    :return: candidates ranked by settled profiles, overshoot above 1 position, settling time and tracking error
+    """
+    profileList = list(profiles(plant).values())
+    candidates = list(itertools.product(kpValues, kiValues, kdValues))
+    batches = [candidates[i:i + batchSize] for i in range(0, len(candidates), batchSize)]
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for batchResults in pool.map(evaluateCandidates, itertools.repeat(plant), itertools.repeat(profileList), batches):
+            results.extend(batchResults)
+    numProfiles = len(profileList)
+    results.sort(key=lambda result: (numProfiles - result[3], result[5] > 1, result[4], result[6]))
+    return results
+
+
+def writeCandidates(results, fileName):
+    with open(fileName, 'w', newline='') as outFile:
+        writer = csv.writer(outFile)
+        writer.writerow(["rank", "kp", "ki", "kd", "settledProfiles", "settlingMs", "overshoot", "meanAbsError"])
+        for rank, result in enumerate(results, 1):
+            writer.writerow([rank] + [round(value, 4) for value in result])
+
+
+def applyCandidate(servoName, kp, ki, kd):
+    """
+    hand the gains to the running skeletonControl, it sends them to the arduino and saves the feedback definitions
+    """
+    from marvinglobal import marvinShares
+    shares = marvinShares.MarvinShares()
+    if not shares.sharedDataConnect("pidTuning"):
+        logging.error("could not connect with marvinData, gains not applied")
+        return False
+    shares.skeletonRequestQueue.put({'msgType': 'updatePIDValues', 'servoName': servoName, 'kp': kp, 'ki': ki, 'kd': kd})
+    logging.info("pid values for %s requested: kp=%s, ki=%s, kd=%s", servoName, kp, ki, kd)
+    return True
+
+
+def gridValues(text):
+    # "start:stop:step" or a comma separated list
+    if ':' in text:
+        start, stop, step = (float(value) for value in text.split(':'))
+        return [round(value, 6) for value in np.arange(start, stop + step / 2, step)]
+    return [float(value) for value in text.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline pid tuning from recorded feedback moves")
+    parser.add_argument('--servo', required=True)
+    parser.add_argument('--days', nargs='+', required=True, help="archive days, yyyy-mm-dd")
+    parser.add_argument('--dataDir', default="feedbackData")
+    parser.add_argument('--kp', default="0:3:0.1", help="start:stop:step or list")
+    parser.add_argument('--ki', default="0:0.2:0.02")
+    parser.add_argument('--kd', default="0:1:0.1")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default="pidCandidates.csv")
+    parser.add_argument('--apply', type=int, default=0, help="send the candidate with this rank to skeletonControl")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+    plant = fitPlant(args.servo, args.days, args.dataDir)
+    if plant is None:
+        logging.error("no recorded moves of %s", args.servo)
+        raise SystemExit(1)
+    logging.info("plant model %s: %s", args.servo, plant)
+
+    results = tune(plant, gridValues(args.kp), gridValues(args.ki), gridValues(args.kd), args.workers)
+    writeCandidates(results, args.out)
+    for rank, (kp, ki, kd, settled, settlingMs, overshoot, absError) in enumerate(results[:10], 1):
+        logging.info("%2d: kp=%.3f, ki=%.3f, kd=%.3f, settled %d, settling %.0f ms, overshoot %.1f, mean abs error %.2f",
+                     rank, kp, ki, kd, settled, settlingMs, overshoot, absError)
+
+    if args.apply > 0:
+        kp, ki, kd = results[args.apply - 1][:3]
+        applyCandidate(args.servo, kp, ki, kd)
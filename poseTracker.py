@@ -0,0 +1,123 @@
+
+# completion of whole body poses
+# a pose is complete when all of its servos reported target reached. a servo taken over by a newer pose
+# or stopped no longer counts for the older pose. the completion is reported once per pose: logged,
+# kept in the recent results and written to the shared servo state (see sharedServoState.lastCompletedPose)
+import time
+import itertools
+import threading
+import collections
+
+import config
+
+
+class Pose:
+
+    def __init__(self, poseId, servoNames, groupId):
+        self.poseId = poseId
+        self.pending = set(servoNames)
+        self.numServos = len(servoNames)
+        self.groupId = groupId
+        self.startTime = time.monotonic()
+        self.superseded = 0
+
+
+class PoseTracker:
+
+    def __init__(self):
+        self.poses = {}             # poseId -> Pose
+        self.poseOfServo = {}       # servoName -> poseId of the pose the servo is moving for
+        self.poseIds = itertools.count(1)
+        self.lock = threading.Lock()
+        self.results = collections.deque(maxlen=100)
+
+        # stats
+        self.posesStarted = 0
+        self.posesCompleted = 0
+        self.posesCancelled = 0
+
+    def newPoseId(self):
+        return next(self.poseIds)
+
+    def start(self, poseId, moveRequests, groupId=None):
+        """
+        track the servos of a pose whose moves were handed to the writers
+        """
+        servoNames = [request['servoName'] for request in moveRequests]
+        completed = []
+        with self.lock:
+            pose = Pose(poseId, servoNames, groupId)
+            self.poses[poseId] = pose
+            self.posesStarted += 1
+            for servoName in servoNames:
+                previous = self.poses.get(self.poseOfServo.get(servoName))
+                if previous is not None and previous is not pose:
+                    previous.pending.discard(servoName)
+                    previous.superseded += 1
+                    if len(previous.pending) == 0:
+                        completed.append(self._remove(previous))
+                self.poseOfServo[servoName] = poseId
+            if len(pose.pending) == 0:
+                completed.append(self._remove(pose))
+        for pose in completed:
+            self._report(pose, 'completed')
+
+    def targetReached(self, servoName):
+        """
+        called by the receive threads, servos not moving for a pose return without locking
+        """
+        if servoName not in self.poseOfServo:
+            return
+        with self.lock:
+            pose = self.poses.get(self.poseOfServo.pop(servoName, None))
+            if pose is None:
+                return
+            pose.pending.discard(servoName)
+            if len(pose.pending) > 0:
+                return
+            self._remove(pose)
+        self._report(pose, 'completed')
+
+    def cancelServo(self, servoName):
+        if servoName not in self.poseOfServo:
+            return
+        with self.lock:
+            pose = self.poses.get(self.poseOfServo.pop(servoName, None))
+            if pose is None:
+                return
+            pose.pending.discard(servoName)
+            if len(pose.pending) > 0:
+                return
+            self._remove(pose)
+        self._report(pose, 'cancelled')
+
+    def cancelAll(self):
+        with self.lock:
+            cancelled = [self._remove(pose) for pose in list(self.poses.values())]
+        for pose in cancelled:
+            self._report(pose, 'cancelled')
+
+    def _remove(self, pose):
+        # call with lock held
+        self.poses.pop(pose.poseId, None)
+        for servoName in pose.pending:
+            if self.poseOfServo.get(servoName) == pose.poseId:
+                del self.poseOfServo[servoName]
+        return pose
+
+    def _report(self, pose, state):
+        duration = time.monotonic() - pose.startTime
+        if state == 'completed':
+            self.posesCompleted += 1
+        else:
+            self.posesCancelled += 1
+        self.results.append({'poseId': pose.poseId, 'state': state, 'servos': pose.numServos,
+                             'superseded': pose.superseded, 'duration': duration})
+        config.log(f"pose {pose.poseId} {state}, {pose.numServos} servos, {duration:.2f} s"
+                   f"{f', {pose.superseded} servos taken over by newer poses' if pose.superseded > 0 else ''}")
+        if config.sharedServoState is not None:
+            config.sharedServoState.poseCompleted(pose.poseId, state == 'completed')
+
+    def stats(self):
+        return {'started': self.posesStarted, 'completed': self.posesCompleted, 'cancelled': self.posesCancelled,
+                'pending': len(self.poses), 'recent': list(self.results)[-10:]}
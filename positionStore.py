@@ -0,0 +1,198 @@
+
+# crash safe store of the last known servo positions
+# the file has a fixed layout, a header followed by two slots (A/B) per servo
+# an update overwrites the older slot of the servo in place (memory mapped), the newer slot stays valid
+# while the write is in progress. each slot carries a generation counter and a crc32, at load the valid
+# slot with the higher generation wins. the dirty pages are flushed to disk by the positionStoreWriter thread
+import os
+import mmap
+import zlib
+import struct
+import threading
+import simplejson as json
+
+import config
+
+MAGIC = b'MPOS'
+VERSION = 2
+HEADER = struct.Struct('<4sHHH')             # magic, version, numServos, slotSize
+HEADER_SIZE = 64
+SLOT = struct.Struct('<32sdQI4x')           # servoName (config.servoNameBytes), position, generation, crc32
+SLOT_CRC = struct.Struct('<32sdQ')
+SLOTS_PER_SERVO = 2
+
+
+def binaryFileName(jsonFileName):
+    return os.path.splitext(jsonFileName)[0] + ".bin"
+
+
+def _packSlot(servoName, position, generation):
+    data = SLOT_CRC.pack(servoName.encode(), float(position), generation)
+    return SLOT.pack(servoName.encode(), float(position), generation, zlib.crc32(data))
+
+
+def _unpackSlot(buffer, offset):
+    """
+    :return: (servoName, position, generation), None for an invalid slot
+    """
+    name, position, generation, crc = SLOT.unpack_from(buffer, offset)
+    if zlib.crc32(SLOT_CRC.pack(name, position, generation)) != crc or generation == 0:
+        return None
+    if position == int(position):
+        position = int(position)
+    return name.rstrip(b'\0').decode(), position, generation
+
+
+def _atomicWrite(fileName, data):
+    # write to a temporary file and rename it, the old file stays intact until the new one is complete
+    tempFileName = fileName + ".tmp"
+    with open(tempFileName, 'wb') as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tempFileName, fileName)
+
+
+class PositionStore:
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.file = None
+        self.map = None
+        self.slotIndex = {}         # servoName -> index of the servo's slot pair
+        self.generations = {}       # servoName -> generation of the last write
+        self.positions = {}         # servoName -> last written position
+        self.lock = threading.Lock()
+        self.dirtyPages = set()
+        self.flushEvent = threading.Event()
+
+        # stats
+        self.updates = 0
+        self.flushes = 0
+
+    @staticmethod
+    def load(fileName):
+        """
+        read the positions of a store file
+        :return: dict servoName -> position, None if the file is missing or has an unexpected layout
+        """
+        if not os.path.isfile(fileName):
+            return None
+        with open(fileName, 'rb') as infile:
+            buffer = infile.read()
+        if len(buffer) < HEADER_SIZE:
+            return None
+        magic, version, numServos, slotSize = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION or slotSize != SLOT.size \
+                or len(buffer) < HEADER_SIZE + numServos * SLOTS_PER_SERVO * SLOT.size:
+            return None
+
+        positions = {}
+        for index in range(numServos):
+            slots = [_unpackSlot(buffer, HEADER_SIZE + (index * SLOTS_PER_SERVO + ab) * SLOT.size)
+                     for ab in range(SLOTS_PER_SERVO)]
+            slots = [slot for slot in slots if slot is not None]
+            if len(slots) > 0:
+                servoName, position, _ = max(slots, key=lambda slot: slot[2])
+                positions[servoName] = position
+        return positions
+
+    def open(self, positions):
+        """
+        create the store file for the servos in positions and map it
+        :param positions: dict servoName -> position
+        """
+        self.close()
+        self.positions = dict(positions)
+
+        buffer = bytearray(HEADER_SIZE + len(positions) * SLOTS_PER_SERVO * SLOT.size)
+        HEADER.pack_into(buffer, 0, MAGIC, VERSION, len(positions), SLOT.size)
+        self.slotIndex = {}
+        for index, (servoName, position) in enumerate(positions.items()):
+            self.slotIndex[servoName] = index
+            self.generations[servoName] = 1
+            offset = self._slotOffset(servoName, 1)
+            buffer[offset:offset + SLOT.size] = _packSlot(servoName, position, 1)
+        _atomicWrite(self.fileName, bytes(buffer))
+
+        self.file = open(self.fileName, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), len(buffer))
+        config.log(f"position store {self.fileName} opened, {len(positions)} servos")
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+            self.map = None
+            self.file = None
+
+    def _slotOffset(self, servoName, generation):
+        # odd generations go to slot A, even generations to slot B
+        return HEADER_SIZE + (self.slotIndex[servoName] * SLOTS_PER_SERVO + (generation + 1) % 2) * SLOT.size
+
+    def update(self, servoName, position):
+        """
+        overwrite the older slot of the servo, the flush to disk is done by the writer thread
+        """
+        with self.lock:
+            if self.map is None or servoName not in self.slotIndex:
+                return
+            generation = self.generations[servoName] + 1
+            offset = self._slotOffset(servoName, generation)
+            self.map[offset:offset + SLOT.size] = _packSlot(servoName, position, generation)
+            self.generations[servoName] = generation
+            self.positions[servoName] = position
+            self.dirtyPages.add(offset - offset % mmap.PAGESIZE)
+            self.updates += 1
+        self.flushEvent.set()
+
+    def flush(self):
+        with self.lock:
+            dirtyPages = self.dirtyPages
+            self.dirtyPages = set()
+        # msync outside of the lock, updates continue in the mapped pages meanwhile
+        if self.map is None:
+            return
+        for page in dirtyPages:
+            self.map.flush(page, min(mmap.PAGESIZE, len(self.map) - page))
+            self.flushes += 1
+
+    def exportJson(self, fileName):
+        """
+        write the positions as json (atomic replace of the file)
+        """
+        with self.lock:
+            positions = dict(self.positions)
+        _atomicWrite(fileName, json.dumps(positions, indent=2).encode())
+        config.log(f"servo positions exported to {fileName}")
+
+    @staticmethod
+    def importJson(fileName):
+        """
+        :return: dict servoName -> position, None if the file is missing or unreadable
+        """
+        if not os.path.isfile(fileName):
+            return None
+        try:
+            with open(fileName, 'r') as infile:
+                return json.load(infile)
+        except Exception as e:
+            config.log(f"could not read servo positions from {fileName}, {e}")
+            return None
+
+    def stats(self):
+        return {'updates': self.updates,
+                'flushes': self.flushes,
+                'dirtyPages': len(self.dirtyPages)}
+
+    def run(self):
+        config.log(f"positionStoreWriter started")
+        while True:
+            self.flushEvent.wait()
+            self.flushEvent.clear()
+            self.flush()
+
+
+def runPositionStoreWriter():
+    config.positionStore.run()
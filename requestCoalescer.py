@@ -0,0 +1,86 @@
+
+# latest value wins for non-sequential position requests
+# tracking clients (head/eye following, randomMoves) send many targets for the same servo,
+# only the most recent target of a servo is sent to the arduino in each pacing interval
+import time
+import logging
+import threading
+import traceback
+
+import config
+import arduinoSend
+
+
+class RequestCoalescer:
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.pending = {}               # servoName -> (position, duration, trace)
+        self.lock = threading.Lock()
+        self.requestsPending = threading.Event()
+
+        # stats
+        self.received = 0
+        self.sent = 0
+        self.superseded = 0             # replaced by a newer target before being sent
+        self.dropped = 0                # removed by a stop request
+        self.errors = 0
+
+    def submit(self, servoName, position, duration):
+        trace = config.requestTracer.admit(servoName)
+        with self.lock:
+            self.received += 1
+            if servoName in self.pending:
+                self.superseded += 1
+                config.requestTracer.drop(self.pending[servoName][2])
+            self.pending[servoName] = (position, duration, trace)
+        self.requestsPending.set()
+
+    def drop(self, servoName):
+        with self.lock:
+            dropped = self.pending.pop(servoName, None)
+            if dropped is not None:
+                self.dropped += 1
+                config.requestTracer.drop(dropped[2])
+
+    def clear(self):
+        with self.lock:
+            self.dropped += len(self.pending)
+            self.pending.clear()
+
+    def stats(self):
+        return {'received': self.received,
+                'sent': self.sent,
+                'superseded': self.superseded,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'pending': len(self.pending)}
+
+    def run(self):
+        config.log(f"requestCoalescer started")
+        while True:
+            self.requestsPending.wait()
+            windowStart = time.monotonic()
+
+            with self.lock:
+                targets = self.pending
+                self.pending = {}
+                self.requestsPending.clear()
+
+            for servoName, (position, duration, trace) in targets.items():
+                self.sent += 1
+                try:
+                    arduinoSend.requestServoPosition(servoName, position, duration, sequential=False, trace=trace)
+                except Exception as e:
+                    self.errors += 1
+                    config.log(f"failure in coalesced request {servoName} {position} {duration}, {e}\n{traceback.format_exc()}",
+                               level=logging.ERROR)
+
+            # collect newer targets until the next pacing window
+            delay = self.interval - (time.monotonic() - windowStart)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def runRequestCoalescer():
+    config.requestCoalescer.run()
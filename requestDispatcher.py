@@ -0,0 +1,145 @@
+
+# dispatch of the skeletonRequestQueue
+# all pending requests are drained in one pass and routed through a handler table built once at startup
+# from skeletonRequests.requestSchemas. a request is checked against the schema of its msgType before
+# its handler is called, malformed or unknown requests are logged and dropped.
+# the process heartbeat (marvinShares.updateProcessDict) is updated on a timer, not per request
+import time
+import queue
+import logging
+import traceback
+
+import config
+
+
+class HandlerStats:
+
+    def __init__(self):
+        self.count = 0
+        self.rejected = 0
+        self.errors = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+
+    def asDict(self):
+        return {'count': self.count, 'rejected': self.rejected, 'errors': self.errors,
+                'meanMs': round(self.totalTime / self.count * 1000, 3) if self.count > 0 else 0.0,
+                'maxMs': round(self.maxTime * 1000, 3)}
+
+
+class RequestDispatcher:
+
+    def __init__(self, requestSchemas, heartbeatInterval=1.0, maxBatch=100):
+        """
+        :param requestSchemas: msgType -> (handler, {fieldName: type or tuple of types})
+        :param heartbeatInterval: seconds between updates of the process heartbeat
+        :param maxBatch: max requests handled in one pass, the heartbeat is checked between passes
+        """
+        self.heartbeatInterval = heartbeatInterval
+        self.maxBatch = maxBatch
+        self.handlers = {}
+        for msgType, (handler, fields) in requestSchemas.items():
+            if not callable(handler):
+                raise ValueError(f"handler of request {msgType} is not callable")
+            self.handlers[msgType] = (handler, tuple(fields.items()))
+        self.nextHeartbeat = 0.0
+
+        # stats
+        self.handlerStats = {msgType: HandlerStats() for msgType in self.handlers}
+        self.unknown = 0
+        self.batches = 0
+        self.maxBatchSize = 0
+        self.heartbeats = 0
+
+    def validate(self, request):
+        """
+        :return: (handler, None) for a valid request, (None, reason) otherwise
+        """
+        if not isinstance(request, dict):
+            return None, "request is not a dict"
+        entry = self.handlers.get(request.get('msgType'))
+        if entry is None:
+            return None, "unknown msgType"
+        handler, fields = entry
+        for fieldName, fieldType in fields:
+            if fieldName not in request:
+                return None, f"missing field {fieldName}"
+            if not isinstance(request[fieldName], fieldType):
+                return None, f"field {fieldName} has type {type(request[fieldName]).__name__}"
+        servoName = request.get('servoName')
+        if servoName is not None and servoName not in config.servoStaticDictLocal:
+            return None, f"unknown servo {servoName}"
+        return handler, None
+
+    def dispatch(self, request, dequeueTime=0.0):
+        handler, reason = self.validate(request)
+        if handler is None:
+            msgType = request.get('msgType') if isinstance(request, dict) else None
+            if msgType in self.handlerStats:
+                self.handlerStats[msgType].rejected += 1
+            else:
+                self.unknown += 1
+            config.log(f"invalid request {request}, {reason}", level=logging.WARNING)
+            return
+
+        # do not log head.jaw requests as they are very frequent
+        if request.get('servoName', 'head.jaw') != 'head.jaw':
+            config.log("skeletonRequestQueue, request received: %s", request, category='requests')
+
+        handlerStats = self.handlerStats[request['msgType']]
+        tracedServos = config.requestTracer.begin(request, dequeueTime)
+        start = time.perf_counter()
+        try:
+            handler(request)
+        except Exception as e:
+            handlerStats.errors += 1
+            config.log(f"failure in request {request}, {e}\n{traceback.format_exc()}", level=logging.ERROR)
+        elapsed = time.perf_counter() - start
+        config.requestTracer.endHandler(tracedServos)
+        handlerStats.count += 1
+        handlerStats.totalTime += elapsed
+        handlerStats.maxTime = max(handlerStats.maxTime, elapsed)
+
+    def heartbeat(self):
+        now = time.monotonic()
+        if now >= self.nextHeartbeat:
+            config.marvinShares.updateProcessDict(config.processName)
+            self.nextHeartbeat = now + self.heartbeatInterval
+            self.heartbeats += 1
+        return self.nextHeartbeat - now
+
+    def drain(self, requestQueue, timeout):
+        """
+        wait up to timeout for a request, then take all pending requests without waiting
+        :return: list of requests, max maxBatch
+        """
+        try:
+            requests = [requestQueue.get(block=True, timeout=timeout)]
+        except (queue.Empty, TimeoutError):
+            return []
+        while len(requests) < self.maxBatch:
+            try:
+                requests.append(requestQueue.get_nowait())
+            except (queue.Empty, TimeoutError):
+                break
+        return requests
+
+    def runOnce(self, requestQueue):
+        requests = self.drain(requestQueue, max(0.0, self.heartbeat()))
+        if len(requests) == 0:
+            return 0
+        dequeueTime = time.monotonic()
+        self.batches += 1
+        self.maxBatchSize = max(self.maxBatchSize, len(requests))
+        for request in requests:
+            self.dispatch(request, dequeueTime)
+        return len(requests)
+
+    def stats(self):
+        return {'batches': self.batches, 'maxBatchSize': self.maxBatchSize, 'heartbeats': self.heartbeats,
+                'unknown': self.unknown,
+                'requests': {msgType: handlerStats.asDict() for msgType, handlerStats in self.handlerStats.items()
+                             if handlerStats.count > 0 or handlerStats.rejected > 0}}
+
+    def logStats(self):
+        config.log(f"request dispatcher {self.stats()}")
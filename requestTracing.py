@@ -0,0 +1,256 @@
+
+# end to end tracing of the move requests
+# a traced request is timestamped (time.monotonic) at the stages it passes:
+#   enqueue     client side, optional 'enqueueTime' field of the request (time.monotonic of the client)
+#   dequeue     taken from the skeletonRequestQueue by the requestDispatcher
+#   handler     handler of the msgType called
+#   admitted    move admitted to the moveRequestBuffer, requestCoalescer or moveScheduler
+#   dispatched  command handed to the arduinoWriter
+#   written     command written to the serial port
+#   moving      first status of the servo reporting moving
+#   reached     targetReached
+# the time between a stage and the previous one the request passed goes into a histogram per
+# msgType, servo and stage. the histograms have fixed log-linear buckets (16 per octave of microseconds),
+# recording is a few integer operations. a trace replaced by a newer request for the same servo is dropped
+import os
+import time
+import threading
+import simplejson as json
+
+import config
+
+STAGES = ('enqueue', 'dequeue', 'handler', 'admitted', 'dispatched', 'written', 'moving', 'reached')
+ENQUEUE, DEQUEUE, HANDLER, ADMITTED, DISPATCHED, WRITTEN, MOVING, REACHED = range(len(STAGES))
+TRACED_MSG_TYPES = ('position', 'requestDegrees', 'scheduledMove', 'pose')
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+NUM_BUCKETS = 2 * SUB_BUCKETS + 32 * SUB_BUCKETS     # up to 2**37 us
+
+
+def bucketIndex(us):
+    if us < 2 * SUB_BUCKETS:
+        return max(us, 0)
+    shift = us.bit_length() - SUB_BUCKET_BITS - 1
+    return min(SUB_BUCKETS * (shift + 1) + (us >> shift) - SUB_BUCKETS, NUM_BUCKETS - 1)
+
+
+def bucketValue(index):
+    """
+    :return: lowest value of the bucket in us
+    """
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return (SUB_BUCKETS + index % SUB_BUCKETS) << shift
+
+
+class LatencyHistogram:
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.maxUs = 0
+
+    def record(self, us):
+        self.counts[bucketIndex(us)] += 1
+        self.count += 1
+        if us > self.maxUs:
+            self.maxUs = us
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count > 0:
+                self.counts[index] += count
+        self.count += other.count
+        self.maxUs = max(self.maxUs, other.maxUs)
+
+    def percentile(self, q):
+        """
+        :return: ms, lower bound of the bucket holding the q quantile
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return bucketValue(index) / 1000
+        return self.maxUs / 1000
+
+    def summary(self):
+        return {'count': self.count, 'p50': self.percentile(0.5), 'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99), 'max': self.maxUs / 1000}
+
+
+class Trace:
+
+    def __init__(self, msgType, servoName):
+        self.msgType = msgType
+        self.servoName = servoName
+        self.times = [0.0] * len(STAGES)
+
+
+class RequestTracer:
+
+    def __init__(self, enabled=True, snapshotFile="requestTraces.json", snapshotInterval=60.0):
+        self.enabled = enabled
+        self.snapshotFile = snapshotFile
+        self.snapshotInterval = snapshotInterval
+        self.pending = {}       # servoName -> Trace, handler called, move not yet admitted
+        self.inFlight = {}      # servoName -> Trace, dispatched, target not yet reached
+        self.histograms = {}    # (msgType, servoName, stage) -> LatencyHistogram
+        self.lock = threading.Lock()    # the request, coalescer, writer and receive threads move the traces
+
+        # stats
+        self.completed = 0
+        self.superseded = 0     # dispatched, replaced by a newer move before reaching the target
+        self.dropped = 0        # admitted, not dispatched (replaced in the coalescer, stopped, minimal move)
+        self.noMove = 0         # handled without admitting a move
+
+    @staticmethod
+    def servoNamesOf(request):
+        if 'servoName' in request:
+            return (request['servoName'],)
+        if request['msgType'] == 'pose':
+            return tuple(request['targets'])
+        if request['msgType'] == 'scheduledMove':
+            return tuple(move['servoName'] for move in request['moves'])
+        return ()
+
+    def begin(self, request, dequeueTime):
+        """
+        called by the requestDispatcher before the handler
+        :return: traced servo names, to be passed to endHandler
+        """
+        if not self.enabled or request['msgType'] not in TRACED_MSG_TYPES:
+            return ()
+        now = time.monotonic()
+        servoNames = self.servoNamesOf(request)
+        with self.lock:
+            for servoName in servoNames:
+                trace = Trace(request['msgType'], servoName)
+                trace.times[ENQUEUE] = request.get('enqueueTime', 0.0)
+                trace.times[DEQUEUE] = dequeueTime
+                trace.times[HANDLER] = now
+                self.pending[servoName] = trace
+        return servoNames
+
+    def endHandler(self, servoNames):
+        # traces of requests that did not result in a move (minimal move, rejected)
+        with self.lock:
+            for servoName in servoNames:
+                if self.pending.pop(servoName, None) is not None:
+                    self.noMove += 1
+
+    def admit(self, servoName):
+        """
+        :return: the pending trace of the servo, to be passed to dispatch, None if not traced
+        """
+        with self.lock:
+            trace = self.pending.pop(servoName, None)
+            if trace is not None:
+                trace.times[ADMITTED] = time.monotonic()
+        return trace
+
+    def dispatch(self, servoName, trace):
+        if trace is None:
+            return
+        with self.lock:
+            trace.times[DISPATCHED] = time.monotonic()
+            if self.inFlight.get(servoName) is not None:
+                self.superseded += 1
+            self.inFlight[servoName] = trace
+
+    def drop(self, trace):
+        if trace is not None:
+            with self.lock:
+                self.dropped += 1
+
+    def mark(self, servoName, stage, now=None):
+        """
+        written and moving, the first mark of a stage counts
+        a moving status before the command was written still belongs to the previous move
+        """
+        with self.lock:
+            trace = self.inFlight.get(servoName)
+            if trace is None or trace.times[stage] != 0.0 or (stage == MOVING and trace.times[WRITTEN] == 0.0):
+                return
+            trace.times[stage] = time.monotonic() if now is None else now
+
+    def reached(self, servoName):
+        with self.lock:
+            trace = self.inFlight.get(servoName)
+            if trace is None or trace.times[WRITTEN] == 0.0:
+                return
+            del self.inFlight[servoName]
+            trace.times[REACHED] = time.monotonic()
+            previous = None
+            for stage, stageTime in enumerate(trace.times):
+                if stageTime == 0.0:
+                    continue
+                if previous is not None:
+                    self._record(trace, STAGES[stage], stageTime - previous)
+                previous = stageTime
+            first = next(stageTime for stageTime in trace.times if stageTime > 0.0)
+            self._record(trace, 'total', trace.times[REACHED] - first)
+            self.completed += 1
+
+    def _record(self, trace, stageName, seconds):
+        key = (trace.msgType, trace.servoName, stageName)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.record(int(seconds * 1000000))
+
+    def snapshot(self):
+        """
+        :return: dict with the summaries per msgType, servo and stage and the summaries per msgType and stage
+        """
+        with self.lock:
+            perServo = {}
+            perMsgType = {}
+            for (msgType, servoName, stageName), histogram in self.histograms.items():
+                perServo[f"{msgType}/{servoName}/{stageName}"] = histogram.summary()
+                perMsgType.setdefault((msgType, stageName), LatencyHistogram()).merge(histogram)
+        stageOrder = STAGES + ('total',)
+        ordered = sorted(perMsgType.items(), key=lambda item: (item[0][0], stageOrder.index(item[0][1])))
+        return {'time': time.time(), 'completed': self.completed, 'superseded': self.superseded,
+                'dropped': self.dropped, 'noMove': self.noMove,
+                'stages': {f"{msgType}/{stageName}": histogram.summary() for (msgType, stageName), histogram in ordered},
+                'servos': perServo}
+
+    def writeSnapshot(self):
+        snapshot = self.snapshot()
+        tempFileName = self.snapshotFile + ".tmp"
+        try:
+            with open(tempFileName, 'w') as outfile:
+                json.dump(snapshot, outfile, indent=1)
+            os.replace(tempFileName, self.snapshotFile)
+        except OSError as e:
+            config.log(f"could not write request trace snapshot {self.snapshotFile}, {e}")
+        return snapshot
+
+    def logSnapshot(self):
+        snapshot = self.writeSnapshot()
+        config.log(f"request traces: {snapshot['completed']} completed, {snapshot['superseded']} superseded, "
+                   f"{snapshot['dropped']} dropped, {snapshot['noMove']} without move, snapshot in {self.snapshotFile}")
+        for key, summary in snapshot['stages'].items():
+            config.log(f"  {key:32} n={summary['count']:6}, p50={summary['p50']:8.2f} ms, p90={summary['p90']:8.2f} ms, "
+                       f"p99={summary['p99']:8.2f} ms, max={summary['max']:8.2f} ms")
+
+    def stats(self):
+        return {'completed': self.completed, 'superseded': self.superseded, 'dropped': self.dropped, 'noMove': self.noMove,
+                'pending': len(self.pending), 'inFlight': len(self.inFlight)}
+
+    def run(self):
+        config.log(f"requestTracer started, snapshot every {self.snapshotInterval} s to {self.snapshotFile}")
+        while True:
+            time.sleep(self.snapshotInterval)
+            if self.enabled:
+                self.writeSnapshot()
+
+
+def runRequestTracer():
+    config.requestTracer.run()
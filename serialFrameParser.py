@@ -0,0 +1,62 @@
+
+# incremental parser for the byte stream received from an arduino
+# the arduino terminates every message with '\n', binary status messages (first byte >= 0xC0)
+# have a fixed length of 3 bytes (standard servo) or 7 bytes (feedback servo) before the '\n'
+import collections
+
+STATUS_FRAME_LENGTHS = (4, 8)     # including the '\n'
+
+
+class FrameParser:
+
+    def __init__(self, maxFrameLength=512):
+        self.buffer = bytearray()
+        self.maxFrameLength = maxFrameLength
+        self.bytesReceived = 0
+        self.statusFrames = 0
+        self.textLines = 0
+        self.errorCounts = collections.Counter()
+
+    def countError(self, reason):
+        self.errorCounts[reason] += 1
+
+    def feed(self, data):
+        """
+        add received bytes and return the complete frames, a frame includes its '\n'
+        incomplete data is kept for the next call
+        """
+        self.bytesReceived += len(data)
+        self.buffer += data
+        frames = []
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end < 0:
+                break
+            frame = bytes(self.buffer[start:end + 1])
+            start = end + 1
+
+            if frame[0] & 0xC0 == 0xC0:
+                if len(frame) not in STATUS_FRAME_LENGTHS:
+                    self.countError('statusFrameLength')
+                    continue
+                self.statusFrames += 1
+            else:
+                self.textLines += 1
+            frames.append(frame)
+
+        if start > 0:
+            del self.buffer[:start]
+
+        if len(self.buffer) > self.maxFrameLength:
+            # no line end within a reasonable length, the stream is garbled
+            self.countError('overflow')
+            self.buffer.clear()
+
+        return frames
+
+    def stats(self):
+        return {'bytesReceived': self.bytesReceived,
+                'statusFrames': self.statusFrames,
+                'textLines': self.textLines,
+                'errors': dict(self.errorCounts)}
@@ -0,0 +1,74 @@
+
+# precomputed tables for the status message decoding in arduinoReceive
+#   statusFlags         flag byte -> (assigned, moving, attached, autoDetach, verbose, targetReached)
+#   servoByArduinoPin   [arduinoIndex][pin] -> (servoName, servoCurrent, servoStatic, servoDerived, posToDeg)
+#   posToDeg            servoName -> degrees for every reportable position (0..255)
+#   degToPos            servoName -> (minDeg, positions for minDeg..maxDeg in steps of 1 degree)
+import config
+from marvinglobal import marvinglobal as mg
+
+NUM_PINS = 64       # the status message has 6 bits for the pin
+
+statusFlags = [(flags & 0x01 > 0, flags & 0x02 > 0, flags & 0x04 > 0,
+                flags & 0x08 > 0, flags & 0x10 > 0, flags & 0x20 > 0) for flags in range(256)]
+
+
+def buildConversionTables(servoName):
+    servoStatic = config.servoStaticDictLocal[servoName]
+    servoDerived = config.servoDerivedDictLocal[servoName]
+    config.posToDeg[servoName] = [mg.evalDegFromPos(servoStatic, servoDerived, pos) for pos in range(256)]
+    minDeg = int(servoStatic.minDeg)
+    config.degToPos[servoName] = (minDeg, [mg.evalPosFromDeg(servoStatic, servoDerived, deg)
+                                           for deg in range(minDeg, int(servoStatic.maxDeg) + 1)])
+
+
+def buildAllConversionTables():
+    for servoName in config.servoStaticDictLocal:
+        buildConversionTables(servoName)
+    config.log(f"position/degrees conversion tables created")
+
+
+def buildPinTable():
+    config.servoByArduinoPin = [[None] * NUM_PINS for _ in range(config.numArduinos)]
+    for servoName in config.servoStaticDictLocal:
+        addPinEntry(servoName)
+    config.log(f"servo lookup table by arduino and pin created")
+
+
+def addPinEntry(servoName):
+    servoStatic = config.servoStaticDictLocal[servoName]
+    config.servoByArduinoPin[servoStatic.arduinoIndex][servoStatic.pin] = (
+        servoName,
+        config.servoCurrentDictLocal[servoName],
+        servoStatic,
+        config.servoDerivedDictLocal[servoName],
+        config.posToDeg[servoName])
+
+
+def rebuildServo(servoName):
+    """
+    the servo definition has changed (reassign), replace its table entries
+    """
+    for pinTable in config.servoByArduinoPin:
+        for pin, entry in enumerate(pinTable):
+            if entry is not None and entry[0] == servoName:
+                pinTable[pin] = None
+    buildConversionTables(servoName)
+    addPinEntry(servoName)
+
+    servoDerived = config.servoDerivedDictLocal[servoName]
+    for servoUniqueId, name in list(config.servoNameByArduinoAndPin.items()):
+        if name == servoName:
+            del config.servoNameByArduinoAndPin[servoUniqueId]
+    config.servoNameByArduinoAndPin.update({servoDerived.servoUniqueId: servoName})
+
+
+def posFromDeg(servoName, degrees):
+    """
+    table lookup for whole degrees within the servo range, calculated otherwise
+    """
+    minDeg, positions = config.degToPos[servoName]
+    index = degrees - minDeg
+    if index == int(index) and 0 <= index < len(positions):
+        return positions[int(index)]
+    return mg.evalPosFromDeg(config.servoStaticDictLocal[servoName], config.servoDerivedDictLocal[servoName], degrees)
@@ -0,0 +1,244 @@
+
+# servo state in shared memory for other processes (gui, stickFigure, randomMoves, playGesture)
+# skeletonControl owns the block and updates it in place from the receive threads, readers map it and
+# read without copies or ipc round trips. the block is a struct of arrays with one slot per servo:
+#   header      magic, version, numServos, last reported pose (poseId, report count, completed)
+#   names       servoName per slot (32 bytes)
+#   seq         uint32 seqlock counter, odd while the slot is written
+#   position, target, servoWrite, planned               int16
+#   flags       uint8, status flag byte (assigned 0x01, moving 0x02, attached 0x04, autoDetach 0x08,
+#               verbose 0x10, targetReached 0x20)
+#   degrees     float32
+#   updateTime, moveRequestTime                         float64 (time.time)
+# each slot has a single writer (the receive thread of its arduino), readers retry while the seq is odd
+# or changed during their read, a slot that stays odd (owner died while writing) raises TimeoutError
+import time
+import struct
+from multiprocessing import shared_memory
+
+MAGIC = b'MSRV'
+VERSION = 1
+HEADER = struct.Struct('<4sHH')
+POSE = struct.Struct('<IHBx')      # in the header after HEADER
+HEADER_SIZE = 16
+NAME_SIZE = 32          # config.servoNameBytes
+FIELDS = (('seq', 'I'), ('updateTime', 'd'), ('moveRequestTime', 'd'), ('degrees', 'f'),
+          ('position', 'h'), ('target', 'h'), ('servoWrite', 'h'), ('planned', 'h'), ('flags', 'B'))
+FLAG_ASSIGNED = 0x01
+FLAG_MOVING = 0x02
+FLAG_ATTACHED = 0x04
+FLAG_AUTODETACH = 0x08
+FLAG_VERBOSE = 0x10
+FLAG_TARGET_REACHED = 0x20
+SPIN_RETRIES = 100          # reader retries without sleep
+MAX_RETRIES = 200           # reader retries before giving up on a slot
+RETRY_SLEEP = 0.001
+
+
+def _layout(numServos):
+    """
+    :return: (dict fieldName -> offset, total size), the fields are ordered by item size for alignment
+    """
+    offsets = {}
+    offset = HEADER_SIZE + numServos * NAME_SIZE
+    for fieldName, typeCode in FIELDS:
+        itemSize = struct.calcsize(typeCode)
+        offset += -offset % 8
+        offsets[fieldName] = offset
+        offset += numServos * itemSize
+    return offsets, offset
+
+
+def _mapFields(buffer, numServos):
+    offsets, _ = _layout(numServos)
+    return {fieldName: buffer[offsets[fieldName]:offsets[fieldName] + numServos * struct.calcsize(typeCode)].cast(typeCode)
+            for fieldName, typeCode in FIELDS}
+
+
+def _attach(name):
+    """
+    map an existing block without registering it with the resource tracker,
+    the owner unlinks the block, a reader must not do it when it exits
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)     # python 3.13+
+    except TypeError:
+        pass
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda resourceName, resourceType: \
+        None if resourceType == 'shared_memory' else register(resourceName, resourceType)
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedServoState:
+    """
+    owner side, created by skeletonControl
+    """
+    def __init__(self, name, servoNames):
+        self.name = name
+        self.servoNames = list(servoNames)
+        self.slotByName = {servoName: slot for slot, servoName in enumerate(self.servoNames)}
+        for servoName in self.servoNames:
+            if len(servoName.encode()) > NAME_SIZE:
+                raise ValueError(f"servo name {servoName} longer than {NAME_SIZE} bytes")
+        _, size = _layout(len(self.servoNames))
+
+        try:    # remove a block left over by a crashed run
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        buffer = self.shm.buf
+        HEADER.pack_into(buffer, 0, MAGIC, VERSION, len(self.servoNames))
+        for slot, servoName in enumerate(self.servoNames):
+            offset = HEADER_SIZE + slot * NAME_SIZE
+            buffer[offset:offset + NAME_SIZE] = servoName.encode().ljust(NAME_SIZE, b'\0')
+        self.fields = _mapFields(buffer, len(self.servoNames))
+        (self.seq, self.updateTime, self.moveRequestTime, self.degrees,
+         self.position, self.target, self.servoWrite, self.planned, self.flags) = (self.fields[fieldName] for fieldName, _ in FIELDS)
+
+        # stats
+        self.updates = 0
+
+    def update(self, servoName, servoCurrent, flags):
+        """
+        write the state of a servo, called by the receive thread of the servo's arduino
+        :param flags: status flag byte
+        """
+        slot = self.slotByName.get(servoName)
+        if slot is None:
+            return
+        seq = self.seq[slot] + 1
+        self.seq[slot] = seq & 0xffffffff          # odd, write in progress
+        self.position[slot] = servoCurrent.currentPosition
+        self.degrees[slot] = servoCurrent.currentDegrees
+        self.target[slot] = int(servoCurrent.targetPosition)
+        self.servoWrite[slot] = servoCurrent.servoWritePosition
+        self.planned[slot] = servoCurrent.plannedPosition
+        self.flags[slot] = flags & 0x3f
+        self.moveRequestTime[slot] = servoCurrent.timeOfLastMoveRequest
+        self.updateTime[slot] = time.time()
+        self.seq[slot] = (seq + 1) & 0xffffffff    # even, slot consistent
+        self.updates += 1
+
+    def poseCompleted(self, poseId, completed=True):
+        """
+        report the end of a pose to the readers, see poseTracker
+        :param completed: False if the pose was cancelled by a stop request
+        """
+        _, count, _ = POSE.unpack_from(self.shm.buf, HEADER.size)
+        POSE.pack_into(self.shm.buf, HEADER.size, poseId & 0xffffffff, (count + 1) & 0xffff, 1 if completed else 0)
+
+    def stats(self):
+        return {'name': self.name, 'servos': len(self.servoNames), 'updates': self.updates}
+
+    def close(self):
+        if self.shm is None:
+            return
+        for field in self.fields.values():
+            field.release()
+        self.fields = {}
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+class ServoStateReader:
+    """
+    reader side for consumer processes
+
+        reader = sharedServoState.ServoStateReader()
+        state = reader.read('head.rothead')     # dict with position, degrees, target, flags, moving, ...
+    """
+    def __init__(self, name="marvinServoState"):
+        self.shm = _attach(name)
+
+        magic, version, numServos = HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.shm.close()
+            raise ValueError(f"shared memory block {name} is not a servo state block")
+        self.servoNames = [bytes(self.shm.buf[HEADER_SIZE + slot * NAME_SIZE:HEADER_SIZE + (slot + 1) * NAME_SIZE]).rstrip(b'\0').decode()
+                           for slot in range(numServos)]
+        self.slotByName = {servoName: slot for slot, servoName in enumerate(self.servoNames)}
+        self.fields = _mapFields(self.shm.buf, numServos)
+        self.seq = self.fields['seq']
+        self.position = self.fields['position']
+
+        # stats
+        self.retries = 0
+
+    def _readSlot(self, slot):
+        """
+        a writer holds the seq odd for a few microseconds, after SPIN_RETRIES the reader sleeps between retries.
+        a seq that stays odd (owner died in the middle of an update) raises TimeoutError after MAX_RETRIES
+        """
+        seq = self.seq
+        for attempt in range(MAX_RETRIES):
+            if attempt >= SPIN_RETRIES:
+                time.sleep(RETRY_SLEEP)
+            before = seq[slot]
+            if before & 1:
+                self.retries += 1
+                continue
+            values = {fieldName: field[slot] for fieldName, field in self.fields.items()}
+            if seq[slot] == before:
+                break
+            self.retries += 1
+        else:
+            raise TimeoutError(f"servo state slot {self.servoNames[slot]} not consistent after {MAX_RETRIES} reads")
+        flags = values['flags']
+        values['assigned'] = flags & FLAG_ASSIGNED > 0
+        values['moving'] = flags & FLAG_MOVING > 0
+        values['attached'] = flags & FLAG_ATTACHED > 0
+        values['targetReached'] = flags & FLAG_TARGET_REACHED > 0
+        return values
+
+    def read(self, servoName):
+        """
+        :return: consistent state of the servo as dict
+        """
+        return self._readSlot(self.slotByName[servoName])
+
+    def readPosition(self, servoName):
+        """
+        current position only, a single value needs no seqlock
+        """
+        return self.position[self.slotByName[servoName]]
+
+    def lastPose(self):
+        """
+        :return: (poseId, report count, completed) of the last finished pose, the count changes with every report
+        """
+        while True:
+            poseId, count, completed = POSE.unpack_from(self.shm.buf, HEADER.size)
+            if POSE.unpack_from(self.shm.buf, HEADER.size) == (poseId, count, completed):
+                return poseId, count, completed > 0
+
+    def waitForPose(self, poseId, timeout=None, interval=0.01):
+        """
+        poll until the pose was reported, poses finishing close together may hide each other
+        :return: True if the pose completed, False if it was cancelled, None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            lastPoseId, _, completed = self.lastPose()
+            if lastPoseId == poseId:
+                return completed
+            time.sleep(interval)
+        return None
+
+    def readAll(self):
+        return {servoName: self._readSlot(slot) for slot, servoName in enumerate(self.servoNames)}
+
+    def close(self):
+        for field in self.fields.values():
+            field.release()
+        self.fields = {}
+        self.shm.close()
@@ -0,0 +1,92 @@
+
+# publish servoCurrent changes to marvinData from a single thread
+# the control threads only mark a servo as changed, the publisher sends the servos whose state
+# differs from the last published snapshot at a limited rate.
+# targetReached and stop events request an immediate flush
+# marvinData takes one complete servoCurrent entry per update and replaces the stored entry with it,
+# so a changed servo is published with its full entry in an update of its own
+import time
+import logging
+import threading
+
+import config
+from marvinglobal import marvinglobal as mg
+
+
+class SharedStatePublisher:
+
+    def __init__(self, interval=0.2):
+        """
+        :param interval: seconds between regular publish passes
+        """
+        self.interval = interval
+        self.changedServos = set()
+        self.lastPublished = {}         # servoName -> dict of the last published servoCurrent
+        self.lock = threading.Lock()
+        self.flushEvent = threading.Event()
+        self.running = False
+
+        # stats
+        self.changesMarked = 0
+        self.updatesSent = 0
+        self.unchangedSkipped = 0
+        self.publishPasses = 0
+        self.roundTripTotal = 0.0
+        self.roundTripMax = 0.0
+
+    def markChanged(self, servoName, flush=False):
+        with self.lock:
+            self.changesMarked += 1
+            self.changedServos.add(servoName)
+        if flush:
+            self.flushEvent.set()
+
+    def stats(self):
+        return {'changesMarked': self.changesMarked,
+                'updatesSent': self.updatesSent,
+                'unchangedSkipped': self.unchangedSkipped,
+                'publishPasses': self.publishPasses,
+                'roundTripAvg': self.roundTripTotal / self.updatesSent if self.updatesSent > 0 else 0.0,
+                'roundTripMax': self.roundTripMax}
+
+    def publish(self, servoName, data):
+        """
+        send the servoCurrent data, used directly as long as the publisher thread is not running
+        """
+        msg = {'msgType': mg.SharedDataItems.SERVO_CURRENT, 'sender': config.processName,
+               'info': {'servoName': servoName, 'data': data}}
+        start = time.monotonic()
+        config.updateSharedDict(msg)
+        roundTrip = time.monotonic() - start
+        self.roundTripTotal += roundTrip
+        self.roundTripMax = max(self.roundTripMax, roundTrip)
+        self.updatesSent += 1
+        self.lastPublished[servoName] = data
+
+    def publishChanged(self):
+        with self.lock:
+            changedServos = self.changedServos
+            self.changedServos = set()
+        self.publishPasses += 1
+
+        for servoName in changedServos:
+            data = dict(config.servoCurrentDictLocal[servoName].__dict__)
+            lastData = self.lastPublished.get(servoName, {})
+            if {**data, 'timeOfLastShareUpdate': None} == {**lastData, 'timeOfLastShareUpdate': None}:
+                self.unchangedSkipped += 1
+                continue
+            config.log("update share: %s", servoName, category='serial', level=logging.DEBUG)
+            config.servoCurrentDictLocal[servoName].timeOfLastShareUpdate = data['timeOfLastShareUpdate'] = time.time()
+            self.publish(servoName, data)
+
+    def run(self):
+        config.log(f"sharedStatePublisher started, publish interval {self.interval} s")
+        self.running = True
+        while True:
+            self.flushEvent.wait(self.interval)
+            self.flushEvent.clear()
+            self.publishChanged()
+
+
+def runSharedStatePublisher():
+    config.sharedStatePublisher.run()
@@ -1,6 +1,8 @@
 
 import os, sys
 import time
+import atexit
+import logging
 import serial   # pip install pyserial
 import threading
 import simplejson as json
@@ -13,8 +15,23 @@ import feedbackServo
 import config
 import arduinoSend
 import arduinoReceive
+import arduinoWriter
+import arduinoProtocol
+import arduinoDiscovery
+import startupCache
+import sharedServoState
+import servoLookup
 import skeletonRequests
+import requestDispatcher
 import moveRequestBuffer
+import moveScheduler
+import requestCoalescer
+import sharedStatePublisher
+import positionStore
+import feedbackRecorder
+import gesturePlayer
+import requestTracing
+import metricsExporter
 
 def assignServos(arduinoIndex):
     """
@@ -33,7 +50,6 @@ def assignServos(arduinoIndex):
 
             config.log(f"servo assign {servoName}, last persisted position: {config.servoCurrentDictLocal.get(servoName).currentPosition}")
             arduinoSend.servoAssign(servoName, config.servoCurrentDictLocal.get(servoName).currentPosition)
-            time.sleep(0.2)     # add delay as arduino gets overwhelmed otherwise
 
     # then move the servos to the last persisted position
     for servoName, servoStatic in config.servoStaticDictLocal.items():
@@ -42,22 +58,58 @@ def assignServos(arduinoIndex):
             arduinoSend.requestServoPosition(servoName, config.servoCurrentDictLocal.get(servoName).currentPosition, 1000)
 
 
+def setupArduino(arduinoIndex):
+    """
+    assign the servos and send the feedback definitions to one arduino
+    """
+    start = time.monotonic()
+    assignServos(arduinoIndex)
+    startupPhase(f"arduino {arduinoIndex} assign", start)
+    start = time.monotonic()
+    feedbackServo.setupFeedbackServos(arduinoIndex)
+    startupPhase(f"arduino {arduinoIndex} feedback", start)
+
+
+def setupArduinos():
+    """
+    configure all arduinos concurrently
+    """
+    start = time.monotonic()
+    setupThreads = []
+    for arduinoIndex, arduinoData in config.arduinoDictLocal.items():
+        config.log(f"assign servos to arduino {arduinoIndex}, {arduinoData['arduinoName']=}, {arduinoData['comPort']=}")
+        setupThread = threading.Thread(target=setupArduino, args=(arduinoIndex,))
+        setupThread.name = f"arduinoSetup_{arduinoIndex}"
+        setupThread.start()
+        setupThreads.append(setupThread)
+    for setupThread in setupThreads:
+        setupThread.join()
+    startupPhase("arduino setup", start)
+
+
+def startupPhase(phase, start):
+    config.startupPhases[phase] = time.monotonic() - start
+    config.log(f"startup phase {phase}: {config.startupPhases[phase]:.2f} s")
+
+
 def markServoPositionAsChanged(servoName, position, verbose=False):
     '''
-    save current servo position to json file if last safe time differs
-    more than maxDelay seconds
+    write the changed servo position in place to the position store
     '''
     if config.persistedServoPositionsLocal[servoName] != position:
         config.persistedServoPositionsLocal[servoName] = position
-        config.servoPositionsChanged = True
+        config.positionStore.update(servoName, position)
         if verbose: config.log(f"mark servo position as changed, {servoName=}, {position=}")
 
 
 def persistServoPositions():
-
-    with open(mg.PERSISTED_SERVO_POSITIONS_FILE, 'w') as outfile:
-        json.dump(config.persistedServoPositionsLocal, outfile, indent=2)
-        config.log("persist changed servo positions to file")
+    '''
+    create the position store with the current positions and export them as json
+    '''
+    if config.positionStore is None:
+        config.positionStore = positionStore.PositionStore(positionStore.binaryFileName(mg.PERSISTED_SERVO_POSITIONS_FILE))
+    config.positionStore.open(config.persistedServoPositionsLocal)
+    config.positionStore.exportJson(mg.PERSISTED_SERVO_POSITIONS_FILE)
 
 
 def initServoControl():
@@ -68,8 +120,7 @@ def initServoControl():
         try:
             with open(mg.SERVO_TYPE_DEFINITIONS_FILE, 'r') as infile:
                 servoTypeDefinitions = json.load(infile)
-            with open(mg.SERVO_TYPE_DEFINITIONS_FILE + ".bak", 'w') as outfile:
-                json.dump(servoTypeDefinitions, outfile, indent=2)
+            startupCache.backupIfChanged(mg.SERVO_TYPE_DEFINITIONS_FILE)
 
         except Exception as e:
             config.log(f"missing {mg.SERVO_TYPE_DEFINITIONS_FILE} file, try using the backup file")
@@ -80,12 +131,6 @@ def initServoControl():
             servoType.updateValues(servoTypeData)
             config.servoTypeDictLocal.update({servoTypeName: servoType})
 
-            # add servoTypes to shared data
-            #updStmt = (mg.SharedDataItems.SERVO_TYPE, servoTypeName, dict(servoType.__dict__))
-            msg = {'msgType': mg.SharedDataItems.SERVO_TYPE, 'sender': config.processName,
-                   'info': {'type': servoTypeName, 'data': dict(servoType.__dict__)}}
-            config.updateSharedDict(msg)
-
         config.log(f"servoTypeDict loaded")
 
 
@@ -95,14 +140,16 @@ def initServoControl():
             with open(mg.SERVO_STATIC_DEFINITIONS_FILE, 'r') as infile:
                 servoStaticDefinitions = json.load(infile)
             # if successfully read create a backup just in case
-            with open(mg.SERVO_STATIC_DEFINITIONS_FILE + ".bak", 'w') as outfile:
-                json.dump(servoStaticDefinitions, outfile, indent=2)
+            startupCache.backupIfChanged(mg.SERVO_STATIC_DEFINITIONS_FILE)
 
         except Exception as e:
             config.log(f"missing {mg.SERVO_STATIC_DEFINITIONS_FILE} file, try using the backup file")
             os._exit(7)
 
         for servoName in servoStaticDefinitions:
+            if len(servoName.encode()) > config.servoNameBytes:
+                config.log(f"servo name {servoName} longer than {config.servoNameBytes} bytes, servo ignored", level=logging.ERROR)
+                continue
             servoStatic = skeletonClasses.ServoStatic()
             servoStatic.updateValues(servoStaticDefinitions[servoName])
             servoType = config.servoTypeDictLocal[servoStatic.servoType]
@@ -131,29 +178,45 @@ def initServoControl():
             # add object to the servoStaticDict
             config.servoStaticDictLocal.update({servoName: servoStatic})
 
-            # populate the shared version of the dict
-            #updStmt = (mg.SharedDataItems.SERVO_STATIC, servoName, dict(servoStatic.__dict__))
-            msg = {'msgType': mg.SharedDataItems.SERVO_STATIC, 'sender': config.processName,
-                   'info': {'servoName': servoName, 'data': dict(servoStatic.__dict__)}}
-            config.marvinShares.updateSharedData(msg)
-
-            #config.updateSharedDict(updStmt)
+        config.log(f"servoStaticDict loaded")
+
+
+    def publishServoDefinitions():
+        # populate the shared versions of the dicts
+        # marvinData takes one entry per message, entries it already holds unchanged
+        # (marvinData kept running while skeletonControl restarted) are not sent again
+        published = 0
+        for item, key, localDict in ((mg.SharedDataItems.SERVO_TYPE, 'type', config.servoTypeDictLocal),
+                                     (mg.SharedDataItems.SERVO_STATIC, 'servoName', config.servoStaticDictLocal),
+                                     (mg.SharedDataItems.SERVO_FEEDBACK, 'servoName', config.servoFeedbackDictLocal)):
+            sharedDict = config.marvinShares.servoDict.get(item)
+            sharedDict = {} if sharedDict is None else sharedDict.copy()     # one round trip for a dict proxy
+            for name, entry in localDict.items():
+                data = dict(entry.__dict__)
+                shared = sharedDict.get(name)
+                if getattr(shared, '__dict__', shared) == data:
+                    continue
+                msg = {'msgType': item, 'sender': config.processName, 'info': {key: name, 'data': data}}
+                config.updateSharedDict(msg)
+                published += 1
 
-        config.log(f"shared servo data updated")
+        config.log(f"shared servo data updated, {published} entries published")
 
 
     def loadServoPositions():
         # global persistedServoPositions, servoCurrentDict
 
         config.log("load last known servo positions")
-        if os.path.isfile(mg.PERSISTED_SERVO_POSITIONS_FILE):
-            with open(mg.PERSISTED_SERVO_POSITIONS_FILE, 'r') as infile:
-                config.persistedServoPositionsLocal = json.load(infile)
-                if len(config.persistedServoPositionsLocal) != len(config.servoStaticDictLocal):
-                    config.log(f"mismatch of servoDict and persistedServoPositions")
-                    createPersistedDefaultServoPositions()
-        else:
+        # the position store is updated with every position change, the json file is an export of it
+        positions = positionStore.PositionStore.load(positionStore.binaryFileName(mg.PERSISTED_SERVO_POSITIONS_FILE))
+        if positions is None:
+            positions = positionStore.PositionStore.importJson(mg.PERSISTED_SERVO_POSITIONS_FILE)
+        if positions is None or set(positions) != set(config.servoStaticDictLocal):
+            config.log(f"missing positions or mismatch of servoDict and persistedServoPositions")
             createPersistedDefaultServoPositions()
+        else:
+            config.persistedServoPositionsLocal = positions
+            persistServoPositions()
 
         # check for valid persisted position
         for servoName in config.servoStaticDictLocal:
@@ -192,26 +255,47 @@ def initServoControl():
 
         config.log("servoPositions loaded")
 
-    loadServoTypes()
-    loadServoStaticDefinitions()
-
-    config.log(f"create servoDerivedDict")
-    for servoName, servoStatic in config.servoStaticDictLocal.items():
-        servoType = config.servoTypeDictLocal[servoStatic.servoType]
-        #servoDerived = skeletonClasses.ServoDerived(servoStatic, servoType)
-        servoDerived = skeletonClasses.ServoDerived()
-        servoDerived.updateValues(servoStatic, servoType)
-        config.servoDerivedDictLocal.update({servoName: servoDerived})
+    # an unchanged configuration is taken from the startup cache
+    # the key covers the definition files and the code building and holding the cached definitions
+    cacheFiles = (mg.SERVO_TYPE_DEFINITIONS_FILE, mg.SERVO_STATIC_DEFINITIONS_FILE, mg.SERVO_FEEDBACK_DEFINITIONS_FILE,
+                  skeletonClasses.__file__, servoLookup.__file__, feedbackServo.__file__, __file__)
+    snapshot = startupCache.load(startupCache.definitionHashes(cacheFiles))
+    if snapshot is not None:
+        startupCache.restore(snapshot)
+    else:
+        loadServoTypes()
+        loadServoStaticDefinitions()
+
+        config.log(f"create servoDerivedDict")
+        for servoName, servoStatic in config.servoStaticDictLocal.items():
+            servoType = config.servoTypeDictLocal[servoStatic.servoType]
+            #servoDerived = skeletonClasses.ServoDerived(servoStatic, servoType)
+            servoDerived = skeletonClasses.ServoDerived()
+            servoDerived.updateValues(servoStatic, servoType)
+            config.servoDerivedDictLocal.update({servoName: servoDerived})
+        servoLookup.buildAllConversionTables()
 
-    feedbackServo.loadServoFeedbackDefinitions()
+        feedbackServo.loadServoFeedbackDefinitions()
+    publishServoDefinitions()
 
     loadServoPositions()
-    saveServoStaticDict()
+    if snapshot is None:
+        # the cleansed definitions may differ from the file, hash the saved version
+        saveServoStaticDict()
+        startupCache.save(startupCache.definitionHashes(cacheFiles))
 
     # create a dict to find servo name from arduino and pin (for messages from arduino)
     for servoName, servoStatic in config.servoStaticDictLocal.items():
         config.servoNameByArduinoAndPin.update({config.servoDerivedDictLocal[servoName].servoUniqueId: servoName})
     config.log(f"lookup list for servo by arduino and pin created")
+    servoLookup.buildPinTable()
+
+    # servo state for readers in other processes, updated in place by the receive threads
+    config.sharedServoState = sharedServoState.SharedServoState(config.sharedServoStateName, config.servoStaticDictLocal.keys())
+    for servoName, servoCurrent in config.servoCurrentDictLocal.items():
+        config.sharedServoState.update(servoName, servoCurrent, 0)
+    atexit.register(config.closeSharedServoState)
+    config.log(f"shared servo state {config.sharedServoStateName} created")
 
 
 def saveServoStaticDict():
@@ -224,10 +308,9 @@ def saveServoStaticDict():
     for servoName, servoObject in config.servoStaticDictLocal.items():
         servoStaticDefinitions.update({servoName: servoObject.__dict__})
 
-    with open(mg.SERVO_STATIC_DEFINITIONS_FILE, 'w') as outfile:
-        json.dump(servoStaticDefinitions, outfile, indent=2)
-
-    config.log(f"servoStaticDict saved")
+    # only rewrite the file if the content changed
+    if startupCache.writeIfChanged(mg.SERVO_STATIC_DEFINITIONS_FILE, json.dumps(servoStaticDefinitions, indent=2)):
+        config.log(f"servoStaticDict saved")
 
 
 def createPersistedDefaultServoPositions():
@@ -264,83 +347,39 @@ def connectWithArduinos():
         config.updateSharedDict(msg)
 
     # try to find the skeleton arduinos
-    pathArduino = "/dev/ttyACM"
-
     config.arduino = None
     config.arduinoConnEstablished = False
 
-    for portNumber in range(5):
-        usbPort = pathArduino + str(portNumber)
-        arduino = None
-        try:
-            arduino = serial.Serial(usbPort)
-            arduino.baudrate = 115200
-
-            # Toggle DTR to reset Arduino
-            arduino.setDTR(False)
-            time.sleep(1)
-            arduino.flushInput()
-            arduino.setDTR(True)
-
-        except Exception as e:
-            config.log(f"could not connect with {usbPort}, try next")
-            continue
-
-        # arduino sends an initial message, check for correct Arduino
-        if arduino.is_open:
-
-            config.log(f"connected with {usbPort}, try to read first message")
-            numBytesAvailable = 0
-            timeout = time.time() + 5
-            try:
-                while numBytesAvailable == 0 and time.time() < timeout:
-                    numBytesAvailable = arduino.inWaiting()
-            except Exception as e:
-                config.log(f"exception in arduinoReceive, readMessages: {e}")
-                continue
-
-            if numBytesAvailable == 0:
-                config.log(f"could not receive initial message")
-                continue
-            else:
-                # cartGlobal.log(f"inWaiting > 0")
-                recvB = arduino.readline()
-                try:
-                    recv = recvB.decode()[:-2]  # without cr/lf
-                except Exception as e:
-                    config.log(f"problem with decoding cart msg '{recvB}' {e}")
-                    continue
-
-                if recv[0:3] == "S0 ":
-                    config.arduinoConn[0] = arduino
-                    config.arduinoDictLocal[0]["comPort"] = usbPort
-                    config.arduinoDictLocal[0]["connected"] = True
-                    config.log(f"received {recv}, connected with skeletonControlArduino S0 on usb port {usbPort}")
-                    if config.arduinoConn[1] is None:
-                        continue
-                    break
-
-                elif recv[0:3] == "S1 ":
-                    config.arduinoConn[1] = arduino
-                    config.arduinoDictLocal[1]["comPort"] = usbPort
-                    config.arduinoDictLocal[1]["connected"] = True
-                    config.log(f"received {recv}, connected with skeletonControlArduino S1 on usb port {usbPort}")
-                    if config.arduinoConn[0] is None:
-                        continue
-                    break
-
-                else:
-                    config.log(f"received {recv}, not a skeletonControlArduino, try next")
-                    continue
+    found = arduinoDiscovery.discoverArduinos(config.arduinoPortCandidates, config.numArduinos)
+    for arduinoIndex, (usbPort, arduino, recv) in found.items():
+        config.arduinoConn[arduinoIndex] = arduino
+        config.arduinoDictLocal[arduinoIndex]["comPort"] = usbPort
+        config.arduinoDictLocal[arduinoIndex]["connected"] = True
+        config.arduinoDictLocal[arduinoIndex]["protocolVersion"] = arduinoProtocol.parseGreeting(recv)
+        config.arduinoDictLocal[arduinoIndex]["ackCredits"] = arduinoProtocol.parseAckCredits(recv)
+        config.log(f"received {recv}, connected with skeletonControlArduino S{arduinoIndex} on usb port {usbPort}")
 
     if config.arduinoConn[0] is None or config.arduinoConn[1] is None:
         config.log(f"could not find both skeletonControlArduinos, going down")
         os._exit(1)
 
 
-    # start serial port receiving threads
+    # start serial port receiving and writing threads
     for arduinoIndex,arduinoData in config.arduinoDictLocal.items():
 
+        protocolVersion = min(arduinoData.get('protocolVersion', arduinoProtocol.PROTOCOL_ASCII), config.serialProtocolVersion)
+        config.log(f"arduino {arduinoIndex} uses {'binary' if protocolVersion >= arduinoProtocol.PROTOCOL_BINARY else 'ascii'} commands")
+        config.arduinoWriters[arduinoIndex] = arduinoWriter.ArduinoWriter(arduinoIndex, config.arduinoConn[arduinoIndex],
+                                                    config.serialSendInterval, config.serialSendBurst,
+                                                    config.serialWriteCombining, config.serialMaxFrameBytes,
+                                                    protocolVersion)
+        config.arduinoWriters[arduinoIndex].start()
+
+        credits = arduinoData.get('ackCredits', 0)
+        if config.useAcks and credits > 0:
+            config.ackCredits[arduinoIndex] = arduinoWriter.AckCredits(arduinoIndex, credits, config.ackTimeout)
+        config.log(f"arduino {arduinoIndex} configuration commands {f'acknowledged, {credits} credits' if config.ackCredits[arduinoIndex] else 'paced'}")
+
         serialReadThread = threading.Thread(target=arduinoReceive.readMessages, args={arduinoIndex})
         serialReadThread.name = f"arduinoRead_{arduinoIndex}"
         serialReadThread.start()
@@ -371,11 +410,85 @@ def connectWithArduinos():
     #time.sleep(0.2)
 
 
+def startMetricsExporter():
+    # the collectors read the single writer stats of the parsers, writers and the move request buffer at scrape time
+    config.metricsExporter.addCollector(arduinoReceive.collectMetrics)
+    config.metricsExporter.addCollector(arduinoSend.collectWriterMetrics)
+    config.metricsExporter.addCollector(config.moveRequestBuffer.metrics)
+    metricsThread = threading.Thread(target=metricsExporter.runMetricsExporter, args={}, daemon=True)
+    metricsThread.name = f"metricsExporter"
+    metricsThread.start()
+
+
+def startServoControl():
+    """
+    start the worker threads and set up the arduinos, used by the main program and benchmarkLatency
+    """
+    # flush the in place position updates to disk
+    positionStoreThread = threading.Thread(target=positionStore.runPositionStoreWriter, args={})
+    positionStoreThread.name = f"positionStoreWriter"
+    positionStoreThread.start()
+
+    # archive the recorded feedback servo moves
+    feedbackWriterThread = threading.Thread(target=feedbackRecorder.runFeedbackWriter, args={})
+    feedbackWriterThread.name = f"feedbackWriter"
+    feedbackWriterThread.start()
+
+    # from now on servoCurrent changes are sent to marvinData by the publisher thread
+    sharedStatePublisherThread = threading.Thread(target=sharedStatePublisher.runSharedStatePublisher, args={})
+    sharedStatePublisherThread.name = f"sharedStatePublisher"
+    sharedStatePublisherThread.start()
+
+    # assign servos and move servos to last known persisted position, all arduinos concurrently
+    setupArduinos()
+
+    # start thread for monitoring the moveRequestBuffer
+    requestBufferThread = threading.Thread(target=moveRequestBuffer.monitorMoveRequestBuffer, args={})
+    requestBufferThread.name = f"requestBufferMonitor"
+    requestBufferThread.start()
+
+    # start thread for the time scheduled move groups
+    moveSchedulerThread = threading.Thread(target=moveScheduler.runMoveScheduler, args={})
+    moveSchedulerThread.name = f"moveScheduler"
+    moveSchedulerThread.start()
+
+    # start thread for sending the latest non-sequential move requests
+    requestCoalescerThread = threading.Thread(target=requestCoalescer.runRequestCoalescer, args={})
+    requestCoalescerThread.name = f"requestCoalescer"
+    requestCoalescerThread.start()
+
+    # start thread for playing gestures
+    gesturePlayerThread = threading.Thread(target=gesturePlayer.runGesturePlayer, args={})
+    gesturePlayerThread.name = f"gesturePlayer"
+    gesturePlayerThread.start()
+
+    # start thread for the request trace snapshots
+    requestTracerThread = threading.Thread(target=requestTracing.runRequestTracer, args={})
+    requestTracerThread.name = f"requestTracer"
+    requestTracerThread.start()
+
+    # link health metrics, prometheus endpoint and snapshots to marvinData
+    startMetricsExporter()
+
+
+def processSkeletonRequests():
+    # drain the pending requests in batches, the dispatcher updates the process heartbeat on its timer
+    config.requestDispatcher = requestDispatcher.RequestDispatcher(skeletonRequests.requestSchemas, heartbeatInterval=1.0)
+    while True:
+        try:
+            config.requestDispatcher.runOnce(config.marvinShares.skeletonRequestQueue)
+        except Exception as e:
+            config.log(f"exception in waiting for skeleton request, {e=}, going down")
+            config.marvinShares.removeProcess(config.processName)
+            config.exitProcess(11)
+
+
 if __name__ == "__main__":
 
     os.chdir("/home/marvin/InMoov/skeletonControl")
 
     #config.startLogging()
+    config.startLogWriter()
     config.log(f"{config.processName},  trying to connect with marvinData")
     config.marvinShares = marvinShares.MarvinShares()
     if not config.marvinShares.sharedDataConnect(config.processName):
@@ -386,66 +499,22 @@ if __name__ == "__main__":
     # add own process to shared process list
     config.marvinShares.updateProcessDict(config.processName)
 
+    startTime = time.monotonic()
+    start = time.monotonic()
     connectWithArduinos()
+    startupPhase("connect", start)
 
+    start = time.monotonic()
     initServoControl()
+    startupPhase("servo definitions", start)
 
-    # assign servos and move servos to last known persisted position
-    for arduinoIndex, arduinoData in config.arduinoDictLocal.items():
-        config.log(f"assign servos to arduino {arduinoIndex}, {arduinoData['arduinoName']=}, {arduinoData['comPort']=}")
-        assignServos(arduinoIndex)
-        feedbackServo.setupFeedbackServos(arduinoIndex)
+    # start the worker threads, set up the arduinos
+    startServoControl()
 
     # set verbose mode for servos to report more details
     arduinoSend.setVerbose('leftArm.shoulder', True)
 
-    # start thread for monitoring the moveRequestBuffer
-    requestBufferThread = threading.Thread(target=moveRequestBuffer.monitorMoveRequestBuffer, args={})
-    requestBufferThread.name = f"requestBufferMonitor"
-    requestBufferThread.start()
-
+    startupPhase("startup", startTime)
     config.log(f"skeletonControl ready, waiting for skeleton requests")
     config.log(f"---------------")
-    request = {}
-    # wait for move requests or timeout
-    while True:
-
-        if config.servoPositionsChanged:
-            secondsSinceLastSave = time.time() - config.servoPositionsSavedTime
-            if secondsSinceLastSave > 1:
-                persistServoPositions()
-                config.servoPositionsSavedTime = time.time()
-                config.servoPositionsChanged = False
-
-        try:
-            config.marvinShares.updateProcessDict(config.processName)
-            request = config.marvinShares.skeletonRequestQueue.get(block=True, timeout=1)
-        except queue.Empty: # in case of empty queue update processDict only
-            continue
-        except TimeoutError: # in case of timeout update processDict only
-            continue
-        except Exception as e:
-            config.log(f"exception in waiting for skeleton request, {e=}, going down")
-            config.marvinShares.removeProcess(config.processName)
-            os._exit(11)
-
-        try:
-            if 'servoName' in request.keys():
-                # do not log head.jaw requests as they are very frequent
-                if request['servoName'] != 'head.jaw':
-                    config.log(f"skeletonRequestQueue, request received: {request}")
-        except Exception as e:
-            config.log(f"invalid request received: {request}")
-
-        ################################################################
-        # try to call the servo method in module skeletonRequests
-        ################################################################
-        try:
-            methodName = request['msgType']
-            getattr(skeletonRequests, methodName, lambda: 'unknown')(request)   #skeletonRequests.cmd
-
-        except Exception as e:
-            config.log(f"unknown command or failure in function, request [{request}], {e}")
-            os._exit(1)
-
-
+    processSkeletonRequests()
@@ -5,6 +5,7 @@ import arduinoSend
 from marvinglobal import marvinglobal as mg
 from marvinglobal import skeletonClasses
 import feedbackServo
+import servoLookup
 
 #    def assign(self, requestQueue, servoName, initialPosition):
 #        requestQueue.put({'msgType': 'assign', 'servoName': servoName, 'position': initialPosition})
@@ -22,29 +23,80 @@ def reassign(msg):
     servoDerivedDict = config.marvinShares.servoDict.get(mg.SharedDataItems.SERVO_DERIVED)
     sharedServoDerived = servoDerivedDict.get(servoName)
     config.servoDerivedDictLocal[servoName] = copy.deepcopy(sharedServoDerived)
+    servoLookup.rebuildServo(servoName)
 
     currentPos = config.servoCurrentDictLocal.get(servoName).currentPosition
     arduinoSend.servoAssign(servoName, currentPos)
 
+# move a group of servos on both arduinos at a scheduled time
+# request: {'msgType': 'scheduledMove', 'moves': [{'servoName': .., 'position' or 'degrees': .., 'duration': ..}, ..],
+#           'startTime': <time.time() value, optional>, 'deadline': <latest start time, optional>}
+def scheduledMove(request):
+    moveRequests = []
+    for move in request['moves']:
+        servoName = move['servoName']
+        if 'position' in move:
+            position = move['position']
+        else:
+            position = servoLookup.posFromDeg(servoName, move['degrees'])
+        moveRequest = arduinoSend.prepareMoveRequest(servoName, position, move['duration'])
+        if moveRequest is not None:
+            moveRequests.append(moveRequest)
+
+    if len(moveRequests) > 0:
+        config.moveScheduler.addGroup(moveRequests, request.get('startTime'), request.get('deadline'))
+
+# move a set of servos together, one request and one batch per arduino for the whole pose
+# request: {'msgType': 'pose', 'targets': {servoName: degrees or position, ..}, 'unit': 'degrees'|'position',
+#           'duration': <ms, optional> or 'speedRate': <>0..1, optional>, 'startTime': <time.time() value, optional>,
+#           'poseId': <int, optional>}
+# the end of the pose is reported once, see poseTracker
+def pose(request):
+    duration = request.get('duration')
+    speedRate = request.get('speedRate', 1.0) if duration is None else None
+    if speedRate is not None and not 0 < speedRate <= 1:
+        config.log(f"pose rejected, speedRate {speedRate} not in >0..1")
+        return
+    moveRequests, problems = arduinoSend.preparePoseMoves(request['targets'], request.get('unit', 'degrees'), duration, speedRate)
+    poseId = request.get('poseId') or config.poseTracker.newPoseId()
+    if len(problems) > 0:
+        config.log(f"pose {poseId} rejected, {'; '.join(problems)}")
+        return
+
+    # non-sequential requests of the pose servos not yet sent would override the pose
+    for moveRequest in moveRequests:
+        config.requestCoalescer.drop(moveRequest['servoName'])
+
+    if 'startTime' in request:
+        groupId = config.moveScheduler.addGroup(moveRequests, request['startTime'], request.get('deadline'))
+        if groupId is None:
+            return
+    else:
+        groupId = config.moveScheduler.startGroup(moveRequests) if len(moveRequests) > 0 else None
+    config.poseTracker.start(poseId, moveRequests, groupId)
+    config.log(f"pose {poseId}, {len(moveRequests)} of {len(request['targets'])} servos moving", category='requests')
+
 #    def stop(self, requestQueue, servoName):
 #        requestQueue.put({'msgType': 'stop', 'servoName': servoName})
 def stop(request):
     arduinoSend.requestServoStop(request['servoName'])
 
 # move servo to position 0..180
+# non-sequential requests go through the requestCoalescer, newer targets replace not yet sent ones
 def position(request):
     #config.log(f"{request=}")
-    if "sequential" in request:
-        arduinoSend.requestServoPosition(request['servoName'], request['position'], request['duration'],request['sequential'])
+    if request.get('sequential', False):
+        arduinoSend.requestServoPosition(request['servoName'], request['position'], request['duration'], True)
     else:
-        arduinoSend.requestServoPosition(request['servoName'], request['position'], request['duration'], False)
+        config.requestCoalescer.submit(request['servoName'], request['position'], request['duration'])
 
 # move servo to requested degrees
 def requestDegrees(request):
-    if "sequential" in request:
-        arduinoSend.requestServoDegrees(request['servoName'], request['degrees'], request['duration'], request['sequential'])
+    if request.get('sequential', False):
+        arduinoSend.requestServoDegrees(request['servoName'], request['degrees'], request['duration'], True)
     else:
-        arduinoSend.requestServoDegrees(request['servoName'], request['degrees'], request['duration'], False)
+        position = servoLookup.posFromDeg(request['servoName'], request['degrees'])
+        config.requestCoalescer.submit(request['servoName'], position, request['duration'])
 
 #    def setVerbose(self, requestQueue, servoName, verbose):
 #        requestQueue.put({'msgType': 'setVerbose', 'servoName': servoName, 'verbose': verbose})
@@ -77,6 +129,24 @@ def stopRandomMoves(request):
 def stopGesture(request):
     # remove process from running process list
     config.marvinShares.removeProcess('playGesture')
+    config.gesturePlayer.stop()
+
+# play a gesture file with the in-process gesture player, see gesturePlayer
+# request: {'msgType': 'playGesture', 'gesture': <name of the file in config.gestureDir without .json>}
+def playGesture(request):
+    problems = config.gesturePlayer.play(request['gesture'])
+    if len(problems) > 0:
+        config.log(f"gesture {request['gesture']} not played, {'; '.join(problems)}")
+
+def pauseGesture(request):
+    config.gesturePlayer.pause()
+
+def resumeGesture(request):
+    config.gesturePlayer.resume()
+
+# request: {'msgType': 'seekGesture', 'time': <ms from gesture start>}
+def seekGesture(request):
+    config.gesturePlayer.seek(request['time'])
 
 
 def startSwipe(request):
@@ -109,8 +179,71 @@ def stopSwipe(request):
     arduinoSend.requestRest(servoName)
 
 
+# write the last known servo positions to the json file
+# request: {'msgType': 'exportServoPositions'}
+def exportServoPositions(request):
+    config.positionStore.exportJson(mg.PERSISTED_SERVO_POSITIONS_FILE)
+
+
+# change the log level of a log category at runtime
+# request: {'msgType': 'setLogLevel', 'category': 'serial'|'feedback'|'moveBuffer'|'requests'|'gesture'|'general', 'level': 'DEBUG'|'INFO'|'WARNING'|'OFF'}
+def setLogLevel(request):
+    config.setLogLevel(request['category'], request['level'])
+
+
 def updatePIDValues(request):
     servoName = request['servoName']
     feedbackServo.updatePIDValues(servoName, request['kp'], request['ki'], request['kd'])
 
-# test git 2
\ No newline at end of file
+
+# join the queued sequential moves of a servo into one continuous motion, see moveRequestBuffer
+# request: {'msgType': 'setMoveBlending', 'blend': True|False}
+def setMoveBlending(request):
+    config.moveRequestBuffer.blend = request['blend']
+    config.log(f"sequential move blending {'on' if request['blend'] else 'off'}")
+
+
+# log the request counts and handler times of the dispatcher
+# request: {'msgType': 'logRequestStats'}
+def logRequestStats(request):
+    config.requestDispatcher.logStats()
+
+
+# request: {'msgType': 'dumpRequestTraces'}, optional 'enabled': True|False to switch the tracing
+def dumpRequestTraces(request):
+    if 'enabled' in request:
+        config.requestTracer.enabled = bool(request['enabled'])
+    config.requestTracer.logSnapshot()
+
+
+# msgType -> (handler, required fields with their types), see requestDispatcher
+NUMBER = (int, float)
+requestSchemas = {
+    'assign': (assign, {'servoName': str, 'position': NUMBER}),
+    'reassign': (reassign, {'info': dict}),
+    'scheduledMove': (scheduledMove, {'moves': list}),
+    'pose': (pose, {'targets': dict}),
+    'stop': (stop, {'servoName': str}),
+    'position': (position, {'servoName': str, 'position': NUMBER, 'duration': NUMBER}),
+    'requestDegrees': (requestDegrees, {'servoName': str, 'degrees': NUMBER, 'duration': NUMBER}),
+    'requestVerboseState': (requestVerboseState, {'servoName': str, 'verboseOn': (bool, int)}),
+    'allServoStop': (allServoStop, {}),
+    'allServoRest': (allServoRest, {}),
+    'setAutoDetach': (setAutoDetach, {'servoName': str, 'duration': NUMBER}),
+    'stopRandomMoves': (stopRandomMoves, {}),
+    'stopGesture': (stopGesture, {}),
+    'playGesture': (playGesture, {'gesture': str}),
+    'pauseGesture': (pauseGesture, {}),
+    'resumeGesture': (resumeGesture, {}),
+    'seekGesture': (seekGesture, {'time': NUMBER}),
+    'startSwipe': (startSwipe, {'servoName': str, 'duration': NUMBER}),
+    'stopSwipe': (stopSwipe, {'servoName': str}),
+    'exportServoPositions': (exportServoPositions, {}),
+    'setLogLevel': (setLogLevel, {'category': str, 'level': str}),
+    'updatePIDValues': (updatePIDValues, {'servoName': str, 'kp': NUMBER, 'ki': NUMBER, 'kd': NUMBER}),
+    'setMoveBlending': (setMoveBlending, {'blend': bool}),
+    'logRequestStats': (logRequestStats, {}),
+    'dumpRequestTraces': (dumpRequestTraces, {}),
+}
+
+# test git 2
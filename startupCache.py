@@ -0,0 +1,124 @@
+
+# snapshot of the servo definitions prepared at startup
+# holds the servo types, the cleansed static definitions, the derived values, the feedback definitions
+# and the position/degrees conversion tables. the snapshot is valid as long as the content hashes of
+# the definition files and of the code preparing and holding the definitions match, an unchanged
+# configuration is then loaded with a single read
+import os
+import pickle
+import hashlib
+
+import config
+
+CACHE_VERSION = 1
+HASH_SIZE = 32
+
+
+def fileHash(fileName):
+    try:
+        with open(fileName, 'rb') as infile:
+            return hashlib.sha256(infile.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def definitionHashes(fileNames):
+    """
+    :param fileNames: definition files and source files of the classes and functions building the snapshot
+    """
+    return {fileName: fileHash(fileName) for fileName in fileNames}
+
+
+def load(hashes):
+    """
+    :return: the snapshot dict if it was taken from definition files with these hashes, None otherwise
+    """
+    try:
+        with open(config.startupCacheFile, 'rb') as infile:
+            data = infile.read()
+    except OSError:
+        return None
+
+    # the payload is followed by its sha256, a truncated or damaged file is rejected before unpickling
+    payload, checksum = data[:-HASH_SIZE], data[-HASH_SIZE:]
+    if len(data) <= HASH_SIZE or hashlib.sha256(payload).digest() != checksum:
+        config.log(f"startup cache {config.startupCacheFile} damaged, ignored")
+        return None
+    try:
+        snapshot = pickle.loads(payload)
+    except Exception as e:
+        config.log(f"startup cache {config.startupCacheFile} not readable, {e}")
+        return None
+    if snapshot.get('version') != CACHE_VERSION or snapshot.get('hashes') != hashes:
+        config.log(f"servo definitions changed, startup cache not used")
+        return None
+    return snapshot
+
+
+def save(hashes):
+    """
+    snapshot the prepared servo definitions, written to a temporary file and renamed
+    """
+    snapshot = {'version': CACHE_VERSION,
+                'hashes': hashes,
+                'servoTypes': config.servoTypeDictLocal,
+                'servoStatic': config.servoStaticDictLocal,
+                'servoDerived': config.servoDerivedDictLocal,
+                'servoFeedback': config.servoFeedbackDictLocal,
+                'posToDeg': config.posToDeg,
+                'degToPos': config.degToPos}
+    payload = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+    tempFileName = config.startupCacheFile + ".tmp"
+    try:
+        with open(tempFileName, 'wb') as outfile:
+            outfile.write(payload)
+            outfile.write(hashlib.sha256(payload).digest())
+        os.replace(tempFileName, config.startupCacheFile)
+    except OSError as e:
+        config.log(f"could not write startup cache {config.startupCacheFile}, {e}")
+        return
+    config.log(f"startup cache saved, {len(payload)} bytes")
+
+
+def restore(snapshot):
+    config.servoTypeDictLocal.update(snapshot['servoTypes'])
+    config.servoStaticDictLocal.update(snapshot['servoStatic'])
+    config.servoDerivedDictLocal.update(snapshot['servoDerived'])
+    config.servoFeedbackDictLocal.update(snapshot['servoFeedback'])
+    config.posToDeg.update(snapshot['posToDeg'])
+    config.degToPos.update(snapshot['degToPos'])
+    config.log(f"servo definitions loaded from startup cache, {len(config.servoStaticDictLocal)} servos")
+
+
+def backupIfChanged(fileName):
+    """
+    copy the definition file to its .bak file unless the backup has the same content
+    """
+    try:
+        with open(fileName, 'rb') as infile:
+            data = infile.read()
+        backupName = fileName + ".bak"
+        if os.path.isfile(backupName):
+            with open(backupName, 'rb') as infile:
+                if infile.read() == data:
+                    return
+        with open(backupName, 'wb') as outfile:
+            outfile.write(data)
+        config.log(f"backup {backupName} updated")
+    except OSError as e:
+        config.log(f"could not backup {fileName}, {e}")
+
+
+def writeIfChanged(fileName, text):
+    """
+    :return: True if the file content differed and was written
+    """
+    try:
+        with open(fileName, 'r') as infile:
+            if infile.read() == text:
+                return False
+    except OSError:
+        pass
+    with open(fileName, 'w') as outfile:
+        outfile.write(text)
+    return True
@@ -0,0 +1,66 @@
+import struct
+
+import pytest
+
+import arduinoProtocol
+
+
+def encode(command):
+    buffer = bytearray(16)
+    size = arduinoProtocol.encodeInto(buffer, 0, command)
+    assert size == arduinoProtocol.commandSize(command)
+    return bytes(buffer[:size])
+
+
+def asciiFields(pin, position, duration):
+    # the ascii move command as built by arduinoSend.buildMoveRequest
+    return f"1,{pin:02.0f},{position:03.0f},{duration:04.0f},\n".split(',')[:4]
+
+
+@pytest.mark.parametrize("position, duration", [(90, 500), (89.6, 499.5), (0, 0), (180.4, 65535)])
+def test_moveMatchesAscii(position, duration):
+    frame = encode(arduinoProtocol.moveCommand(12, position, duration))
+    assert frame[0] == arduinoProtocol.CMD_MOVE
+    assert [int(field) for field in arduinoProtocol.decode(frame)] == [int(field) for field in asciiFields(12, position, duration)]
+
+
+def test_moveDurationClamped():
+    assert arduinoProtocol.moveCommand(3, 90, 70000)[3] == 0xffff
+
+
+def test_stopAndStatus():
+    assert arduinoProtocol.decode(encode(arduinoProtocol.stopCommand(7))) == ['2', '7']
+    assert arduinoProtocol.decode(encode(arduinoProtocol.statusCommand(7))) == ['4', '7']
+
+
+def test_jaw():
+    command = arduinoProtocol.jawCommand(26, 40.5, 155)
+    assert command[0] == arduinoProtocol.CMD_JAW
+    assert arduinoProtocol.decode(encode(command)) == ['1', '26', '40', '160']
+    # longer moves do not fit the 10 ms units
+    assert arduinoProtocol.jawCommand(26, 40, 3000)[0] == arduinoProtocol.CMD_MOVE
+
+
+def test_frameStartMarksBinary():
+    # binary frames must not be mistaken for the start of an ascii command
+    for command in (arduinoProtocol.moveCommand(1, 2, 3), arduinoProtocol.stopCommand(1),
+                    arduinoProtocol.statusCommand(1), arduinoProtocol.jawCommand(1, 2, 30)):
+        assert encode(command)[0] >= 0xE0
+
+
+def test_outOfRangeRaises():
+    with pytest.raises(struct.error):
+        encode(arduinoProtocol.moveCommand(3, 300, 100))
+
+
+@pytest.mark.parametrize("greeting, protocol, credits", [("S0 skeleton", arduinoProtocol.PROTOCOL_ASCII, 0),
+                                                         ("S0 skeleton P1", arduinoProtocol.PROTOCOL_BINARY, 0),
+                                                         ("S1 skeleton P1 A4", arduinoProtocol.PROTOCOL_BINARY, 4)])
+def test_greeting(greeting, protocol, credits):
+    assert arduinoProtocol.parseGreeting(greeting) == protocol
+    assert arduinoProtocol.parseAckCredits(greeting) == credits
+
+
+def test_isAck():
+    assert arduinoProtocol.isAck("S0 ack")
+    assert not arduinoProtocol.isAck("S0 ack 1")
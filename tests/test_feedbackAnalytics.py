@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import feedbackAnalytics
+
+
+def chunk(moves):
+    """
+    :param moves: list of (fromPos, toPos, speedRate, planned, current), one sample every 100 ms
+    :return: (index, columns) as read by feedbackAnalytics.loadChunk
+    """
+    index = np.zeros(len(moves), dtype=feedbackAnalytics.INDEX_DTYPE)
+    columns = {columnName: [] for columnName in feedbackAnalytics.COLUMN_DTYPES}
+    offset = 0
+    for moveIndex, (fromPos, toPos, speedRate, planned, current) in enumerate(moves):
+        index[moveIndex] = (b"head.rothead", 0.0, fromPos, toPos, speedRate, 0, 0, 0, offset, len(planned))
+        columns['ms'] += [sample * 100 for sample in range(len(planned))]
+        columns['planned'] += planned
+        columns['servoWrite'] += planned
+        columns['current'] += current
+        offset += len(planned)
+    return index, {columnName: np.array(values, dtype=feedbackAnalytics.COLUMN_DTYPES[columnName])
+                   for columnName, values in columns.items()}
+
+
+PLANNED = [0, 20, 40, 60, 80] + [100] * 6
+
+
+def test_slowMoveLowersAchievedSpeedRate():
+    # the plan reaches the target after 500 ms, the servo needs 1000 ms
+    current = [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
+    metrics = feedbackAnalytics.moveMetrics(*chunk([(0, 100, 0.5, PLANNED, current)]))
+    assert metrics['plannedMs'][0] == 500
+    assert metrics['settlingMs'][0] == 1000
+    assert metrics['achievedSpeedRate'][0] == pytest.approx(0.25)
+    assert metrics['maxError'][0] == 50
+    assert metrics['overshoot'][0] == 0
+
+
+def test_overshootAndSettling():
+    current = [0, 20, 40, 60, 80, 100, 104, 101, 100, 100, 100]
+    metrics = feedbackAnalytics.moveMetrics(*chunk([(0, 100, 0.5, PLANNED, current)]))
+    assert metrics['overshoot'][0] == 4
+    assert metrics['settlingMs'][0] == 700
+    assert metrics['achievedSpeedRate'][0] == pytest.approx(0.5 * 500 / 700)
+
+
+def test_movesOfOneChunk():
+    # the second move runs down, the per move values must not mix
+    down = [100, 80, 60, 40, 20] + [0] * 6
+    index, columns = chunk([(0, 100, 1.0, PLANNED, PLANNED), (100, 0, 0.5, down, [100] * 11)])
+    metrics = feedbackAnalytics.moveMetrics(index, columns)
+    assert metrics['achievedSpeedRate'][0] == pytest.approx(1.0)
+    assert metrics['rmsError'][0] == 0
+    assert np.isnan(metrics['settlingMs'][1])
+    assert np.isnan(metrics['achievedSpeedRate'][1])
+
+
+def test_analyseArchive(tmp_path):
+    index, columns = chunk([(0, 100, 0.5, PLANNED, PLANNED), (100, 0, 0.5, PLANNED[::-1], PLANNED[::-1])])
+    index['servoName'][1] = b"head.neck"
+    dayDir = tmp_path / "2026-10-18"
+    dayDir.mkdir()
+    index.tofile(dayDir / "chunk000.index")
+    for columnName, values in columns.items():
+        values.tofile(dayDir / f"chunk000.{columnName}")
+    (dayDir / "chunk001.index").touch()
+    for columnName in columns:
+        (dayDir / f"chunk001.{columnName}").touch()
+
+    assert feedbackAnalytics.chunkNames(str(dayDir)) == ["chunk000", "chunk001"]
+    movesIndex, metrics = feedbackAnalytics.analyse(["2026-10-18"], str(tmp_path), servoName="head.neck")
+    assert list(movesIndex['servoName']) == [b"head.neck"]
+    assert metrics['rmsError'][0] == 0
@@ -0,0 +1,34 @@
+import numpy as np
+
+import feedbackAnalytics
+import pidTuning
+
+
+def writeChunk(dayDir, ms, planned, current):
+    index = np.zeros(1, dtype=feedbackAnalytics.INDEX_DTYPE)
+    index[0] = (b"leftArm.shoulder", 0.0, planned[0], planned[-1], 0.5, 0, 0, 0, 0, len(ms))
+    index.tofile(dayDir / "chunk000.index")
+    columns = {'ms': ms, 'current': current, 'servoWrite': planned, 'planned': planned}
+    for columnName, values in columns.items():
+        np.array(values, dtype=feedbackAnalytics.COLUMN_DTYPES[columnName]).tofile(dayDir / f"chunk000.{columnName}")
+
+
+def test_sharedTimestamps(tmp_path):
+    # most samples share their timestamp with the previous one, the sample time must not become 0
+    dayDir = tmp_path / "2026-10-18"
+    dayDir.mkdir()
+    ms = [20 * (k // 3) for k in range(60)]
+    planned = [min(100, 5 * k) for k in range(60)]
+    current = [0] + [round(0.5 * (planned[k - 1] + position)) for k, position in enumerate(planned[1:], 1)]
+    writeChunk(dayDir, ms, planned, current)
+
+    plant = pidTuning.fitPlant("leftArm.shoulder", ["2026-10-18"], str(tmp_path))
+    assert plant.sampleMs == 20
+    profiles = pidTuning.profiles(plant)
+    assert profiles['step'][-1] == 60
+    settlingMs, _, _ = pidTuning.simulate(plant, 0.5, 0.0, 0.0, profiles['ramp 1.0'])
+    assert settlingMs is None or settlingMs >= 0
+
+
+def test_unknownServo(tmp_path):
+    assert pidTuning.fitPlant("head.neck", ["2026-10-18"], str(tmp_path)) is None
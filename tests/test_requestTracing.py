@@ -0,0 +1,57 @@
+import sys
+import types
+
+# the histogram needs no config, the full config needs marvinglobal and builds the controller singletons
+sys.modules.setdefault('config', types.ModuleType('config'))
+import requestTracing
+
+
+def test_smallValuesExact():
+    for us in range(2 * requestTracing.SUB_BUCKETS):
+        assert requestTracing.bucketIndex(us) == us
+        assert requestTracing.bucketValue(us) == us
+    assert requestTracing.bucketIndex(-5) == 0
+
+
+def test_bucketHoldsValue():
+    # a value falls into the bucket starting at or below it, with a relative error below 1 / SUB_BUCKETS
+    for us in (32, 33, 100, 1000, 12345, 10 ** 6, 2 ** 30 + 7):
+        index = requestTracing.bucketIndex(us)
+        assert requestTracing.bucketValue(index) <= us < requestTracing.bucketValue(index + 1)
+        assert us - requestTracing.bucketValue(index) < us / requestTracing.SUB_BUCKETS
+
+
+def test_monotonic():
+    indexes = [requestTracing.bucketIndex(us) for us in range(0, 100000, 7)]
+    assert indexes == sorted(indexes)
+
+
+def test_largeValuesInLastBucket():
+    assert requestTracing.bucketIndex(2 ** 40) == requestTracing.NUM_BUCKETS - 1
+
+
+def test_traceStages():
+    tracer = requestTracing.RequestTracer()
+    servoNames = tracer.begin({'msgType': 'position', 'servoName': 'head.neck', 'enqueueTime': 1.0}, 1.001)
+    trace = tracer.admit('head.neck')
+    tracer.endHandler(servoNames)
+    tracer.dispatch('head.neck', trace)
+    tracer.mark('head.neck', requestTracing.MOVING)      # status of the previous move, not counted
+    tracer.mark('head.neck', requestTracing.WRITTEN, trace.times[requestTracing.DISPATCHED] + 0.002)
+    tracer.mark('head.neck', requestTracing.MOVING)
+    tracer.reached('head.neck')
+    assert tracer.stats()['completed'] == 1
+    assert tracer.stats()['inFlight'] == 0
+    stages = tracer.snapshot()['stages']
+    assert stages['position/written']['count'] == 1
+    assert 1.9 <= stages['position/written']['p50'] <= 2.0
+
+
+def test_supersededAndNoMove():
+    tracer = requestTracing.RequestTracer()
+    for _ in range(2):
+        tracer.begin({'msgType': 'position', 'servoName': 'head.neck'}, 0.0)
+        tracer.dispatch('head.neck', tracer.admit('head.neck'))
+    tracer.endHandler(tracer.begin({'msgType': 'position', 'servoName': 'head.neck'}, 0.0))
+    assert tracer.stats()['superseded'] == 1
+    assert tracer.stats()['noMove'] == 1
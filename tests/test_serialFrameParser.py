@@ -0,0 +1,29 @@
+import serialFrameParser
+
+
+def test_textAndStatusFrames():
+    parser = serialFrameParser.FrameParser()
+    frames = parser.feed(b"S0 skeleton P1\n\xc1\x05\x5a\n\xc3\x01\x02\x03\x04\x05\x06\n")
+    assert frames == [b"S0 skeleton P1\n", b"\xc1\x05\x5a\n", b"\xc3\x01\x02\x03\x04\x05\x06\n"]
+    assert parser.stats() == {'bytesReceived': 27, 'statusFrames': 2, 'textLines': 1, 'errors': {}}
+
+
+def test_partialFramesKept():
+    parser = serialFrameParser.FrameParser()
+    assert parser.feed(b"S0 a") == []
+    assert parser.feed(b"ck\n\xc1\x05") == [b"S0 ack\n"]
+    assert parser.feed(b"\x5a\n") == [b"\xc1\x05\x5a\n"]
+
+
+def test_statusFrameLengthError():
+    parser = serialFrameParser.FrameParser()
+    assert parser.feed(b"\xc1\x05\n") == []
+    assert parser.stats()['errors'] == {'statusFrameLength': 1}
+    assert parser.feed(b"ok\n") == [b"ok\n"]
+
+
+def test_overflowClearsBuffer():
+    parser = serialFrameParser.FrameParser(maxFrameLength=8)
+    assert parser.feed(b"0123456789") == []
+    assert parser.stats()['errors'] == {'overflow': 1}
+    assert parser.feed(b"ok\n") == [b"ok\n"]
@@ -0,0 +1,47 @@
+import os
+import types
+
+import pytest
+
+import sharedServoState
+
+
+@pytest.fixture
+def state():
+    state = sharedServoState.SharedServoState(f"testServoState{os.getpid()}", ["head.neck", "rightArm.bicep"])
+    yield state
+    state.close()
+
+
+def servoCurrent(position):
+    return types.SimpleNamespace(currentPosition=position, currentDegrees=position / 2, targetPosition=position,
+                                 servoWritePosition=position, plannedPosition=position, timeOfLastMoveRequest=0.0)
+
+
+def test_readWrittenState(state):
+    state.update("rightArm.bicep", servoCurrent(120), sharedServoState.FLAG_MOVING | sharedServoState.FLAG_ASSIGNED)
+    reader = sharedServoState.ServoStateReader(state.name)
+    try:
+        assert reader.servoNames == ["head.neck", "rightArm.bicep"]
+        values = reader.read("rightArm.bicep")
+        assert values['position'] == 120 and values['degrees'] == 60
+        assert values['moving'] and values['assigned'] and not values['attached']
+        assert reader.readPosition("head.neck") == 0
+    finally:
+        reader.close()
+
+
+def test_inconsistentSlot(state):
+    # the owner died while writing the slot, the seq stays odd
+    reader = sharedServoState.ServoStateReader(state.name)
+    try:
+        state.seq[0] += 1
+        with pytest.raises(TimeoutError):
+            reader.read("head.neck")
+    finally:
+        reader.close()
+
+
+def test_nameTooLong():
+    with pytest.raises(ValueError):
+        sharedServoState.SharedServoState(f"testServoState{os.getpid()}", ["x" * (sharedServoState.NAME_SIZE + 1)])
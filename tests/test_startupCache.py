@@ -0,0 +1,46 @@
+import sys
+import types
+
+import pytest
+
+# startupCache only needs config.log, the cache file name and the cached dicts, see the fixture
+sys.modules.setdefault('config', types.ModuleType('config'))
+import startupCache
+
+HASHES = {'servoTypes.json': 'a1', 'servoStatic.json': 'b2', 'servoFeedback.json': None}
+
+
+@pytest.fixture
+def cacheFile(tmp_path, monkeypatch):
+    fileName = str(tmp_path / "startupCache.pickle")
+    config = types.SimpleNamespace(log=lambda msg, *args, **kwargs: None, startupCacheFile=fileName,
+                                   servoTypeDictLocal={}, servoStaticDictLocal={}, servoDerivedDictLocal={},
+                                   servoFeedbackDictLocal={}, posToDeg={'head.rothead': [0.5, 1.0]}, degToPos={})
+    monkeypatch.setattr(startupCache, 'config', config)
+    return fileName
+
+
+def test_roundTrip(cacheFile):
+    startupCache.save(HASHES)
+    snapshot = startupCache.load(HASHES)
+    assert snapshot['version'] == startupCache.CACHE_VERSION
+    assert snapshot['posToDeg'] == {'head.rothead': [0.5, 1.0]}
+
+
+def test_missingFile(cacheFile):
+    assert startupCache.load(HASHES) is None
+
+
+def test_changedDefinitions(cacheFile):
+    startupCache.save(HASHES)
+    assert startupCache.load(dict(HASHES, **{'servoStatic.json': 'c3'})) is None
+
+
+@pytest.mark.parametrize("damage", [lambda data: data[:-1], lambda data: data[:10], lambda data: b'x' + data[1:], lambda data: b''])
+def test_damagedFile(cacheFile, damage):
+    startupCache.save(HASHES)
+    with open(cacheFile, 'rb') as infile:
+        data = infile.read()
+    with open(cacheFile, 'wb') as outfile:
+        outfile.write(damage(data))
+    assert startupCache.load(HASHES) is None
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+import trajectoryBlending
+
+
+def test_singleSegment():
+    times, waypoints = trajectoryBlending.planBlend(0, [100], [1000], msPerPos=2.0)
+    assert times[-1] == pytest.approx(1000)
+    assert waypoints[-1] == 100
+    assert np.all(np.diff(times) > 0)
+    assert np.all(np.diff(waypoints) >= 0)
+    assert np.all(np.diff(times) <= 200 + 1e-9)
+
+
+def test_segmentEndsAreWaypoints():
+    times, waypoints = trajectoryBlending.planBlend(0, [50, 100], [500, 500], msPerPos=2.0)
+    assert 500 in times
+    assert waypoints[list(times).index(500)] == pytest.approx(50)
+    assert waypoints[-1] == 100
+
+
+def test_tooShortDurationExtended():
+    # 100 positions at 5 ms per position need at least 500 ms
+    times, waypoints = trajectoryBlending.planBlend(0, [100], [100], msPerPos=5.0)
+    assert times[-1] >= 500
+    assert waypoints[-1] == 100
+
+
+def test_directionChangeStops():
+    times, waypoints = trajectoryBlending.planBlend(0, [100, 20], [1000, 1000], msPerPos=2.0, intervalMs=50)
+    assert waypoints.max() == pytest.approx(100)
+    assert waypoints[-1] == 20
+    # the servo turns at the first target, no waypoint beyond it
+    assert np.all(waypoints <= 100 + 1e-9)
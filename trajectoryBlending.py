@@ -0,0 +1,63 @@
+
+# continuous velocity profile over the queued sequential moves of a servo
+# each segment gets a trapezoidal profile whose entry and exit velocities are shared with its neighbours,
+# the servo passes the intermediate targets without stopping unless the direction reverses.
+# the profile is sampled into waypoints, every waypoint is sent as a short move that reaches the arduino
+# before the previous one ends, see moveRequestBuffer
+import numpy as np
+
+
+def planBlend(startPos, targets, durations, msPerPos, rampMs=150.0, intervalMs=200.0):
+    """
+    :param startPos: current position of the servo
+    :param targets: target position of every segment
+    :param durations: requested ms of every segment, extended where the servo can not make it
+    :param msPerPos: ms the servo needs per position at full speed
+    :param rampMs: ms to change the velocity at the start and end of a segment
+    :param intervalMs: ms between waypoints, the segment ends are always waypoints
+    :return: (waypoint times in ms from the start, waypoint positions), the last waypoint is the last target
+    """
+    positions = np.concatenate(([float(startPos)], np.asarray(targets, dtype=np.float64)))
+    deltas = np.diff(positions)
+    segmentMs = np.maximum(np.maximum(np.asarray(durations, dtype=np.float64), np.abs(deltas) * msPerPos), 1.0)
+    velocities = deltas / segmentMs
+
+    # a segment end is passed with the lower speed of both segments, the servo stops where the direction changes
+    sameDirection = np.sign(velocities[:-1]) * np.sign(velocities[1:]) > 0
+    jointVelocities = np.where(sameDirection,
+                               np.sign(velocities[:-1]) * np.minimum(np.abs(velocities[:-1]), np.abs(velocities[1:])), 0.0)
+    entryVelocities = np.concatenate(([0.0], jointVelocities))
+    exitVelocities = np.concatenate((jointVelocities, [0.0]))
+
+    # cruise velocity covering the segment distance in its duration, limited by the servo speed
+    rampMs = np.minimum(rampMs, segmentMs / 3)
+    cruiseVelocities = (deltas - (entryVelocities + exitVelocities) * rampMs / 2) / (segmentMs - rampMs)
+    maxVelocity = 1.0 / msPerPos
+    tooFast = np.abs(cruiseVelocities) > maxVelocity
+    cruiseVelocities = np.where(tooFast, np.sign(deltas) * maxVelocity, cruiseVelocities)
+    segmentMs = np.where(tooFast, rampMs + (np.abs(deltas) - np.abs(entryVelocities + exitVelocities) * rampMs / 2) / maxVelocity,
+                         segmentMs)
+
+    segmentEnds = np.cumsum(segmentMs)
+    segmentStarts = segmentEnds - segmentMs
+
+    # waypoints on a regular grid plus the segment ends, grid points close to a segment end are dropped
+    grid = np.arange(intervalMs, segmentEnds[-1], intervalMs)
+    distance = np.min(np.abs(grid[:, None] - segmentEnds[None, :]), axis=1) if len(grid) > 0 else grid
+    times = np.union1d(grid[distance > intervalMs / 2], segmentEnds)
+
+    segment = np.minimum(np.searchsorted(segmentEnds, times, side='left'), len(segmentMs) - 1)
+    u = times - segmentStarts[segment]
+    length = segmentMs[segment]
+    ramp = rampMs[segment]
+    entry = entryVelocities[segment]
+    cruise = cruiseVelocities[segment]
+    exit = exitVelocities[segment]
+    rampDistance = (entry + cruise) * ramp / 2
+    w = u - (length - ramp)
+    displacement = np.where(u < ramp, entry * u + (cruise - entry) * u ** 2 / (2 * ramp),
+                            np.where(w <= 0, rampDistance + cruise * (u - ramp),
+                                     rampDistance + cruise * (length - 2 * ramp) + cruise * w + (exit - cruise) * w ** 2 / (2 * ramp)))
+    waypoints = positions[segment] + displacement
+    waypoints[-1] = positions[-1]
+    return times, waypoints